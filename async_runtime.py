@@ -0,0 +1,56 @@
+import asyncio
+import logging
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+from telebot.async_telebot import AsyncTeleBot
+
+from webhook import update_key
+
+logger = logging.getLogger(__name__)
+
+# runtime مبتنی بر asyncio (RUN_MODE = "async"):
+# - AsyncTeleBot آپدیت‌ها را long-poll می‌کند و ارسال‌های صف (outbox) را هم‌زمان انجام می‌دهد.
+# - هندلرها دیگر منتظر HTTP نیستند و فقط با SQLite کار دارند، پس روی یک executor
+#   کوچک و جدا برای دیتابیس اجرا می‌شوند؛ تعداد thread به تعداد کاربران بستگی ندارد.
+# - آپدیت‌های هر چت به ترتیب و چت‌های مختلف با asyncio.gather هم‌زمان پردازش می‌شوند.
+
+async def run(bot, outbox, token, parse_mode=None, db_workers=4, send_concurrency=100, poll_timeout=30):
+    abot = AsyncTeleBot(token, parse_mode=parse_mode)
+    loop = asyncio.get_running_loop()
+    executor = ThreadPoolExecutor(db_workers, thread_name_prefix="db")
+    sender = loop.create_task(outbox.run_async(abot, send_concurrency))
+    offset = None
+
+    try:
+        while True:
+            try:
+                updates = await abot.get_updates(
+                    offset=offset, timeout=poll_timeout, request_timeout=poll_timeout + 10
+                )
+            except Exception:
+                logger.exception("get_updates failed")
+                await asyncio.sleep(3)
+                continue
+            if not updates:
+                continue
+            offset = updates[-1].update_id + 1
+            await process_updates(loop, executor, bot, updates)
+    finally:
+        sender.cancel()
+        executor.shutdown(wait=False)
+        await abot.close_session()
+
+async def process_updates(loop, executor, bot, updates):
+    by_chat = defaultdict(list)
+    for update in updates:
+        by_chat[update_key(update)].append(update)
+
+    results = await asyncio.gather(
+        *(loop.run_in_executor(executor, bot.process_new_updates, chat_updates)
+          for chat_updates in by_chat.values()),
+        return_exceptions=True
+    )
+    for result in results:
+        if isinstance(result, Exception):
+            logger.error("update processing failed", exc_info=result)
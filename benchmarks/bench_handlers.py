@@ -0,0 +1,303 @@
+# بنچمارک آفلاین هندلرهای bot.py: بدون توکن و بدون شبکه
+#
+#   python -m benchmarks.bench_handlers --buyers 10000 --out results.json
+#
+# درخواست‌های telebot به یک سرور تلگرام ساختگی داخل همین پروسه می‌روند
+# (apihelper.CUSTOM_REQUEST_SENDER) و جریانی از آپدیت‌های مصنوعی (خریدارهایی که محصولات را
+# می‌بینند، به سبد اضافه می‌کنند و به فروشنده پیام می‌دهند) روی یک shop.db ساختگی اجرا می‌شود.
+# خروجی JSON برای مقایسه‌ی اجراهای مختلف با هم است.
+
+import argparse
+import io
+import json
+import os
+import platform
+import random
+import sqlite3
+import statistics
+import subprocess
+import sys
+import threading
+import time
+import types
+import zlib
+from collections import Counter, defaultdict
+
+import config
+
+# ===================== FAKE TELEGRAM =====================
+
+class FakeResponse:
+    status_code = 200
+    reason = "OK"
+
+    def __init__(self, result):
+        self._json = {"ok": True, "result": result}
+        self.text = json.dumps(self._json)
+
+    def json(self):
+        return self._json
+
+class FakeTelegram:
+    # به هر متد تلگرام یک پاسخ معتبر و فوری می‌دهد و تعداد فراخوانی‌ها را می‌شمارد
+    def __init__(self):
+        self.calls = Counter()
+        self._lock = threading.Lock()
+        self._message_id = 0
+
+    def _message(self, chat_id):
+        with self._lock:
+            self._message_id += 1
+            message_id = self._message_id
+        return {
+            "message_id": message_id,
+            "date": 1,
+            "chat": {"id": int(chat_id or 1), "type": "private"},
+        }
+
+    def __call__(self, method, url, params=None, files=None, **kwargs):
+        name = url.rsplit("/", 1)[1]
+        params = params or {}
+        with self._lock:
+            self.calls[name] += 1
+        if name == "getMe":
+            return FakeResponse({"id": 1, "is_bot": True, "first_name": "bench", "username": "bench_bot"})
+        if name in ("answerCallbackQuery", "answerInlineQuery", "setWebhook"):
+            return FakeResponse(True)
+        if name == "sendMediaGroup":
+            media = json.loads(params["media"])
+            return FakeResponse([self._message(params.get("chat_id")) for _ in media])
+        message = self._message(params.get("chat_id"))
+        if name == "sendPhoto":
+            # file_id عکس آپلودشده (مثلاً کولاژ) همان file_id ارسال است یا یک شناسه‌ی جدید
+            photo = params.get("photo") if isinstance(params.get("photo"), str) else f"upload{message['message_id']}"
+            message["photo"] = [{"file_id": photo, "file_unique_id": photo, "width": 960, "height": 960}]
+        return FakeResponse(message)
+
+    # ---------- file API (برای collage.PhotoCache) ----------
+
+    def get_file(self, file_id):
+        with self._lock:
+            self.calls["getFile"] += 1
+        return types.SimpleNamespace(file_id=file_id, file_path=f"photos/{file_id}.jpg")
+
+    def download_file(self, file_path):
+        with self._lock:
+            self.calls["downloadFile"] += 1
+        from PIL import Image
+        out = io.BytesIO()
+        shade = zlib.crc32(file_path.encode("utf-8")) & 0xFF
+        Image.new("RGB", (640, 480), (shade, 128, 255 - shade)).save(out, "JPEG")
+        return out.getvalue()
+
+# ===================== UPDATE STREAM =====================
+
+class Updates:
+    def __init__(self):
+        self._next_id = 0
+
+    def _id(self):
+        self._next_id += 1
+        return self._next_id
+
+    def _user(self, user_id):
+        return {"id": user_id, "is_bot": False, "first_name": "u", "username": f"buyer{user_id}"}
+
+    def message(self, user_id, text):
+        return {
+            "update_id": self._id(),
+            "message": {
+                "message_id": self._id(),
+                "date": 1,
+                "chat": {"id": user_id, "type": "private"},
+                "from": self._user(user_id),
+                "text": text,
+            },
+        }
+
+    def callback(self, user_id, data, text=None):
+        message = {"message_id": self._id(), "date": 1, "chat": {"id": user_id, "type": "private"}}
+        if text is not None:
+            message["text"] = text
+        return {
+            "update_id": self._id(),
+            "callback_query": {
+                "id": str(self._id()),
+                "chat_instance": "bench",
+                "from": self._user(user_id),
+                "data": data,
+                "message": message,
+            },
+        }
+
+def buyer_session(updates, user_id, product_ids, words, rng):
+    # یک خریدار معمولی: منو، چند محصول، جستجو، سبد، پیام به فروشنده، تاریخچه
+    pid = rng.choice(product_ids)
+    query = rng.choice(words)
+    session = [
+        updates.message(user_id, "/start"),
+        updates.message(user_id, "🛍 مشاهده همه محصولات"),
+    ]
+    for _ in range(rng.randint(1, 4)):
+        session.append(updates.callback(user_id, f"browse_next:{pid}"))
+        pid = rng.choice(product_ids)
+    session += [
+        updates.message(user_id, f"/search {query}"),
+        updates.callback(user_id, "search_page:5", text=f"🔎 نتایج جستجو: {query}"),
+        updates.callback(user_id, f"later_add:{rng.choice(product_ids)}"),
+        updates.callback(user_id, f"cart_add:{pid}"),
+        updates.callback(user_id, f"cart_add:{rng.choice(product_ids)}"),
+        updates.message(user_id, "🛒 سبد خرید"),
+        updates.callback(user_id, f"contact:{pid}"),
+        updates.message(user_id, "⭐ برای بعداً"),
+        updates.message(user_id, "📜 تاریخچه"),
+    ]
+    return session
+
+def interleave(sessions, rng):
+    # آپدیت‌های خریدارها مثل ترافیک واقعی در هم می‌آیند ولی ترتیب هر خریدار حفظ می‌شود
+    active = [iter(s) for s in sessions]
+    while active:
+        i = rng.randrange(len(active))
+        update = next(active[i], None)
+        if update is None:
+            active[i] = active[-1]
+            active.pop()
+            continue
+        yield update
+
+# ===================== RUN =====================
+
+def percentile(sorted_values, q):
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * q))]
+
+def summarize(timings, calls, count):
+    timings = sorted(timings)
+    return {
+        "count": count,
+        "p50_ms": round(percentile(timings, 0.50) * 1000, 4),
+        "p99_ms": round(percentile(timings, 0.99) * 1000, 4),
+        "mean_ms": round(statistics.fmean(timings) * 1000, 4),
+        "api_calls_per_update": round(calls / count, 3),
+    }
+
+def git_revision():
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"], stderr=subprocess.DEVNULL, text=True
+        ).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def main():
+    parser = argparse.ArgumentParser(description="offline benchmark of bot.py handlers")
+    parser.add_argument("--buyers", type=int, default=10000)
+    parser.add_argument("--sellers", type=int, default=500)
+    parser.add_argument("--products", type=int, default=50000)
+    parser.add_argument("--db", default="bench_handlers.db")
+    parser.add_argument("--out", default="bench_handlers.json")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    # bot.py تنظیماتش را هنگام import از config می‌خواند
+    config.TOKEN = "0:offline-benchmark"
+    config.DB_NAME = os.path.abspath(args.db)
+    # محدودیت نرخ تلگرام اینجا اندازه‌گیری نمی‌شود
+    config.OUTBOX_GLOBAL_RATE = config.OUTBOX_CHAT_RATE = config.OUTBOX_CHAT_BURST = 10 ** 9
+    config.PHOTO_CACHE_DIR = os.path.abspath(args.db) + ".photos"
+    config.COLLAGE_CHAT = -1000000000001
+
+    from telebot import apihelper, types
+    fake = FakeTelegram()
+    apihelper.CUSTOM_REQUEST_SENDER = fake
+
+    import bot as app
+    app.create_app()
+    if app.collages is not None:
+        # دانلود عکس‌ها از تلگرام هم ساختگی است
+        app.collages.photos.file_api = fake
+    from benchmarks.dataset import build_vocabulary, generate_products, generate_users
+    app.bot.threaded = False
+
+    rng = random.Random(args.seed)
+    vocabulary, cum_weights = build_vocabulary(5000, rng)
+    generate_users(app.db, args.sellers, args.buyers)
+    generate_products(app.db, args.products, vocabulary, cum_weights, rng, sellers=args.sellers)
+    app.db.flush()
+
+    product_ids = [row[0] for row in app.db.cursor().execute("SELECT id FROM products")]
+    updates = Updates()
+    buyers = range(args.sellers + 1, args.sellers + args.buyers + 1)
+    sessions = [buyer_session(updates, uid, product_ids, vocabulary[:500], rng) for uid in buyers]
+    stream = [types.Update.de_json(u) for u in interleave(sessions, rng)]
+
+    # زمان و تعداد درخواست‌های API هر هندلر از داخل router.dispatch گرفته می‌شود
+    timings = defaultdict(list)
+    api_calls = Counter()
+    current = threading.local()
+    dispatch = app.router.dispatch
+    submit = app.api.submit
+
+    def timed_dispatch(handler, update, **data):
+        current.handler = handler.__name__
+        start = time.perf_counter()
+        try:
+            dispatch(handler, update, **data)
+        finally:
+            timings[handler.__name__].append(time.perf_counter() - start)
+
+    def counted_submit(method, *a, **kw):
+        api_calls[getattr(current, "handler", None)] += 1
+        return submit(method, *a, **kw)
+
+    app.router.dispatch = timed_dispatch
+    app.api.submit = counted_submit
+
+    print(f"replaying {len(stream)} updates from {args.buyers} buyers", file=sys.stderr)
+    start = time.perf_counter()
+    for update in stream:
+        app.bot.process_new_updates([update])
+    handled = time.perf_counter() - start
+    app.api.join()
+    app.db.flush()
+    drained = time.perf_counter() - start
+
+    total_calls = sum(fake.calls.values())
+    result = {
+        "meta": {
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "git": git_revision(),
+            "python": platform.python_version(),
+            "sqlite": sqlite3.sqlite_version,
+            "buyers": args.buyers,
+            "sellers": args.sellers,
+            "products": len(product_ids),
+            "seed": args.seed,
+        },
+        "total": {
+            "updates": len(stream),
+            "handle_s": round(handled, 3),
+            "drain_s": round(drained, 3),
+            "updates_per_s": round(len(stream) / handled, 1),
+            "api_calls": total_calls,
+            "api_calls_per_update": round(total_calls / len(stream), 3),
+            "api_calls_by_method": dict(fake.calls.most_common()),
+        },
+        "handlers": {
+            name: summarize(values, api_calls[name], len(values))
+            for name, values in sorted(timings.items())
+        },
+    }
+
+    with open(args.out, "w", encoding="utf-8") as f:
+        json.dump(result, f, ensure_ascii=False, indent=2)
+
+    print(f"{'handler':<24}{'count':>8}{'p50 ms':>9}{'p99 ms':>9}{'api/upd':>9}")
+    for name, row in result["handlers"].items():
+        print(f"{name:<24}{row['count']:>8}{row['p50_ms']:>9.3f}{row['p99_ms']:>9.3f}{row['api_calls_per_update']:>9.2f}")
+    total = result["total"]
+    print(f"{total['updates']} updates, {total['updates_per_s']} updates/s, "
+          f"{total['api_calls_per_update']} API calls/update -> {args.out}")
+
+if __name__ == "__main__":
+    main()
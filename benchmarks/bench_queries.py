@@ -0,0 +1,331 @@
+# بنچمارک تک‌تک کوئری‌های bot.py روی دیتابیس مصنوعی بزرگ
+#
+#   python -m benchmarks.bench_queries --users 100000 --products 1000000 --history 10000000
+#
+# جدول‌ها با database.ensure_schema ساخته و با داده‌ی مصنوعی پر می‌شوند (پیش‌فرض bench_queries.db،
+# در اجراهای بعدی دوباره استفاده می‌شود). برای هر کوئری زمان اجرا، EXPLAIN QUERY PLAN و تعداد
+# گام‌های ماشین مجازی SQLite (جایگزین «تعداد سطرهای پیمایش‌شده»؛ پایتون به sqlite3_stmt_status
+# دسترسی ندارد) ثبت می‌شود. کوئری جدید در bot.py باید به queries() هم اضافه شود.
+
+import argparse
+import json
+import os
+import platform
+import random
+import sqlite3
+import statistics
+import sys
+import time
+
+import config
+from benchmarks.bench_handlers import git_revision, percentile
+from benchmarks.dataset import (
+    build_vocabulary, generate_cart, generate_history, generate_later, generate_products,
+    generate_users
+)
+
+# ===================== QUERIES =====================
+
+class StatementRecorder:
+    # به جای cursor به search_products داده می‌شود تا SQL و پارامترهایش را بدون اجرا بگیریم
+    def execute(self, sql, params=()):
+        self.sql, self.params = sql, list(params)
+
+    def fetchall(self):
+        return []
+
+def search_statement(raw):
+    from search import search_products
+    recorder = StatementRecorder()
+    search_products(recorder, raw)
+    return recorder.sql, recorder.params
+
+class Sample:
+    # پارامترهای تصادفی ولی واقعی برای هر کوئری
+    def __init__(self, db, rng, sellers, words):
+        self.rng = rng
+        self.sellers = sellers
+        self.words = words
+        cur = db.cursor()
+        self.max_user = cur.execute("SELECT MAX(telegram_id) FROM users").fetchone()[0]
+        self.max_product = cur.execute("SELECT MAX(id) FROM products").fetchone()[0]
+        self.later = cur.execute("SELECT id FROM later ORDER BY random() LIMIT 1000").fetchall()
+        self.cart = cur.execute("SELECT id, user_id FROM cart ORDER BY random() LIMIT 1000").fetchall()
+
+    def seller(self):
+        return self.rng.randint(1, self.sellers)
+
+    def buyer(self):
+        return self.rng.randint(self.sellers + 1, self.max_user)
+
+    def product(self):
+        return self.rng.randint(1, self.max_product)
+
+    def later_id(self):
+        return self.rng.choice(self.later)[0] if self.later else 0
+
+    def cart_row(self):
+        return self.rng.choice(self.cart) if self.cart else (0, 0)
+
+    def terms(self):
+        return " ".join(self.rng.sample(self.words, 2))
+
+    def price_range(self):
+        low = self.rng.randrange(10000, 90000000, 1000)
+        return f"{low}-{low + 2000000}"
+
+def queries(sample):
+    # (نام، SQL، تابع ساخت پارامترها، آیا می‌نویسد)؛ نوشتن‌ها بعد از اجرا rollback می‌شوند
+    # تا دیتابیس بین اجراها ثابت بماند
+    terms_sql = search_statement("a b")[0]
+    priced_sql = search_statement("a b 1-2")[0]
+    price_only_sql = search_statement("1-2")[0]
+    return [
+        ("identity", "SELECT (SELECT role FROM users WHERE telegram_id=?), \
+                EXISTS(SELECT 1 FROM admins WHERE user_id=?)",
+         lambda: (sample.buyer(),) * 2, False),
+        ("seller_profile",
+         "SELECT username, profile_photo, shop_name, bio, phone, product_count FROM users WHERE telegram_id=?",
+         lambda: (sample.seller(),), False),
+        ("my_products",
+         "SELECT id, title, description, price, photo, contact_count, cart_count \
+         FROM products WHERE seller_id=?",
+         lambda: (sample.seller(),), False),
+        ("catalog_next",
+         "SELECT p.id, p.title, p.description, p.price, p.photo, p.seller_id, u.username \
+             FROM products p LEFT JOIN users u ON p.seller_id = u.telegram_id \
+             WHERE p.id > ? ORDER BY p.id LIMIT 1",
+         lambda: (sample.product(),), False),
+        ("catalog_prev",
+         "SELECT p.id, p.title, p.description, p.price, p.photo, p.seller_id, u.username \
+             FROM products p LEFT JOIN users u ON p.seller_id = u.telegram_id \
+             WHERE p.id < ? ORDER BY p.id DESC LIMIT 1",
+         lambda: (sample.product(),), False),
+        ("inline_latest",
+         "SELECT id, title, price, photo FROM products ORDER BY id DESC LIMIT ?",
+         lambda: (config.INLINE_PAGE_SIZE,), False),
+        ("inline_page",
+         "SELECT id, title, price, photo FROM products WHERE id < ? ORDER BY id DESC LIMIT ?",
+         lambda: (sample.product(), config.INLINE_PAGE_SIZE), False),
+        ("search_terms", terms_sql,
+         lambda: search_statement(sample.terms())[1], False),
+        ("search_terms_price", priced_sql,
+         lambda: search_statement(f"{sample.terms()} {sample.price_range()}")[1], False),
+        ("search_price", price_only_sql,
+         lambda: search_statement(sample.price_range())[1], False),
+        ("later_list",
+         "SELECT l.id, p.id, p.title, p.description, p.price, p.photo \
+         FROM later l JOIN products p ON l.product_id = p.id \
+         WHERE l.user_id=?",
+         lambda: (sample.buyer(),), False),
+        ("later_lookup", "SELECT product_id FROM later WHERE id=?",
+         lambda: (sample.later_id(),), False),
+        ("cart_list",
+         "SELECT c.id, p.id, p.title, p.description, p.price, p.photo, p.seller_id, u.username, \
+                c.quantity, \
+                SUM(p.price * c.quantity) OVER (PARTITION BY p.seller_id), \
+                SUM(p.price * c.quantity) OVER () \
+         FROM cart c \
+         JOIN products p ON c.product_id = p.id \
+         LEFT JOIN users u ON p.seller_id = u.telegram_id \
+         WHERE c.user_id=? \
+         ORDER BY p.seller_id, c.id",
+         lambda: (sample.buyer(),), False),
+        ("contact_lookup",
+         "SELECT p.seller_id, u.username \
+         FROM products p LEFT JOIN users u ON p.seller_id = u.telegram_id \
+         WHERE p.id=?",
+         lambda: (sample.product(),), False),
+        ("history_top20",
+         "SELECT h.timestamp, p.title, u.username \
+         FROM history h \
+         JOIN products p ON h.product_id = p.id \
+         LEFT JOIN users u ON h.seller_id = u.telegram_id \
+         WHERE h.user_id=? \
+         ORDER BY h.id DESC \
+         LIMIT 20",
+         lambda: (sample.buyer(),), False),
+        ("state_load", "SELECT state, data FROM states WHERE chat_id=? AND expires_at > ?",
+         lambda: (sample.buyer(), time.time()), False),
+
+        ("upsert_user",
+         "INSERT INTO users (telegram_id, role, username) VALUES (?, NULL, ?) \
+         ON CONFLICT (telegram_id) DO UPDATE SET username = excluded.username \
+         WHERE username IS NOT excluded.username",
+         lambda: (sample.buyer(), "renamed"), True),
+        ("add_product",
+         "INSERT INTO products (seller_id, title, description, price, photo) VALUES (?, ?, ?, ?, ?)",
+         lambda: (sample.seller(), sample.terms(), sample.terms(), 100000, "PHOTO"), True),
+        ("update_product_title", "UPDATE products SET title=? WHERE id=?",
+         lambda: (sample.terms(), sample.product()), True),
+        ("later_add", "INSERT OR IGNORE INTO later (user_id, product_id) VALUES (?, ?)",
+         lambda: (sample.buyer(), sample.product()), True),
+        ("cart_add",
+         "INSERT INTO cart (user_id, product_id) VALUES (?, ?) \
+         ON CONFLICT (user_id, product_id) DO UPDATE SET quantity = quantity + 1",
+         lambda: (sample.buyer(), sample.product()), True),
+        ("cart_increment", "UPDATE cart SET quantity = quantity + 1 WHERE id=? AND user_id=?",
+         sample.cart_row, True),
+        ("history_insert",
+         "INSERT INTO history (user_id, product_id, seller_id, timestamp) VALUES (?, ?, ?, ?)",
+         lambda: (sample.buyer(), sample.product(), sample.seller(), "2024-01-01T00:00:00"), True),
+        ("state_save",
+         "INSERT OR REPLACE INTO states (chat_id, state, data, expires_at) VALUES (?, ?, ?, ?)",
+         lambda: (sample.buyer(), "add_product_title", "{}", time.time() + 3600), True),
+        ("delete_later", "DELETE FROM later WHERE id=?",
+         lambda: (sample.later_id(),), True),
+        ("delete_cart_item", "DELETE FROM cart WHERE id=? AND user_id=?",
+         sample.cart_row, True),
+        ("delete_product", "DELETE FROM products WHERE id=?",
+         lambda: (sample.product(),), True),
+        ("delete_user", "DELETE FROM users WHERE telegram_id=?",
+         lambda: (sample.buyer(),), True),
+        ("states_cleanup", "DELETE FROM states WHERE expires_at <= ?",
+         lambda: (time.time(),), True),
+    ]
+
+# ===================== RUN =====================
+
+def query_plan(cur, sql, params):
+    # مثل خروجی sqlite3 CLI: هر گره با تورفتگی زیر والدش
+    rows = cur.execute("EXPLAIN QUERY PLAN " + sql, params).fetchall()
+    depth = {0: -1}
+    lines = []
+    for node, parent, _, detail in rows:
+        depth[node] = depth.get(parent, -1) + 1
+        lines.append("  " * depth[node] + detail)
+    return lines
+
+def full_scans(plan):
+    # SCAN روی جدول واقعی یعنی هزینه با اندازه‌ی جدول رشد می‌کند؛ FTS، ردیف ثابت و
+    # subqueryهایی که خودشان در همین plan ساخته شده‌اند (CO-ROUTINE / MATERIALIZE) حساب نمی‌شوند
+    details = [line.strip() for line in plan]
+    derived = {
+        detail.split()[1] for detail in details
+        if detail.startswith(("CO-ROUTINE ", "MATERIALIZE "))
+    }
+    return [
+        detail for detail in details
+        if detail.startswith("SCAN ")
+        and "VIRTUAL TABLE" not in detail
+        and detail != "SCAN CONSTANT ROW"
+        and not detail.split()[1].startswith("(")
+        and detail.split()[1] not in derived
+    ]
+
+def vm_steps(conn, sql, params):
+    steps = 0
+
+    def count():
+        nonlocal steps
+        steps += 1
+        return 0
+
+    conn.set_progress_handler(count, 1)
+    try:
+        conn.execute(sql, params).fetchall()
+    finally:
+        conn.set_progress_handler(None, 0)
+    return steps
+
+def bench(conn, sql, make_params, write, repeat, step_samples):
+    cur = conn.cursor()
+    timings = []
+    rows = []
+    steps = []
+    for i in range(repeat):
+        params = make_params()
+        start = time.perf_counter()
+        rows.append(len(cur.execute(sql, params).fetchall()))
+        timings.append(time.perf_counter() - start)
+        if i < step_samples:
+            # شمارش گام‌ها خودش کند است؛ جدا از زمان‌گیری انجام می‌شود
+            if write:
+                conn.rollback()
+            steps.append(vm_steps(conn, sql, params))
+        if write:
+            conn.rollback()
+
+    plan = query_plan(cur, sql, make_params())
+    timings.sort()
+    return {
+        "sql": " ".join(sql.split()),
+        "write": write,
+        "p50_ms": round(percentile(timings, 0.50) * 1000, 4),
+        "p99_ms": round(percentile(timings, 0.99) * 1000, 4),
+        "max_ms": round(timings[-1] * 1000, 4),
+        "mean_ms": round(statistics.fmean(timings) * 1000, 4),
+        "rows": round(statistics.fmean(rows), 2),
+        "vm_steps": round(statistics.fmean(steps)) if steps else None,
+        "full_scans": full_scans(plan),
+        "plan": plan,
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="micro-benchmark of every SQL statement in bot.py")
+    parser.add_argument("--users", type=int, default=100000)
+    parser.add_argument("--sellers", type=int, default=5000)
+    parser.add_argument("--products", type=int, default=1000000)
+    parser.add_argument("--history", type=int, default=10000000)
+    parser.add_argument("--cart", type=int, default=300000)
+    parser.add_argument("--later", type=int, default=300000)
+    parser.add_argument("--repeat", type=int, default=200)
+    parser.add_argument("--steps", type=int, default=5, help="executions per query for vm_steps")
+    parser.add_argument("--only", help="comma-separated query names")
+    parser.add_argument("--db", default="bench_queries.db")
+    parser.add_argument("--out", default="bench_queries.json")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    # database مسیر دیتابیس را هنگام import از config.DB_NAME می‌خواند
+    config.DB_NAME = os.path.abspath(args.db)
+    from database import Database, ensure_schema
+
+    ensure_schema()
+    db = Database(config.DB_NAME)
+    rng = random.Random(args.seed)
+    vocabulary, cum_weights = build_vocabulary(5000, rng)
+    buyers = range(args.sellers + 1, args.users + 1)
+    generate_users(db, args.sellers, args.users - args.sellers)
+    generate_products(db, args.products, vocabulary, cum_weights, rng, sellers=args.sellers)
+    products = range(1, args.products + 1)
+    generate_history(db, args.history, buyers, products, rng)
+    generate_cart(db, args.cart, buyers, products, rng)
+    generate_later(db, args.later, buyers, products, rng)
+    with db.transaction() as cur:
+        cur.execute("ANALYZE")
+
+    conn = db.connection()
+    sample = Sample(db, rng, args.sellers, vocabulary[:500])
+    only = set(args.only.split(",")) if args.only else None
+    results = {}
+    print(f"{'query':<22}{'p50 ms':>9}{'p99 ms':>9}{'rows':>8}{'vm steps':>11}  full scans")
+    for name, sql, make_params, write in queries(sample):
+        if only and name not in only:
+            continue
+        row = results[name] = bench(conn, sql, make_params, write, args.repeat, args.steps)
+        print(f"{name:<22}{row['p50_ms']:>9.3f}{row['p99_ms']:>9.3f}{row['rows']:>8.1f}"
+              f"{row['vm_steps'] or 0:>11}  {', '.join(row['full_scans'])}")
+
+    counts = {
+        table: conn.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0]
+        for table in ("users", "products", "history", "cart", "later")
+    }
+    result = {
+        "meta": {
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "git": git_revision(),
+            "python": platform.python_version(),
+            "sqlite": sqlite3.sqlite_version,
+            "rows": counts,
+            "repeat": args.repeat,
+            "seed": args.seed,
+        },
+        "queries": results,
+    }
+    with open(args.out, "w", encoding="utf-8") as f:
+        json.dump(result, f, ensure_ascii=False, indent=2)
+    print(f"{len(results)} queries -> {args.out}", file=sys.stderr)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,78 @@
+# بنچمارک جستجوی محصولات روی دیتابیس مصنوعی
+#
+#   python -m benchmarks.bench_search --products 1000000
+#
+# دیتابیس ساخته‌شده (پیش‌فرض bench_search.db) در اجراهای بعدی دوباره استفاده می‌شود.
+
+import argparse
+import os
+import random
+import statistics
+import time
+
+import config
+from benchmarks.dataset import build_vocabulary, generate_products
+
+def query_sets(vocabulary, rng, repeat):
+    common = vocabulary[:20]
+    rare = vocabulary[len(vocabulary) // 2:]
+    return {
+        "common term": [rng.choice(common) for _ in range(repeat)],
+        "rare term": [rng.choice(rare) for _ in range(repeat)],
+        "two terms": [f"{rng.choice(common)} {rng.choice(rare)}" for _ in range(repeat)],
+        "three terms": [" ".join(rng.choice(common) for _ in range(3)) for _ in range(repeat)],
+        "term + price": [f"{rng.choice(rare)} 1000000-5000000" for _ in range(repeat)],
+        "price only": [f"{p}-{p + 100000}" for p in (rng.randrange(10000, 99000000, 1000) for _ in range(repeat))],
+    }
+
+def run(db, search_products, queries, offsets):
+    cur = db.cursor()
+    results = []
+    for name, batch in queries.items():
+        for offset in offsets:
+            timings = []
+            hits = 0
+            for query in batch:
+                start = time.perf_counter()
+                rows, _, _ = search_products(cur, query, offset)
+                timings.append((time.perf_counter() - start) * 1000)
+                hits += len(rows)
+            timings.sort()
+            results.append((
+                f"{name} @{offset}",
+                statistics.median(timings),
+                timings[int(len(timings) * 0.95) - 1],
+                timings[int(len(timings) * 0.99) - 1],
+                timings[-1],
+                hits / len(batch),
+            ))
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description="benchmark product search")
+    parser.add_argument("--products", type=int, default=1000000)
+    parser.add_argument("--vocabulary", type=int, default=20000)
+    parser.add_argument("--repeat", type=int, default=200)
+    parser.add_argument("--db", default="bench_search.db")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    # database مسیر دیتابیس را هنگام import از config.DB_NAME می‌خواند
+    config.DB_NAME = os.path.abspath(args.db)
+    from database import Database, ensure_schema
+    from search import search_products
+
+    ensure_schema()
+    db = Database(config.DB_NAME)
+    rng = random.Random(args.seed)
+    vocabulary, cum_weights = build_vocabulary(args.vocabulary, rng)
+    generate_products(db, args.products, vocabulary, cum_weights, rng)
+
+    queries = query_sets(vocabulary, rng, args.repeat)
+    run(db, search_products, queries, [0])   # گرم کردن cache
+    print(f"{'query':<22}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}{'max ms':>9}{'rows':>7}")
+    for name, p50, p95, p99, worst, rows in run(db, search_products, queries, [0, 50]):
+        print(f"{name:<22}{p50:>9.2f}{p95:>9.2f}{p99:>9.2f}{worst:>9.2f}{rows:>7.1f}")
+
+if __name__ == "__main__":
+    main()
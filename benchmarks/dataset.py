@@ -0,0 +1,150 @@
+# ساخت دیتابیس مصنوعی برای بنچمارک‌ها: فروشنده‌ها، خریدارها، محصولات با متن فارسی،
+# تاریخچه، سبد خرید و «برای بعداً»
+
+import itertools
+import sys
+import time
+from datetime import datetime, timedelta
+
+NOUNS = [
+    "گوشی", "لپتاپ", "کتاب", "کفش", "کیف", "ساعت", "هدفون", "تبلت", "دوربین", "مانیتور",
+    "کیبورد", "ماوس", "پیراهن", "شلوار", "کاپشن", "عطر", "فرش", "مبل", "میز", "صندلی",
+]
+ADJECTIVES = [
+    "سامسونگ", "اپل", "شیائومی", "ایسوس", "لنوو", "سونی", "چرم", "نخی", "مشکی", "سفید",
+    "قرمز", "آبی", "اصل", "دست‌دوم", "نو", "ارزان", "حرفه‌ای", "کودک", "مردانه", "زنانه",
+]
+SYLLABLES = ["کا", "را", "مو", "نی", "سا", "تو", "لی", "با", "دو", "فر", "گل", "من", "شی", "زر", "پا", "ها"]
+
+def build_vocabulary(size, rng):
+    # کلمات واقعی پرتکرارترند؛ بقیه کلمات ساختگی با توزیع Zipf هستند
+    words = NOUNS + ADJECTIVES
+    seen = set(words)
+    while len(words) < size:
+        word = "".join(rng.choice(SYLLABLES) for _ in range(rng.randint(2, 4)))
+        if word not in seen:
+            seen.add(word)
+            words.append(word)
+    cum_weights = list(itertools.accumulate(1 / (rank + 1) for rank in range(len(words))))
+    return words, cum_weights
+
+def arabic_variant(text, rng):
+    # بخشی از متن‌ها با ي و ك عربی نوشته می‌شوند، مثل ورودی واقعی کاربران
+    if rng.random() < 0.1:
+        return text.replace("ی", "ي").replace("ک", "ك")
+    return text
+
+def generate_users(db, sellers, buyers):
+    # فروشنده‌ها id های 1..sellers و خریدارها بعد از آن‌ها
+    done = db.cursor().execute("SELECT COUNT(*) FROM users").fetchone()[0]
+    if done >= sellers + buyers:
+        return
+    with db.transaction() as cur:
+        cur.executemany(
+            "INSERT OR IGNORE INTO users (telegram_id, role, username, profile_photo, shop_name) \
+             VALUES (?, 'seller', ?, 'PROFILE', ?)",
+            ((i, f"seller{i}", f"فروشگاه {i}") for i in range(1, sellers + 1))
+        )
+        cur.executemany(
+            "INSERT OR IGNORE INTO users (telegram_id, role, username) VALUES (?, 'buyer', ?)",
+            ((i, f"buyer{i}") for i in range(sellers + 1, sellers + buyers + 1))
+        )
+
+def generate_products(db, count, vocabulary, cum_weights, rng, sellers=5000, chunk=10000):
+    done = db.cursor().execute("SELECT COUNT(*) FROM products").fetchone()[0]
+    start = time.perf_counter()
+    while done < count:
+        rows = []
+        for _ in range(min(chunk, count - done)):
+            title = " ".join(rng.choices(vocabulary, cum_weights=cum_weights, k=rng.randint(2, 5)))
+            desc = " ".join(rng.choices(vocabulary, cum_weights=cum_weights, k=rng.randint(10, 25)))
+            rows.append((
+                rng.randint(1, sellers),
+                arabic_variant(title, rng),
+                desc,
+                rng.randrange(10000, 100000000, 1000),
+                "PHOTO",
+            ))
+        with db.transaction() as cur:
+            # executemany هر سطر را یک statement جدا اجرا می‌کند و FTS5 بعد از هر کدام
+            # یک segment جدید می‌نویسد؛ INSERT ... SELECT از جدول موقت چند برابر سریع‌تر است
+            cur.execute("CREATE TEMP TABLE IF NOT EXISTS staging (seller_id, title, description, price, photo)")
+            cur.execute("DELETE FROM staging")
+            cur.executemany("INSERT INTO staging VALUES (?, ?, ?, ?, ?)", rows)
+            cur.execute(
+                "INSERT INTO products (seller_id, title, description, price, photo) \
+                 SELECT seller_id, title, description, price, photo FROM staging"
+            )
+        done += len(rows)
+        print(f"\r{done}/{count} products", end="", file=sys.stderr)
+    if done:
+        print(f"\rgenerated {done} products in {time.perf_counter() - start:.1f}s", file=sys.stderr)
+
+def _staged_insert(db, table, columns, rows, select):
+    # مثل محصولات: ردیف‌ها اول در جدول موقت و بعد با یک INSERT ... SELECT وارد جدول اصلی می‌شوند
+    staging = f"staging_{table}"
+    with db.transaction() as cur:
+        cur.execute(f"CREATE TEMP TABLE IF NOT EXISTS {staging} ({', '.join(columns)})")
+        cur.execute(f"DELETE FROM {staging}")
+        cur.executemany(
+            f"INSERT INTO {staging} VALUES ({', '.join('?' * len(columns))})", rows
+        )
+        cur.execute(select.format(staging=staging))
+
+def _fill(db, table, count, make_rows, columns, select, chunk):
+    done = db.cursor().execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0]
+    start = time.perf_counter()
+    generated = 0
+    while done < count:
+        rows = make_rows(min(chunk, count - done))
+        _staged_insert(db, table, columns, rows, select)
+        done += len(rows)
+        generated += len(rows)
+        print(f"\r{done}/{count} {table}", end="", file=sys.stderr)
+    if generated:
+        print(f"\rgenerated {generated} {table} in {time.perf_counter() - start:.1f}s", file=sys.stderr)
+
+def generate_history(db, count, buyers, products, rng, chunk=100000):
+    # buyers و products بازه‌ی id ها هستند؛ seller_id از خود محصول برداشته می‌شود.
+    # زمان‌ها با ترتیب id صعودی‌اند، مثل جدولی که فقط به انتهایش اضافه می‌شود.
+    base = datetime(2024, 1, 1)
+    clock = [db.cursor().execute("SELECT COUNT(*) FROM history").fetchone()[0]]
+
+    def rows(n):
+        out = []
+        for _ in range(n):
+            clock[0] += 1
+            out.append((
+                rng.choice(buyers),
+                rng.choice(products),
+                (base + timedelta(seconds=clock[0] * 3)).isoformat(),
+            ))
+        return out
+
+    _fill(
+        db, "history", count, rows, ("user_id", "product_id", "timestamp"),
+        "INSERT INTO history (user_id, product_id, seller_id, timestamp) \
+         SELECT s.user_id, s.product_id, p.seller_id, s.timestamp \
+         FROM {staging} s JOIN products p ON p.id = s.product_id",
+        chunk
+    )
+
+def generate_cart(db, count, buyers, products, rng, chunk=100000):
+    _fill(
+        db, "cart", count,
+        lambda n: [(rng.choice(buyers), rng.choice(products), rng.randint(1, 3)) for _ in range(n)],
+        ("user_id", "product_id", "quantity"),
+        "INSERT OR IGNORE INTO cart (user_id, product_id, quantity) \
+         SELECT user_id, product_id, quantity FROM {staging}",
+        chunk
+    )
+
+def generate_later(db, count, buyers, products, rng, chunk=100000):
+    _fill(
+        db, "later", count,
+        lambda n: [(rng.choice(buyers), rng.choice(products)) for _ in range(n)],
+        ("user_id", "product_id"),
+        "INSERT OR IGNORE INTO later (user_id, product_id) \
+         SELECT user_id, product_id FROM {staging}",
+        chunk
+    )
@@ -1,136 +1,191 @@
-import telebot
-from telebot import types
+import importlib.util
+import json
+import logging
+import sys
+import threading
 from datetime import datetime
-
-from database import db
-from config import TOKEN
-
-bot = telebot.TeleBot(TOKEN, parse_mode="Markdown")
+from string import Template
+
+from database import db, connect_db, ensure_schema, repair_counters
+from config import (
+    TOKEN, OUTBOX_GLOBAL_RATE, OUTBOX_CHAT_RATE, OUTBOX_CHAT_BURST, OUTBOX_WORKERS,
+    USER_CACHE_SIZE, USER_CACHE_TTL, RUN_MODE,
+    WEBHOOK_URL, WEBHOOK_HOST, WEBHOOK_PORT, WEBHOOK_PATH, WEBHOOK_SECRET,
+    WEBHOOK_WORKERS, WEBHOOK_QUEUE_SIZE, ASYNC_DB_WORKERS, ASYNC_SEND_CONCURRENCY,
+    STATE_TTL, INLINE_PAGE_SIZE, INLINE_CACHE_SIZE, INLINE_CACHE_TTL, INLINE_CACHE_TIME,
+    METRICS_HOST, METRICS_PORT,
+    COLLAGE_ENABLED, COLLAGE_CHAT, COLLAGE_TILE, COLLAGE_CACHE_SIZE, PHOTO_CACHE_DIR, PHOTO_CACHE_MB,
+    IMPORT_MAX_BYTES, IMPORT_MAX_ROWS, IMPORT_CHUNK, IMPORT_WORKERS, IMPORT_PROGRESS_INTERVAL,
+    EXPORT_BATCH, EXPORT_MAX_BYTES, EXPORT_WORKERS,
+    RETENTION_DAYS, RETENTION_INTERVAL, RETENTION_BATCH, HISTORY_ARCHIVE_DIR, VACUUM_PAGES
+)
+import collage
+import exporter
+import importer
+import retention
+from cache import TTLCache
+from outbox import Outbox, PRIORITY_BULK
+from router import Router, parse_callback
+from fsm import StateStore
+from metrics import metrics, MetricsServer
+from search import search_products, normalize, PAGE_SIZE as SEARCH_PAGE_SIZE, CANDIDATES as SEARCH_CANDIDATES
+
+def lazy_import(name):
+    # ماژول با اولین دسترسی به یکی از attributeهایش واقعاً import می‌شود؛
+    # telebot (و requests زیرش) بیشتر زمان import را می‌گیرد و هندلرها تا اجرا لازمش ندارند
+    if name in sys.modules:
+        return sys.modules[name]
+    spec = importlib.util.find_spec(name)
+    spec.loader = importlib.util.LazyLoader(spec.loader)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    spec.loader.exec_module(module)
+    return module
+
+telebot = lazy_import("telebot")
+
+logger = logging.getLogger(__name__)
+
+# import شدن این فایل فقط هندلرها را روی router ثبت می‌کند؛ TeleBot، صف ارسال و بررسی
+# schema در create_app ساخته می‌شوند (main برای اجرای ربات، بنچمارک‌ها و ابزارها مستقیم)
+bot = None
+
+# همه‌ی ارسال‌ها از این صف می‌گذرند تا هندلرها منتظر HTTP نمانند
+api = None
+
+# کولاژ صفحه‌های لیست؛ None = خاموش یا Pillow نصب نیست (آلبوم فرستاده می‌شود)
+collages = None
+
+# ورود گروهی محصولات روی threadهای جدا (در create_app ساخته می‌شود)
+importer_jobs = None
+
+# خروجی جدول‌ها برای ادمین، روی snapshot جدا و thread جدا
+exporter_jobs = None
+
+# جمع روزانه، آرشیو و حذف تاریخچه‌ی قدیمی؛ None = خاموش (RETENTION_DAYS = 0)
+history_retention = None
+
+# همه‌ی دکمه‌ها و callbackها از طریق router و با جستجوی O(1) مسیریابی می‌شوند
+router = Router()
+
+# مراحل گفتگو (ثبت محصول، پروفایل، امکانات ادمین) در دیتابیس نگه داشته می‌شوند
+states = StateStore(db, ttl=STATE_TTL)
+router.use_states(states)
 
 # ===================== HELPERS عمومی =====================
 
-def get_user_row(user_id):
+# نقش و ادمین بودن هر کاربر با یک کوئری خوانده و کش می‌شود؛
+# هر جا نقش یا ادمین‌ها عوض شوند باید identity_cache.invalidate صدا زده شود.
+identity_cache = TTLCache(USER_CACHE_SIZE, USER_CACHE_TTL)
+
+def load_identity(user_id):
     cur = db.cursor()
-    cur.execute("SELECT * FROM users WHERE telegram_id=?", (user_id,))
-    return cur.fetchone()
+    cur.execute(
+        "SELECT (SELECT role FROM users WHERE telegram_id=?), \
+                EXISTS(SELECT 1 FROM admins WHERE user_id=?)",
+        (user_id, user_id)
+    )
+    role, admin = cur.fetchone()
+    return role, bool(admin)
 
 def get_role(user_id):
-    row = get_user_row(user_id)
-    if row:
-        return row[1]
-    return None
+    return identity_cache.get_or_load(user_id, load_identity)[0]
 
 def upsert_user(user):
-    telegram_id = user.id
-    username = user.username or ""
-    existing = get_user_row(telegram_id)
-    cur = db.cursor()
-
-    if existing:
-        cur.execute(
-            "UPDATE users SET username=? WHERE telegram_id=?",
-            (username, telegram_id)
-        )
-    else:
-        cur.execute(
-            "INSERT INTO users (telegram_id, role, username) VALUES (?, ?, ?)",
-            (telegram_id, None, username)
-        )
-    db.commit()
+    # یک UPSERT صف‌شده؛ اگر یوزرنیم عوض نشده باشد اصلاً چیزی نوشته نمی‌شود
+    db.defer(
+        "INSERT INTO users (telegram_id, role, username) VALUES (?, NULL, ?) \
+         ON CONFLICT (telegram_id) DO UPDATE SET username = excluded.username \
+         WHERE username IS NOT excluded.username",
+        (user.id, user.username or "")
+    )
 
 def set_role(user_id, role):
-    row = get_user_row(user_id)
-    cur = db.cursor()
-    if row:
-        cur.execute(
-            "UPDATE users SET role=? WHERE telegram_id=?",
-            (role, user_id)
-        )
-    else:
+    # فوری commit می‌شود چون بلافاصله منوی نقش جدید خوانده می‌شود
+    with db.transaction() as cur:
         cur.execute(
-            "INSERT INTO users (telegram_id, role) VALUES (?, ?)",
+            "INSERT INTO users (telegram_id, role) VALUES (?, ?) \
+             ON CONFLICT (telegram_id) DO UPDATE SET role = excluded.role",
             (user_id, role)
         )
-    db.commit()
+    identity_cache.invalidate(user_id)
 
 def get_seller_profile(user_id):
+    # product_count را triggerها به‌روز نگه می‌دارند؛ پروفایل فقط یک جستجوی کلید اصلی است
     cur = db.cursor()
     cur.execute(
-        "SELECT username, profile_photo, shop_name, bio, phone FROM users WHERE telegram_id=?",
+        "SELECT username, profile_photo, shop_name, bio, phone, product_count FROM users WHERE telegram_id=?",
         (user_id,)
     )
     return cur.fetchone()
 
-def count_seller_products(user_id):
-    cur = db.cursor()
-    cur.execute("SELECT COUNT(*) FROM products WHERE seller_id=?", (user_id,))
-    row = cur.fetchone()
-    return row[0] if row else 0
-
 # ===================== HELPERS ادمین =====================
 
 def is_admin(user_id):
-    cur = db.cursor()
-    cur.execute("SELECT user_id FROM admins WHERE user_id=?", (user_id,))
-    return cur.fetchone() is not None
+    return identity_cache.get_or_load(user_id, load_identity)[1]
 
 def add_admin(user_id):
-    cur = db.cursor()
-    cur.execute("INSERT OR IGNORE INTO admins (user_id) VALUES (?)", (user_id,))
-    db.commit()
+    with db.transaction() as cur:
+        cur.execute("INSERT OR IGNORE INTO admins (user_id) VALUES (?)", (user_id,))
+    identity_cache.invalidate(user_id)
 
 def remove_admin(user_id):
-    cur = db.cursor()
-    cur.execute("DELETE FROM admins WHERE user_id=?", (user_id,))
-    db.commit()
+    with db.transaction() as cur:
+        cur.execute("DELETE FROM admins WHERE user_id=?", (user_id,))
+    identity_cache.invalidate(user_id)
 
 # ===================== KEYBOARDS =====================
 
-def seller_keyboard():
-    kb = types.ReplyKeyboardMarkup(resize_keyboard=True)
-    kb.add("👤 پروفایل من")
-    kb.add("➕ ثبت محصول", "📦 محصولات من")
-    kb.add("🛍 مشاهده همه محصولات")
-    return kb
-
-def buyer_keyboard():
-    kb = types.ReplyKeyboardMarkup(resize_keyboard=True)
-    kb.add("🛍 مشاهده همه محصولات")
-    kb.add("⭐ برای بعداً", "🛒 سبد خرید")
-    kb.add("📜 تاریخچه")
-    return kb
-
-def admin_keyboard_base():
-    kb = types.ReplyKeyboardMarkup(resize_keyboard=True)
-    kb.add("👥 مدیریت کاربران", "🛍 مدیریت محصولات")
-    kb.add("➕ افزودن ادمین", "❌ حذف ادمین")
-    kb.add("🚫 بن کاربر", "🔄 تغییر نقش کاربر")
-    kb.add("🗑 حذف محصول", "✏️ ویرایش محصول")
-    return kb
+def reply_keyboard(*rows):
+    # همان خروجی ReplyKeyboardMarkup(resize_keyboard=True).to_json()، بدون نیاز به telebot
+    return json.dumps({
+        "keyboard": [[{"text": text} for text in row] for row in rows],
+        "resize_keyboard": True,
+    })
+
+SELLER_ROWS = [
+    ["👤 پروفایل من", "📥 ورود گروهی"],
+    ["➕ ثبت محصول", "📦 محصولات من"],
+    ["🛍 مشاهده همه محصولات", "🔎 جستجو"],
+]
+
+BUYER_ROWS = [
+    ["🛍 مشاهده همه محصولات", "🔎 جستجو"],
+    ["⭐ برای بعداً", "🛒 سبد خرید"],
+    ["📜 تاریخچه"],
+]
+
+ADMIN_ROWS = [
+    ["👥 مدیریت کاربران", "🛍 مدیریت محصولات"],
+    ["➕ افزودن ادمین", "❌ حذف ادمین"],
+    ["🚫 بن کاربر", "🔄 تغییر نقش کاربر"],
+    ["🗑 حذف محصول", "✏️ ویرایش محصول"],
+]
+
+# فقط چهار منوی اصلی ممکن است (خریدار/فروشنده، با/بدون ادمین)؛
+# یک بار JSON می‌شوند و telebot رشته‌ی JSON را بدون تغییر می‌فرستد.
+# منوی ادمین‌ها = کیبورد نقش + امکانات ادمین
+MAIN_MENUS = {
+    (seller, admin): reply_keyboard(*(SELLER_ROWS if seller else BUYER_ROWS), *(ADMIN_ROWS if admin else []))
+    for seller in (False, True)
+    for admin in (False, True)
+}
 
 def merged_keyboard_for_user(user_id):
-    role = get_role(user_id)
-    if role == "seller":
-        base = seller_keyboard()
-    else:
-        base = buyer_keyboard()
-
-    if not is_admin(user_id):
-        return base
+    return MAIN_MENUS[(get_role(user_id) == "seller", is_admin(user_id))]
 
-    # ادغام کیبورد نقش + امکانات ادمین
-    admin_row1 = ["👥 مدیریت کاربران", "🛍 مدیریت محصولات"]
-    admin_row2 = ["➕ افزودن ادمین", "❌ حذف ادمین"]
-    admin_row3 = ["🚫 بن کاربر", "🔄 تغییر نقش کاربر"]
-    admin_row4 = ["🗑 حذف محصول", "✏️ ویرایش محصول"]
-
-    for row in [admin_row1, admin_row2, admin_row3, admin_row4]:
-        base.row(*row)
-    return base
+def inline_template(*rows):
+    # کیبورد inline با جای خالی $pid؛ فقط رشته جایگزین می‌شود و شیء جدیدی ساخته نمی‌شود
+    return Template(json.dumps({
+        "inline_keyboard": [
+            [{"text": text, "callback_data": data} for text, data in row]
+            for row in rows
+        ]
+    }))
 
 # ===================== START =====================
 
-@bot.message_handler(commands=['start'])
+@router.command("start")
 def start(message):
     user = message.from_user
     upsert_user(user)
@@ -144,27 +199,32 @@ def start(message):
     else:
         send_main_menu(message, role)
 
-@bot.message_handler(commands=['make_me_admin'])
+    # لینک «مشاهده در ربات» نتایج inline: /start p<id>
+    payload = message.text.split(maxsplit=1)[1:]
+    if payload and payload[0].startswith("p") and payload[0][1:].isdigit():
+        if not send_product_card(message.chat.id, int(payload[0][1:])):
+            api.send_message(message.chat.id, "محصول پیدا نشد.")
+
+@router.command("make_me_admin")
 def make_me_admin(message):
     add_admin(message.from_user.id)
-    bot.send_message(message.chat.id, "تو الان ادمین شدی ✔️", reply_markup=merged_keyboard_for_user(message.from_user.id))
+    api.send_message(message.chat.id, "تو الان ادمین شدی ✔️", reply_markup=merged_keyboard_for_user(message.from_user.id))
 
 # ===================== ROLE SELECT =====================
 
+ROLE_KEYBOARD = inline_template(
+    [("🛒 خریدار", "role:buyer"), ("🛍 فروشنده", "role:seller")]
+).template
+
 def ask_role(message):
-    kb = types.InlineKeyboardMarkup()
-    kb.add(
-        types.InlineKeyboardButton("🛒 خریدار", callback_data="role_buyer"),
-        types.InlineKeyboardButton("🛍 فروشنده", callback_data="role_seller")
-    )
-    bot.send_message(message.chat.id, "نقشت رو انتخاب کن:", reply_markup=kb)
+    api.send_message(message.chat.id, "نقشت رو انتخاب کن:", reply_markup=ROLE_KEYBOARD)
 
-@bot.callback_query_handler(func=lambda c: c.data.startswith("role_"))
+@router.callback("role")
 def set_user_role(call):
-    role = call.data.split("_")[1]
+    _, role = parse_callback(call.data)
     set_role(call.from_user.id, role)
 
-    bot.edit_message_text(
+    api.edit_message_text(
         "نقش با موفقیت ثبت شد ✔️",
         chat_id=call.message.chat.id,
         message_id=call.message.message_id
@@ -179,31 +239,33 @@ def set_user_role(call):
 def send_main_menu(message, role=None):
     user_id = message.from_user.id
     kb = merged_keyboard_for_user(user_id)
-    bot.send_message(message.chat.id, "منوی اصلی:", reply_markup=kb)
+    api.send_message(message.chat.id, "منوی اصلی:", reply_markup=kb)
 
 # ===================== PROFILE (SELLER ONLY) =====================
 
-@bot.message_handler(func=lambda m: m.text == "👤 پروفایل من")
+PROFILE_KEYBOARD = inline_template(
+    [("تغییر عکس پروفایل", "change_profile_photo"), ("ویرایش اطلاعات", "edit_profile_info")]
+).template
+
+@router.text("👤 پروفایل من")
 def show_profile(message):
     user_id = message.from_user.id
     role = get_role(user_id)
     if role != "seller":
-        bot.send_message(message.chat.id, "این بخش فقط برای فروشنده‌هاست.")
+        api.send_message(message.chat.id, "این بخش فقط برای فروشنده‌هاست.")
         return
 
     profile = get_seller_profile(user_id)
-    username, photo, shop_name, bio, phone = profile
+    username, photo, shop_name, bio, phone, count = profile
 
     if not photo:
-        msg = bot.send_message(
+        api.send_message(
             message.chat.id,
             "هنوز پروفایل نداری.\nاول یک عکس پروفایل بفرست:"
         )
-        bot.register_next_step_handler(msg, set_profile_photo_first_time)
+        states.set(message.chat.id, set_profile_photo_first_time)
         return
 
-    count = count_seller_products(user_id)
-
     caption_lines = []
     if shop_name:
         caption_lines.append(f"*{shop_name}*")
@@ -225,419 +287,772 @@ def show_profile(message):
 
     caption = "\n".join(caption_lines)
 
-    kb = types.InlineKeyboardMarkup()
-    kb.add(
-        types.InlineKeyboardButton("تغییر عکس پروفایل", callback_data="change_profile_photo"),
-        types.InlineKeyboardButton("ویرایش اطلاعات", callback_data="edit_profile_info")
-    )
-
-    bot.send_photo(
+    api.send_photo(
         message.chat.id,
         photo,
         caption=caption,
-        reply_markup=kb
+        reply_markup=PROFILE_KEYBOARD
     )
 
+@states.step
 def set_profile_photo_first_time(message):
     if not message.photo:
-        bot.send_message(message.chat.id, "لطفاً یک عکس بفرست.")
-        msg = bot.send_message(message.chat.id, "دوباره تلاش کن، عکس پروفایل را بفرست:")
-        bot.register_next_step_handler(msg, set_profile_photo_first_time)
+        api.send_message(message.chat.id, "لطفاً یک عکس بفرست.")
+        api.send_message(message.chat.id, "دوباره تلاش کن، عکس پروفایل را بفرست:")
+        states.set(message.chat.id, set_profile_photo_first_time)
         return
 
     file_id = message.photo[-1].file_id
     user_id = message.from_user.id
 
-    cur = db.cursor()
-    cur.execute(
-        "UPDATE users SET profile_photo=? WHERE telegram_id=?",
-        (file_id, user_id)
-    )
-    db.commit()
+    with db.transaction() as cur:
+        cur.execute(
+            "UPDATE users SET profile_photo=? WHERE telegram_id=?",
+            (file_id, user_id)
+        )
 
-    msg = bot.send_message(message.chat.id, "نام فروشگاه را وارد کن (یا بنویس رد):")
-    bot.register_next_step_handler(msg, set_profile_shop_name)
+    api.send_message(message.chat.id, "نام فروشگاه را وارد کن (یا بنویس رد):")
+    states.set(message.chat.id, set_profile_shop_name)
 
+@states.step
 def set_profile_shop_name(message):
     user_id = message.from_user.id
-    text = message.text.strip()
+    text = (message.text or "").strip()
 
-    cur = db.cursor()
     if text.lower() != "رد":
-        cur.execute(
-            "UPDATE users SET shop_name=? WHERE telegram_id=?",
-            (text, user_id)
-        )
-        db.commit()
+        with db.transaction() as cur:
+            cur.execute(
+                "UPDATE users SET shop_name=? WHERE telegram_id=?",
+                (text, user_id)
+            )
 
-    msg = bot.send_message(message.chat.id, "بیو (توضیحات پروفایل) را وارد کن (یا بنویس رد):")
-    bot.register_next_step_handler(msg, set_profile_bio)
+    api.send_message(message.chat.id, "بیو (توضیحات پروفایل) را وارد کن (یا بنویس رد):")
+    states.set(message.chat.id, set_profile_bio)
 
+@states.step
 def set_profile_bio(message):
     user_id = message.from_user.id
-    text = message.text.strip()
+    text = (message.text or "").strip()
 
-    cur = db.cursor()
     if text.lower() != "رد":
-        cur.execute(
-            "UPDATE users SET bio=? WHERE telegram_id=?",
-            (text, user_id)
-        )
-        db.commit()
+        with db.transaction() as cur:
+            cur.execute(
+                "UPDATE users SET bio=? WHERE telegram_id=?",
+                (text, user_id)
+            )
 
-    msg = bot.send_message(message.chat.id, "شماره تماس را وارد کن (یا بنویس رد):")
-    bot.register_next_step_handler(msg, set_profile_phone)
+    api.send_message(message.chat.id, "شماره تماس را وارد کن (یا بنویس رد):")
+    states.set(message.chat.id, set_profile_phone)
 
+@states.step
 def set_profile_phone(message):
     user_id = message.from_user.id
-    text = message.text.strip()
+    text = (message.text or "").strip()
 
-    cur = db.cursor()
     if text.lower() != "رد":
-        cur.execute(
-            "UPDATE users SET phone=? WHERE telegram_id=?",
-            (text, user_id)
-        )
-        db.commit()
+        with db.transaction() as cur:
+            cur.execute(
+                "UPDATE users SET phone=? WHERE telegram_id=?",
+                (text, user_id)
+            )
 
-    bot.send_message(message.chat.id, "پروفایل با موفقیت ساخته شد ✔️")
+    api.send_message(message.chat.id, "پروفایل با موفقیت ساخته شد ✔️")
     show_profile(message)
 
-@bot.callback_query_handler(func=lambda c: c.data == "change_profile_photo")
+@router.callback("change_profile_photo")
 def change_profile_photo(call):
-    msg = bot.send_message(call.message.chat.id, "عکس جدید پروفایل را بفرست:")
-    bot.register_next_step_handler(msg, set_new_profile_photo)
+    api.send_message(call.message.chat.id, "عکس جدید پروفایل را بفرست:")
+    states.set(call.message.chat.id, set_new_profile_photo)
 
+@states.step
 def set_new_profile_photo(message):
     if not message.photo:
-        bot.send_message(message.chat.id, "لطفاً یک عکس بفرست.")
-        msg = bot.send_message(message.chat.id, "دوباره تلاش کن، عکس پروفایل را بفرست:")
-        bot.register_next_step_handler(msg, set_new_profile_photo)
+        api.send_message(message.chat.id, "لطفاً یک عکس بفرست.")
+        api.send_message(message.chat.id, "دوباره تلاش کن، عکس پروفایل را بفرست:")
+        states.set(message.chat.id, set_new_profile_photo)
         return
 
     file_id = message.photo[-1].file_id
     user_id = message.from_user.id
 
-    cur = db.cursor()
-    cur.execute(
-        "UPDATE users SET profile_photo=? WHERE telegram_id=?",
-        (file_id, user_id)
-    )
-    db.commit()
+    with db.transaction() as cur:
+        cur.execute(
+            "UPDATE users SET profile_photo=? WHERE telegram_id=?",
+            (file_id, user_id)
+        )
 
-    bot.send_message(message.chat.id, "عکس پروفایل با موفقیت تغییر کرد ✔️")
+    api.send_message(message.chat.id, "عکس پروفایل با موفقیت تغییر کرد ✔️")
     show_profile(message)
 
-@bot.callback_query_handler(func=lambda c: c.data == "edit_profile_info")
+@router.callback("edit_profile_info")
 def edit_profile_info(call):
-    msg = bot.send_message(call.message.chat.id, "نام جدید فروشگاه را وارد کن (یا بنویس رد):")
-    bot.register_next_step_handler(msg, edit_profile_shop_name)
+    api.send_message(call.message.chat.id, "نام جدید فروشگاه را وارد کن (یا بنویس رد):")
+    states.set(call.message.chat.id, edit_profile_shop_name)
 
+@states.step
 def edit_profile_shop_name(message):
     user_id = message.from_user.id
-    text = message.text.strip()
+    text = (message.text or "").strip()
 
-    cur = db.cursor()
     if text.lower() != "رد":
-        cur.execute(
-            "UPDATE users SET shop_name=? WHERE telegram_id=?",
-            (text, user_id)
-        )
-        db.commit()
+        with db.transaction() as cur:
+            cur.execute(
+                "UPDATE users SET shop_name=? WHERE telegram_id=?",
+                (text, user_id)
+            )
 
-    msg = bot.send_message(message.chat.id, "بیو جدید را وارد کن (یا بنویس رد):")
-    bot.register_next_step_handler(msg, edit_profile_bio)
+    api.send_message(message.chat.id, "بیو جدید را وارد کن (یا بنویس رد):")
+    states.set(message.chat.id, edit_profile_bio)
 
+@states.step
 def edit_profile_bio(message):
     user_id = message.from_user.id
-    text = message.text.strip()
+    text = (message.text or "").strip()
 
-    cur = db.cursor()
     if text.lower() != "رد":
-        cur.execute(
-            "UPDATE users SET bio=? WHERE telegram_id=?",
-            (text, user_id)
-        )
-        db.commit()
+        with db.transaction() as cur:
+            cur.execute(
+                "UPDATE users SET bio=? WHERE telegram_id=?",
+                (text, user_id)
+            )
 
-    msg = bot.send_message(message.chat.id, "شماره تماس جدید را وارد کن (یا بنویس رد):")
-    bot.register_next_step_handler(msg, edit_profile_phone)
+    api.send_message(message.chat.id, "شماره تماس جدید را وارد کن (یا بنویس رد):")
+    states.set(message.chat.id, edit_profile_phone)
 
+@states.step
 def edit_profile_phone(message):
     user_id = message.from_user.id
-    text = message.text.strip()
+    text = (message.text or "").strip()
 
-    cur = db.cursor()
     if text.lower() != "رد":
-        cur.execute(
-            "UPDATE users SET phone=? WHERE telegram_id=?",
-            (text, user_id)
-        )
-        db.commit()
+        with db.transaction() as cur:
+            cur.execute(
+                "UPDATE users SET phone=? WHERE telegram_id=?",
+                (text, user_id)
+            )
 
-    bot.send_message(message.chat.id, "اطلاعات پروفایل با موفقیت به‌روزرسانی شد ✔️")
+    api.send_message(message.chat.id, "اطلاعات پروفایل با موفقیت به‌روزرسانی شد ✔️")
     show_profile(message)
 
+# ===================== LISTINGS (آلبوم) =====================
+
+ALBUM_SIZE = 10   # سقف تلگرام برای هر media group
+INDEX_SIZE = 30   # هر پیام فهرست حداکثر ۱۰۰ دکمه دارد
+INDEX_TITLE = 64  # طول عنوان محصول در خط‌های پیام فهرست
+MESSAGE_LIMIT = 4096  # سقف متن پیام تلگرام (واحدهای UTF-16)
+
+def short_title(title):
+    return title if len(title) <= INDEX_TITLE else title[:INDEX_TITLE - 1] + "…"
+
+def _units(text):
+    # تلگرام طول را با UTF-16 می‌شمارد؛ ایموجی‌هایی مثل 👤 دو واحدند
+    return len(text.encode("utf-16-le")) // 2
+
+def fit_index(header, body, footer):
+    # متن پیام فهرست زیر MESSAGE_LIMIT: از footer اول جمع فروشنده‌ها (جز خط آخر، جمع کل)
+    # تا نصف سقف کنار می‌روند و بعد خط‌های آخر body؛ به جای هر بخش حذف‌شده «…» می‌آید
+    footer_lines = footer.split("\n") if footer else []
+    dropped = False
+    while len(footer_lines) > 1 and _units("\n".join(footer_lines)) > MESSAGE_LIMIT // 2:
+        footer_lines.pop(0)
+        dropped = True
+    footer = "\n".join((["…"] if dropped else []) + footer_lines)
+
+    parts = [header, body, footer]
+    room = MESSAGE_LIMIT - _units("\n\n".join(part for part in parts if part))
+    if room < 0:
+        body_lines = body.split("\n")
+        while body_lines and _units("\n".join(body_lines + ["…"])) > _units(body) + room:
+            body_lines.pop()
+        parts[1] = "\n".join(body_lines + ["…"])
+    return "\n\n".join(part for part in parts if part)
+
+def album_index(items, start, header, footer=None, lines=None):
+    # پیام فهرستِ آیتم‌های start تا start + INDEX_SIZE؛ footer فقط در آخرین پیام می‌آید
+    # و lines (اگر باشد) برای هر آیتم یک خط توضیح در متن پیام است
+    kb = telebot.types.InlineKeyboardMarkup()
+    for n, (_, _, buttons) in enumerate(items[start:start + INDEX_SIZE], start + 1):
+        kb.row(*[
+            telebot.types.InlineKeyboardButton(f"{n} {text}", callback_data=data)
+            for text, data in buttons
+        ])
+    body = "\n".join(lines[start:start + INDEX_SIZE]) if lines else ""
+    if not (footer and start + INDEX_SIZE >= len(items)):
+        footer = None
+    return fit_index(header, body, footer), kb
+
+def send_product_album(chat_id, items, header, footer=None, lines=None):
+    # items: لیست (photo, caption, buttons) — عکس‌ها آلبومی فرستاده می‌شوند
+    # و دکمه‌های هر آیتم با شماره‌اش در یک پیام فهرست جمع می‌شوند
+    for start in range(0, len(items), ALBUM_SIZE):
+        chunk = items[start:start + ALBUM_SIZE]
+        if len(chunk) == 1:
+            photo, caption, _ = chunk[0]
+            api.send_photo(chat_id, photo, caption=f"{start + 1}. {caption}", priority=PRIORITY_BULK)
+            continue
+        if collages is not None and send_collage(chat_id, chunk, start):
+            continue
+        media = [
+            telebot.types.InputMediaPhoto(photo, caption=f"{start + i + 1}. {caption}")
+            for i, (photo, caption, _) in enumerate(chunk)
+        ]
+        api.send_media_group(chat_id, media, priority=PRIORITY_BULK)
+
+    for start in range(0, len(items), INDEX_SIZE):
+        text, kb = album_index(items, start, header, footer, lines)
+        api.send_message(chat_id, text, reply_markup=kb, priority=PRIORITY_BULK)
+
+def send_collage(chat_id, chunk, start):
+    # یک عکس شبکه‌ای با شماره‌ها به جای آلبوم، اگر قبلاً ساخته و آپلود شده باشد؛
+    # وگرنه ساختنش در پس‌زمینه شروع می‌شود و این بار آلبوم فرستاده می‌شود (خروجی False)
+    photos = [photo for photo, _, _ in chunk]
+    key = collages.key(start + 1, photos)
+    file_id = collages.lookup(key)
+    if not file_id:
+        collages.prepare(key, start + 1, photos)
+        return False
+
+    # عنوان هر آیتم (خط اول caption) در caption کولاژ؛ جزئیات در پیام فهرست است
+    titles = [text.split("\n", 1)[0] for _, text, _ in chunk]
+    caption = "\n".join(f"{n}. {title}" for n, title in enumerate(titles, start + 1))[:1024]
+    api.send_photo(chat_id, file_id, caption=caption, priority=PRIORITY_BULK)
+    return True
+
 # ===================== SELLER: ADD PRODUCT =====================
 
-@bot.message_handler(func=lambda m: m.text == "➕ ثبت محصول")
+@router.text("➕ ثبت محصول")
 def add_product(message):
     role = get_role(message.from_user.id)
     if role != "seller":
-        bot.send_message(message.chat.id, "این بخش فقط برای فروشنده‌هاست.")
+        api.send_message(message.chat.id, "این بخش فقط برای فروشنده‌هاست.")
         return
 
-    msg = bot.send_message(message.chat.id, "عنوان محصول:")
-    bot.register_next_step_handler(msg, get_product_title)
+    api.send_message(message.chat.id, "عنوان محصول:")
+    states.set(message.chat.id, get_product_title)
 
+@states.step
 def get_product_title(message):
-    title = message.text.strip()
+    title = (message.text or "").strip()
     if not title:
-        msg = bot.send_message(message.chat.id, "عنوان نامعتبر است، دوباره وارد کن:")
-        bot.register_next_step_handler(msg, get_product_title)
+        api.send_message(message.chat.id, "عنوان نامعتبر است، دوباره وارد کن:")
+        states.set(message.chat.id, get_product_title)
         return
 
-    msg = bot.send_message(message.chat.id, "توضیحات محصول:")
-    bot.register_next_step_handler(msg, get_product_description, title)
+    api.send_message(message.chat.id, "توضیحات محصول:")
+    states.set(message.chat.id, get_product_description, title=title)
 
+@states.step
 def get_product_description(message, title):
-    desc = message.text.strip()
-    msg = bot.send_message(message.chat.id, "قیمت محصول (عدد):")
-    bot.register_next_step_handler(msg, get_product_price, title, desc)
+    desc = (message.text or "").strip()
+    api.send_message(message.chat.id, "قیمت محصول (عدد):")
+    states.set(message.chat.id, get_product_price, title=title, desc=desc)
 
+@states.step
 def get_product_price(message, title, desc):
     try:
         price = int(message.text.strip())
     except:
-        msg = bot.send_message(message.chat.id, "قیمت نامعتبر است، یک عدد بفرست:")
-        bot.register_next_step_handler(msg, get_product_price, title, desc)
+        metrics.swallowed()
+        api.send_message(message.chat.id, "قیمت نامعتبر است، یک عدد بفرست:")
+        states.set(message.chat.id, get_product_price, title=title, desc=desc)
         return
 
-    msg = bot.send_message(message.chat.id, "عکس محصول را بفرست:")
-    bot.register_next_step_handler(msg, get_product_photo, title, desc, price)
+    api.send_message(message.chat.id, "عکس محصول را بفرست:")
+    states.set(message.chat.id, get_product_photo, title=title, desc=desc, price=price)
 
+@states.step
 def get_product_photo(message, title, desc, price):
     if not message.photo:
-        msg = bot.send_message(message.chat.id, "لطفاً یک عکس بفرست:")
-        bot.register_next_step_handler(msg, get_product_photo, title, desc, price)
+        api.send_message(message.chat.id, "لطفاً یک عکس بفرست:")
+        states.set(message.chat.id, get_product_photo, title=title, desc=desc, price=price)
         return
 
     file_id = message.photo[-1].file_id
     seller_id = message.from_user.id
 
-    cur = db.cursor()
-    cur.execute(
-        "INSERT INTO products (seller_id, title, description, price, photo) VALUES (?, ?, ?, ?, ?)",
-        (seller_id, title, desc, price, file_id)
-    )
-    db.commit()
+    with db.transaction() as cur:
+        cur.execute(
+            "INSERT INTO products (seller_id, title, description, price, photo) VALUES (?, ?, ?, ?, ?)",
+            (seller_id, title, desc, price, file_id)
+        )
+
+    api.send_message(message.chat.id, "محصول با موفقیت ثبت شد ✔️")
+
+# ===================== SELLER/ADMIN: BULK IMPORT =====================
+
+IMPORT_HELP = (
+    "یک فایل CSV (با سرستون) یا JSONL (هر خط یک شیء JSON) بفرست با ستون‌های:\n"
+    "`title`، `description`، `price` و `photo` (file_id عکسی که قبلاً در تلگرام فرستاده شده؛ نه آدرس اینترنتی)\n"
+    f"حداکثر {IMPORT_MAX_ROWS} محصول و {IMPORT_MAX_BYTES // (1024 * 1024)} مگابایت، با encoding UTF-8."
+)
+
+@router.text("📥 ورود گروهی")
+@router.command("import")
+def ask_import(message):
+    user_id = message.from_user.id
+    seller = get_role(user_id) == "seller"
+    admin = is_admin(user_id)
+    if not (seller or admin):
+        api.send_message(message.chat.id, "این بخش فقط برای فروشنده‌هاست.")
+        return
+
+    text = IMPORT_HELP
+    if admin:
+        text += "\nادمین: با ستون `seller_id` می‌توانی برای هر فروشنده‌ای محصول ثبت کنی."
+    api.send_message(message.chat.id, text)
+    states.set(message.chat.id, import_document, admin=admin, seller=seller)
+
+@states.step
+def import_document(message, admin, seller):
+    doc = message.document
+    if doc is None:
+        if message.text:
+            # هر پیام متنی (مثلاً دکمه‌ی منو) ورود را لغو می‌کند
+            api.send_message(message.chat.id, "ورود گروهی لغو شد.")
+            return
+        api.send_message(message.chat.id, "فایل را به صورت document بفرست:")
+        states.set(message.chat.id, import_document, admin=admin, seller=seller)
+        return
+
+    fmt = importer.detect_format(doc.file_name, doc.mime_type)
+    if fmt is None:
+        api.send_message(message.chat.id, "فقط فایل .csv یا .jsonl پذیرفته می‌شود، دوباره بفرست:")
+        states.set(message.chat.id, import_document, admin=admin, seller=seller)
+        return
+    if doc.file_size and doc.file_size > IMPORT_MAX_BYTES:
+        api.send_message(message.chat.id, "فایل خیلی بزرگ است؛ آن را به چند فایل تقسیم کن.")
+        return
 
-    bot.send_message(message.chat.id, "محصول با موفقیت ثبت شد ✔️")
+    started = importer_jobs.start(
+        message.chat.id, message.from_user.id, doc.file_id, doc.file_name or "file",
+        doc.file_size, fmt, admin=admin, seller=seller
+    )
+    if not started:
+        api.send_message(message.chat.id, "یک ورود گروهی دیگر هنوز در حال انجام است.")
 
 # ===================== SELLER: MY PRODUCTS =====================
 
-@bot.message_handler(func=lambda m: m.text == "📦 محصولات من")
+@router.text("📦 محصولات من")
 def my_products(message):
     user_id = message.from_user.id
     role = get_role(user_id)
     if role != "seller":
-        bot.send_message(message.chat.id, "این بخش فقط برای فروشنده‌هاست.")
+        api.send_message(message.chat.id, "این بخش فقط برای فروشنده‌هاست.")
         return
 
     cur = db.cursor()
     cur.execute(
-        "SELECT id, title, description, price, photo FROM products WHERE seller_id=?",
+        "SELECT id, title, description, price, photo, contact_count, cart_count \
+         FROM products WHERE seller_id=?",
         (user_id,)
     )
     products = cur.fetchall()
 
     if not products:
-        bot.send_message(message.chat.id, "هنوز هیچ محصولی ثبت نکردی.")
+        api.send_message(message.chat.id, "هنوز هیچ محصولی ثبت نکردی.")
         return
 
-    for pid, title, desc, price, photo in products:
-        caption = f"*{title}*\n{desc}\n💰 قیمت: {price} تومان\n🆔 محصول: {pid}"
-
-        kb = types.InlineKeyboardMarkup()
-        kb.add(
-            types.InlineKeyboardButton("✏️ ویرایش", callback_data=f"edit_{pid}"),
-            types.InlineKeyboardButton("❌ حذف", callback_data=f"delete_{pid}")
+    items = []
+    lines = []
+    for n, (pid, title, desc, price, photo, contacts, carts) in enumerate(products, 1):
+        caption = (
+            f"*{title}*\n{desc}\n💰 قیمت: {price} تومان\n🆔 محصول: {pid}\n"
+            f"📩 پیام‌ها: {contacts} | 🛒 در سبدها: {carts}"
         )
+        buttons = [("✏️ ویرایش", f"edit:{pid}"), ("❌ حذف", f"delete:{pid}")]
+        items.append((photo, caption, buttons))
+        # کولاژ فقط عنوان‌ها را دارد؛ قیمت، شناسه و شمارنده‌ها در پیام فهرست می‌آیند
+        lines.append(f"{n}. {short_title(title)} — {price} تومان | 🆔 {pid} | 📩 {contacts} | 🛒 {carts}")
 
-        bot.send_photo(message.chat.id, photo, caption=caption, reply_markup=kb)
+    send_product_album(message.chat.id, items, "📦 محصولات من — دکمه‌ها به ترتیب شماره عکس‌ها:", lines=lines)
 
 # ===================== DELETE PRODUCT (seller/admin) =====================
 
-@bot.callback_query_handler(func=lambda c: c.data.startswith("delete_"))
+@router.callback("delete")
 def delete_product(call):
-    pid = call.data.split("_")[1]
+    _, pid = parse_callback(call.data)
 
-    cur = db.cursor()
-    cur.execute("DELETE FROM products WHERE id=?", (pid,))
-    db.commit()
+    with db.transaction() as cur:
+        cur.execute("DELETE FROM products WHERE id=?", (pid,))
 
-    bot.answer_callback_query(call.id, "محصول حذف شد ✔️")
-    try:
-        bot.edit_message_caption(
+    api.answer_callback_query(call.id, "محصول حذف شد ✔️")
+    if call.message.photo:
+        api.edit_message_caption(
             chat_id=call.message.chat.id,
             message_id=call.message.message_id,
             caption="❌ این محصول حذف شد."
         )
-    except:
-        pass
 
 # ===================== EDIT PRODUCT MENU =====================
 
-@bot.callback_query_handler(func=lambda c: c.data.startswith("edit_") and not any(
-    c.data.startswith(x) for x in ["edit_title_", "edit_desc_", "edit_price_", "edit_photo_"]
-))
-def edit_product_menu(call):
-    pid = call.data.split("_")[1]
+EDIT_PRODUCT_KEYBOARD = inline_template(
+    [("✏️ تغییر عنوان", "edit_title:$pid"), ("📝 تغییر توضیحات", "edit_desc:$pid")],
+    [("💰 تغییر قیمت", "edit_price:$pid"), ("🖼 تغییر عکس", "edit_photo:$pid")]
+)
 
-    kb = types.InlineKeyboardMarkup()
-    kb.add(
-        types.InlineKeyboardButton("✏️ تغییر عنوان", callback_data=f"edit_title_{pid}"),
-        types.InlineKeyboardButton("📝 تغییر توضیحات", callback_data=f"edit_desc_{pid}")
-    )
-    kb.add(
-        types.InlineKeyboardButton("💰 تغییر قیمت", callback_data=f"edit_price_{pid}"),
-        types.InlineKeyboardButton("🖼 تغییر عکس", callback_data=f"edit_photo_{pid}")
-    )
+@router.callback("edit")
+def edit_product_menu(call):
+    _, pid = parse_callback(call.data)
 
-    bot.send_message(call.message.chat.id, "چه چیزی را می‌خوای ویرایش کنی:", reply_markup=kb)
+    kb = EDIT_PRODUCT_KEYBOARD.substitute(pid=pid)
+    api.send_message(call.message.chat.id, "چه چیزی را می‌خوای ویرایش کنی:", reply_markup=kb)
 
 # ===================== EDIT TITLE =====================
 
-@bot.callback_query_handler(func=lambda c: c.data.startswith("edit_title_"))
+@router.callback("edit_title")
 def edit_title(call):
-    pid = call.data.split("_")[2]
-    msg = bot.send_message(call.message.chat.id, "عنوان جدید را وارد کن:")
-    bot.register_next_step_handler(msg, save_new_title, pid)
+    _, pid = parse_callback(call.data)
+    api.send_message(call.message.chat.id, "عنوان جدید را وارد کن:")
+    states.set(call.message.chat.id, save_new_title, pid=pid)
 
+@states.step
 def save_new_title(message, pid):
-    new_title = message.text.strip()
-    cur = db.cursor()
-    cur.execute("UPDATE products SET title=? WHERE id=?", (new_title, pid))
-    db.commit()
-    bot.send_message(message.chat.id, "عنوان با موفقیت تغییر کرد ✔️")
+    new_title = (message.text or "").strip()
+    with db.transaction() as cur:
+        cur.execute("UPDATE products SET title=? WHERE id=?", (new_title, pid))
+    api.send_message(message.chat.id, "عنوان با موفقیت تغییر کرد ✔️")
 
 # ===================== EDIT DESCRIPTION =====================
 
-@bot.callback_query_handler(func=lambda c: c.data.startswith("edit_desc_"))
+@router.callback("edit_desc")
 def edit_desc(call):
-    pid = call.data.split("_")[2]
-    msg = bot.send_message(call.message.chat.id, "توضیحات جدید را وارد کن:")
-    bot.register_next_step_handler(msg, save_new_desc, pid)
+    _, pid = parse_callback(call.data)
+    api.send_message(call.message.chat.id, "توضیحات جدید را وارد کن:")
+    states.set(call.message.chat.id, save_new_desc, pid=pid)
 
+@states.step
 def save_new_desc(message, pid):
-    new_desc = message.text.strip()
-    cur = db.cursor()
-    cur.execute("UPDATE products SET description=? WHERE id=?", (new_desc, pid))
-    db.commit()
-    bot.send_message(message.chat.id, "توضیحات با موفقیت تغییر کرد ✔️")
+    new_desc = (message.text or "").strip()
+    with db.transaction() as cur:
+        cur.execute("UPDATE products SET description=? WHERE id=?", (new_desc, pid))
+    api.send_message(message.chat.id, "توضیحات با موفقیت تغییر کرد ✔️")
 
 # ===================== EDIT PRICE =====================
 
-@bot.callback_query_handler(func=lambda c: c.data.startswith("edit_price_"))
+@router.callback("edit_price")
 def edit_price(call):
-    pid = call.data.split("_")[2]
-    msg = bot.send_message(call.message.chat.id, "قیمت جدید را وارد کن:")
-    bot.register_next_step_handler(msg, save_new_price, pid)
+    _, pid = parse_callback(call.data)
+    api.send_message(call.message.chat.id, "قیمت جدید را وارد کن:")
+    states.set(call.message.chat.id, save_new_price, pid=pid)
 
+@states.step
 def save_new_price(message, pid):
     try:
         new_price = int(message.text.strip())
     except:
-        bot.send_message(message.chat.id, "قیمت نامعتبر است.")
+        metrics.swallowed()
+        api.send_message(message.chat.id, "قیمت نامعتبر است.")
         return
 
-    cur = db.cursor()
-    cur.execute("UPDATE products SET price=? WHERE id=?", (new_price, pid))
-    db.commit()
-    bot.send_message(message.chat.id, "قیمت با موفقیت تغییر کرد ✔️")
+    with db.transaction() as cur:
+        cur.execute("UPDATE products SET price=? WHERE id=?", (new_price, pid))
+    api.send_message(message.chat.id, "قیمت با موفقیت تغییر کرد ✔️")
 
 # ===================== EDIT PHOTO =====================
 
-@bot.callback_query_handler(func=lambda c: c.data.startswith("edit_photo_"))
+@router.callback("edit_photo")
 def edit_photo(call):
-    pid = call.data.split("_")[2]
-    msg = bot.send_message(call.message.chat.id, "عکس جدید محصول را بفرست:")
-    bot.register_next_step_handler(msg, save_new_photo, pid)
+    _, pid = parse_callback(call.data)
+    api.send_message(call.message.chat.id, "عکس جدید محصول را بفرست:")
+    states.set(call.message.chat.id, save_new_photo, pid=pid)
 
+@states.step
 def save_new_photo(message, pid):
     if not message.photo:
-        bot.send_message(message.chat.id, "لطفاً یک عکس بفرست.")
+        api.send_message(message.chat.id, "لطفاً یک عکس بفرست.")
         return
 
     new_photo = message.photo[-1].file_id
-    cur = db.cursor()
-    cur.execute("UPDATE products SET photo=? WHERE id=?", (new_photo, pid))
-    db.commit()
+    with db.transaction() as cur:
+        cur.execute("UPDATE products SET photo=? WHERE id=?", (new_photo, pid))
 
-    bot.send_message(message.chat.id, "عکس محصول با موفقیت تغییر کرد ✔️")
+    api.send_message(message.chat.id, "عکس محصول با موفقیت تغییر کرد ✔️")
 
 # ===================== BUYER: SHOW ALL PRODUCTS =====================
 
-@bot.message_handler(func=lambda m: m.text in ["🛍 مشاهده محصولات", "🛍 مشاهده همه محصولات"])
-def show_all_products(message):
+def fetch_catalog_product(after_id=0, before_id=None):
+    # صفحه‌بندی keyset روی products.id: هر بار فقط یک سطر خوانده می‌شود
     cur = db.cursor()
-    cur.execute(
-        "SELECT p.id, p.title, p.description, p.price, p.photo, p.seller_id, u.username \
-         FROM products p LEFT JOIN users u ON p.seller_id = u.telegram_id"
+    if before_id is not None:
+        cur.execute(
+            "SELECT p.id, p.title, p.description, p.price, p.photo, p.seller_id, u.username \
+             FROM products p LEFT JOIN users u ON p.seller_id = u.telegram_id \
+             WHERE p.id < ? ORDER BY p.id DESC LIMIT 1",
+            (before_id,)
+        )
+    else:
+        cur.execute(
+            "SELECT p.id, p.title, p.description, p.price, p.photo, p.seller_id, u.username \
+             FROM products p LEFT JOIN users u ON p.seller_id = u.telegram_id \
+             WHERE p.id > ? ORDER BY p.id LIMIT 1",
+            (after_id,)
+        )
+    return cur.fetchone()
+
+def catalog_caption(title, desc, price, username):
+    seller_line = ""
+    if username:
+        seller_line = f"\n👤 فروشنده: @{username}"
+    return f"*{title}*\n{desc}\n💰 قیمت: {price} تومان{seller_line}"
+
+CATALOG_KEYBOARD = inline_template(
+    [("⭐ برای بعداً", "later_add:$pid"), ("🛒 افزودن به سبد", "cart_add:$pid")],
+    [("⬅️ قبلی", "browse_prev:$pid"), ("بعدی ➡️", "browse_next:$pid")]
+)
+
+def catalog_keyboard(pid):
+    return CATALOG_KEYBOARD.substitute(pid=pid)
+
+@router.text("🛍 مشاهده محصولات", "🛍 مشاهده همه محصولات")
+def show_all_products(message):
+    row = fetch_catalog_product()
+    if not row:
+        api.send_message(message.chat.id, "هیچ محصولی ثبت نشده.")
+        return
+
+    pid, title, desc, price, photo, seller_id, username = row
+    api.send_photo(
+        message.chat.id,
+        photo,
+        caption=catalog_caption(title, desc, price, username),
+        reply_markup=catalog_keyboard(pid)
     )
-    products = cur.fetchall()
 
-    if not products:
-        bot.send_message(message.chat.id, "هیچ محصولی ثبت نشده.")
+@router.callback("browse_prev", "browse_next")
+def browse_products(call):
+    action, pid = parse_callback(call.data)
+    if action == "browse_next":
+        row = fetch_catalog_product(after_id=int(pid))
+    else:
+        row = fetch_catalog_product(before_id=int(pid))
+
+    if not row:
+        api.answer_callback_query(call.id, "به انتهای لیست رسیدی.")
         return
 
-    for pid, title, desc, price, photo, seller_id, username in products:
-        seller_line = ""
-        if username:
-            seller_line = f"\n👤 فروشنده: @{username}"
-        caption = f"*{title}*\n{desc}\n💰 قیمت: {price} تومان{seller_line}"
+    pid, title, desc, price, photo, seller_id, username = row
+    media = telebot.types.InputMediaPhoto(
+        photo,
+        caption=catalog_caption(title, desc, price, username),
+        parse_mode="Markdown"
+    )
+    api.edit_message_media(
+        media,
+        chat_id=call.message.chat.id,
+        message_id=call.message.message_id,
+        reply_markup=catalog_keyboard(pid)
+    )
+    api.answer_callback_query(call.id)
+
+# ===================== SEARCH =====================
+
+SEARCH_HEADER = "🔎 نتایج جستجو: "
+
+# عبارت جستجو در callback_data (حداکثر ۶۴ بایت) جا نمی‌شود؛ در خط اول پیام نتایج
+# نوشته می‌شود و دکمه‌های صفحه‌بندی آن را از همان‌جا می‌خوانند.
+_MARKDOWN_CHARS = str.maketrans("", "", "*_`[]")
 
-        kb = types.InlineKeyboardMarkup()
-        kb.add(
-            types.InlineKeyboardButton("⭐ برای بعداً", callback_data=f"later_add_{pid}"),
-            types.InlineKeyboardButton("🛒 افزودن به سبد", callback_data=f"cart_add_{pid}")
+def render_search(query, offset=0):
+    rows, has_more, truncated = search_products(db.cursor(), query, offset)
+    if not rows:
+        return None
+
+    lines = [f"{SEARCH_HEADER}{query}", ""]
+    kb = telebot.types.InlineKeyboardMarkup()
+    for n, (pid, title, price, photo) in enumerate(rows, offset + 1):
+        lines.append(f"{n}. *{title}* — 💰 {price} تومان")
+        kb.row(
+            telebot.types.InlineKeyboardButton(f"{n} 🖼 مشاهده", callback_data=f"view:{pid}"),
+            telebot.types.InlineKeyboardButton(f"{n} ⭐", callback_data=f"later_add:{pid}"),
+            telebot.types.InlineKeyboardButton(f"{n} 🛒", callback_data=f"cart_add:{pid}")
         )
 
-        bot.send_photo(message.chat.id, photo, caption=caption, reply_markup=kb)
+    if truncated:
+        lines += ["", f"ℹ️ فقط {SEARCH_CANDIDATES} نتیجه‌ی جدیدتر بررسی شد؛ برای نتایج دقیق‌تر کلمه یا بازه‌ی قیمت اضافه کن."]
+
+    nav = []
+    if offset:
+        nav.append(telebot.types.InlineKeyboardButton(
+            "⬅️ قبلی", callback_data=f"search_page:{max(0, offset - SEARCH_PAGE_SIZE)}"
+        ))
+    if has_more:
+        nav.append(telebot.types.InlineKeyboardButton(
+            "بعدی ➡️", callback_data=f"search_page:{offset + SEARCH_PAGE_SIZE}"
+        ))
+    if nav:
+        kb.row(*nav)
+    return "\n".join(lines), kb
+
+def send_search_results(chat_id, text):
+    query = " ".join(text.translate(_MARKDOWN_CHARS).split())
+    result = render_search(query) if query else None
+    if not result:
+        api.send_message(chat_id, "نتیجه‌ای پیدا نشد.")
+        return
+    body, kb = result
+    api.send_message(chat_id, body, reply_markup=kb)
+
+@router.text("🔎 جستجو")
+def ask_search(message):
+    api.send_message(
+        message.chat.id,
+        "عبارت جستجو را بفرست (برای فیلتر قیمت یک بازه هم بنویس، مثلاً: گوشی 1000000-5000000):"
+    )
+    states.set(message.chat.id, search_step)
+
+@router.command("search")
+def search_command(message):
+    parts = message.text.split(maxsplit=1)
+    if len(parts) < 2:
+        ask_search(message)
+        return
+    send_search_results(message.chat.id, parts[1])
+
+@states.step
+def search_step(message):
+    send_search_results(message.chat.id, message.text or "")
+
+@router.callback("search_page")
+def search_page(call):
+    offset = int(parse_callback(call.data)[1])
+    header = (call.message.text or "").split("\n", 1)[0]
+    result = render_search(header.removeprefix(SEARCH_HEADER), offset)
+    if not result:
+        api.answer_callback_query(call.id, "نتیجه‌ی دیگری نیست.")
+        return
+
+    text, kb = result
+    api.edit_message_text(
+        text,
+        chat_id=call.message.chat.id,
+        message_id=call.message.message_id,
+        reply_markup=kb
+    )
+    api.answer_callback_query(call.id)
+
+def send_product_card(chat_id, pid):
+    # کارت محصول با همان دکمه‌های کاتالوگ؛ از همین‌جا می‌شود قبلی/بعدی را هم دید
+    row = fetch_catalog_product(after_id=pid - 1)
+    if not row or row[0] != pid:
+        return False
+
+    pid, title, desc, price, photo, seller_id, username = row
+    api.send_photo(
+        chat_id,
+        photo,
+        caption=catalog_caption(title, desc, price, username),
+        reply_markup=catalog_keyboard(pid)
+    )
+    return True
+
+@router.callback("view")
+def view_product(call):
+    pid = int(parse_callback(call.data)[1])
+    if send_product_card(call.message.chat.id, pid):
+        api.answer_callback_query(call.id)
+    else:
+        api.answer_callback_query(call.id, "محصول پیدا نشد.")
+
+# ===================== INLINE MODE =====================
+
+# «@bot عبارت» در هر چتی: نتایج از file_idهای ذخیره‌شده ساخته می‌شوند (بدون آپلود دوباره)
+# و تلگرام صفحه‌ی بعد را فقط وقتی کاربر پایین برود با next_offset می‌خواهد.
+inline_cache = TTLCache(INLINE_CACHE_SIZE, INLINE_CACHE_TTL)
+
+def fetch_inline_page(key):
+    query, offset = key
+    cur = db.cursor()
+    if query:
+        start = int(offset or 0)
+        # در حالت inline جایی برای توضیح بریده شدن نتایج نیست
+        rows, has_more, _ = search_products(cur, query, start, limit=INLINE_PAGE_SIZE)
+        next_offset = str(start + INLINE_PAGE_SIZE) if has_more else ""
+    else:
+        # بدون عبارت: جدیدترین محصولات، صفحه‌بندی keyset (offset = کوچک‌ترین id صفحه‌ی قبل)
+        if offset:
+            cur.execute(
+                "SELECT id, title, price, photo FROM products WHERE id < ? ORDER BY id DESC LIMIT ?",
+                (int(offset), INLINE_PAGE_SIZE)
+            )
+        else:
+            cur.execute(
+                "SELECT id, title, price, photo FROM products ORDER BY id DESC LIMIT ?",
+                (INLINE_PAGE_SIZE,)
+            )
+        rows = cur.fetchall()
+        next_offset = str(rows[-1][0]) if len(rows) == INLINE_PAGE_SIZE else ""
+
+    # پیام inline به چت ربات تعلق ندارد و callback آن call.message ندارد؛
+    # برای همین دکمه‌اش لینکی است که کارت کامل محصول را در خود ربات باز می‌کند
+    link = f"https://t.me/{bot.user.username}?start=p"
+    results = []
+    for pid, title, price, photo in rows:
+        kb = telebot.types.InlineKeyboardMarkup()
+        kb.add(telebot.types.InlineKeyboardButton("🛍 مشاهده در ربات", url=f"{link}{pid}"))
+        results.append(telebot.types.InlineQueryResultCachedPhoto(
+            id=str(pid),
+            photo_file_id=photo,
+            title=title,
+            description=f"💰 {price} تومان",
+            caption=f"*{title}*\n💰 قیمت: {price} تومان",
+            parse_mode="Markdown",
+            reply_markup=kb
+        ))
+    return results, next_offset
+
+@router.inline
+def inline_products(query):
+    # عبارت یکسان‌سازی‌شده کلید کش است (كتاب و کتاب یک نتیجه دارند)
+    key = (" ".join(normalize(query.query).split()), query.offset)
+    try:
+        results, next_offset = inline_cache.get_or_load(key, fetch_inline_page)
+    except ValueError:
+        # offset ساختگی؛ ما همیشه عدد می‌فرستیم
+        results, next_offset = [], ""
+
+    api.answer_inline_query(
+        query.id,
+        results,
+        cache_time=INLINE_CACHE_TIME,
+        next_offset=next_offset
+    )
 
 # ===================== LATER: ADD =====================
 
-@bot.callback_query_handler(func=lambda c: c.data.startswith("later_add_"))
+@router.callback("later_add")
 def later_add(call):
     user_id = call.from_user.id
-    product_id = int(call.data.split("_")[2])
+    product_id = int(parse_callback(call.data)[1])
 
-    cur = db.cursor()
-    cur.execute("SELECT id FROM later WHERE user_id=? AND product_id=?", (user_id, product_id))
-    if not cur.fetchone():
-        cur.execute("INSERT INTO later (user_id, product_id) VALUES (?, ?)", (user_id, product_id))
-        db.commit()
+    db.defer("INSERT OR IGNORE INTO later (user_id, product_id) VALUES (?, ?)", (user_id, product_id))
 
-    bot.answer_callback_query(call.id, "به لیست برای بعداً اضافه شد ✔️")
+    api.answer_callback_query(call.id, "به لیست برای بعداً اضافه شد ✔️")
 
 # ===================== CART: ADD =====================
 
-@bot.callback_query_handler(func=lambda c: c.data.startswith("cart_add_"))
+def add_to_cart(user_id, product_id):
+    # محصول تکراری یک ردیف جدید نمی‌سازد، تعدادش یکی زیاد می‌شود
+    db.defer(
+        "INSERT INTO cart (user_id, product_id) VALUES (?, ?) \
+         ON CONFLICT (user_id, product_id) DO UPDATE SET quantity = quantity + 1",
+        (user_id, product_id)
+    )
+
+@router.callback("cart_add")
 def cart_add(call):
     user_id = call.from_user.id
-    product_id = int(call.data.split("_")[2])
-
-    cur = db.cursor()
-    cur.execute("INSERT INTO cart (user_id, product_id) VALUES (?, ?)", (user_id, product_id))
-    db.commit()
+    product_id = int(parse_callback(call.data)[1])
 
-    bot.answer_callback_query(call.id, "به سبد خرید اضافه شد ✔️")
+    add_to_cart(user_id, product_id)
+    api.answer_callback_query(call.id, "به سبد خرید اضافه شد ✔️")
 
 # ===================== LATER: LIST =====================
 
-@bot.message_handler(func=lambda m: m.text == "⭐ برای بعداً")
+@router.text("⭐ برای بعداً")
 def show_later(message):
     user_id = message.from_user.id
+    # «برای بعداً» با db.defer ثبت می‌شود؛ تازه‌ترین افزودن هم باید در لیست باشد
+    db.flush()
     cur = db.cursor()
     cur.execute(
         "SELECT l.id, p.id, p.title, p.description, p.price, p.photo \
@@ -648,89 +1063,194 @@ def show_later(message):
     rows = cur.fetchall()
 
     if not rows:
-        bot.send_message(message.chat.id, "لیست برای بعداً خالی است.")
+        api.send_message(message.chat.id, "لیست برای بعداً خالی است.")
         return
 
-    for later_id, pid, title, desc, price, photo in rows:
+    items = []
+    lines = []
+    for n, (later_id, pid, title, desc, price, photo) in enumerate(rows, 1):
         caption = f"*{title}*\n{desc}\n💰 قیمت: {price} تومان"
+        buttons = [
+            ("❌ حذف از برای بعداً", f"later_del:{later_id}"),
+            ("🛒 افزودن به سبد", f"later_to_cart:{later_id}")
+        ]
+        items.append((photo, caption, buttons))
+        lines.append(f"{n}. {short_title(title)} — {price} تومان")
 
-        kb = types.InlineKeyboardMarkup()
-        kb.add(
-            types.InlineKeyboardButton("❌ حذف از برای بعداً", callback_data=f"later_del_{later_id}"),
-            types.InlineKeyboardButton("🛒 افزودن به سبد", callback_data=f"later_to_cart_{later_id}")
-        )
-
-        bot.send_photo(message.chat.id, photo, caption=caption, reply_markup=kb)
+    send_product_album(message.chat.id, items, "⭐ برای بعداً — دکمه‌ها به ترتیب شماره عکس‌ها:", lines=lines)
 
-@bot.callback_query_handler(func=lambda c: c.data.startswith("later_del_"))
+@router.callback("later_del")
 def later_delete(call):
-    later_id = int(call.data.split("_")[2])
-    cur = db.cursor()
-    cur.execute("DELETE FROM later WHERE id=?", (later_id,))
-    db.commit()
-    bot.answer_callback_query(call.id, "از لیست برای بعداً حذف شد ✔️")
+    later_id = int(parse_callback(call.data)[1])
+    with db.transaction() as cur:
+        cur.execute("DELETE FROM later WHERE id=?", (later_id,))
+    api.answer_callback_query(call.id, "از لیست برای بعداً حذف شد ✔️")
 
-@bot.callback_query_handler(func=lambda c: c.data.startswith("later_to_cart_"))
+@router.callback("later_to_cart")
 def later_to_cart(call):
-    later_id = int(call.data.split("_")[2])
+    later_id = int(parse_callback(call.data)[1])
     user_id = call.from_user.id
 
     cur = db.cursor()
     cur.execute("SELECT product_id FROM later WHERE id=?", (later_id,))
     row = cur.fetchone()
     if not row:
-        bot.answer_callback_query(call.id, "این آیتم دیگر در لیست برای بعداً نیست.")
+        api.answer_callback_query(call.id, "این آیتم دیگر در لیست برای بعداً نیست.")
         return
 
-    product_id = row[0]
-    cur.execute("INSERT INTO cart (user_id, product_id) VALUES (?, ?)", (user_id, product_id))
-    db.commit()
-
-    bot.answer_callback_query(call.id, "به سبد خرید اضافه شد ✔️")
+    add_to_cart(user_id, row[0])
+    api.answer_callback_query(call.id, "به سبد خرید اضافه شد ✔️")
 
 # ===================== CART: LIST =====================
 
-@bot.message_handler(func=lambda m: m.text == "🛒 سبد خرید")
-def show_cart(message):
-    user_id = message.from_user.id
+CART_HEADER = "🛒 سبد خرید — دکمه‌ها به ترتیب شماره عکس‌ها:"
+
+def load_cart(user_id):
+    # جمع هر فروشنده و جمع کل با window function در همان کوئری حساب می‌شوند.
+    # افزودن به سبد صف‌شده (db.defer) است؛ قبل از خواندن commit می‌شود
+    db.flush()
     cur = db.cursor()
     cur.execute(
-        "SELECT c.id, p.id, p.title, p.description, p.price, p.photo, p.seller_id, u.username \
+        "SELECT c.id, p.id, p.title, p.description, p.price, p.photo, p.seller_id, u.username, \
+                c.quantity, \
+                SUM(p.price * c.quantity) OVER (PARTITION BY p.seller_id), \
+                SUM(p.price * c.quantity) OVER () \
          FROM cart c \
          JOIN products p ON c.product_id = p.id \
          LEFT JOIN users u ON p.seller_id = u.telegram_id \
-         WHERE c.user_id=?",
+         WHERE c.user_id=? \
+         ORDER BY p.seller_id, c.id",
         (user_id,)
     )
-    rows = cur.fetchall()
-
+    return cur.fetchall()
+
+CART_TOTAL = "💰 مجموع سبد خرید"
+
+def cart_entry(n, row, start):
+    # آیتم (برای send_product_album) و خط فهرستِ یک ردیف سبد با شماره‌ی n؛
+    # start شروع پیام فهرستی است که آیتم در آن است و دکمه‌های +/− همان پیام را دوباره می‌سازند
+    cart_id, pid, title, desc, price, photo, _, username, quantity, _, _ = row
+    item = (photo, catalog_caption(title, desc, price, username), [
+        ("📩 پیام به فروشنده", f"contact:{pid}"),
+        ("➖", f"cart_dec:{cart_id}:{start}"),
+        ("➕", f"cart_inc:{cart_id}:{start}"),
+    ])
+    return item, f"{n}. {short_title(title)} × {quantity} = {price * quantity} تومان"
+
+def cart_footer(rows):
+    # ردیف‌ها بر اساس فروشنده مرتب‌اند؛ بعد از آخرین ردیف هر فروشنده جمع او می‌آید
+    subtotals = []
+    for i, row in enumerate(rows):
+        seller_id, username, seller_total = row[6], row[7], row[9]
+        if i + 1 == len(rows) or rows[i + 1][6] != seller_id:
+            seller = f"@{username}" if username else "بدون یوزرنیم"
+            subtotals.append(f"👤 {seller}: {seller_total} تومان")
+    return "\n".join(subtotals + [f"{CART_TOTAL}: {rows[-1][10]} تومان"])
+
+def cart_view(rows):
+    # خروجی: (items برای send_product_album، یک خط برای هر آیتم، footer جمع‌ها)
+    items = []
+    lines = []
+    for i, row in enumerate(rows):
+        item, line = cart_entry(i + 1, row, i - i % INDEX_SIZE)
+        items.append(item)
+        lines.append(line)
+    return items, lines, cart_footer(rows)
+
+def cart_page(markup):
+    # شناسه‌های سبدِ یک پیام فهرست به ترتیب شماره‌هایش، از روی دکمه‌های خود پیام
+    ids = []
+    for buttons in markup.keyboard if markup else []:
+        for button in buttons:
+            action, arg = parse_callback(button.callback_data or "")
+            if action in ("cart_dec", "cart_gone"):
+                ids.append(int(arg.split(":")[0]))
+                break
+    return ids
+
+@router.text("🛒 سبد خرید")
+def show_cart(message):
+    rows = load_cart(message.from_user.id)
     if not rows:
-        bot.send_message(message.chat.id, "سبد خرید خالی است.")
+        api.send_message(message.chat.id, "سبد خرید خالی است.")
         return
 
-    total = 0
-    for cart_id, pid, title, desc, price, photo, seller_id, username in rows:
-        total += price
-        seller_line = ""
-        if username:
-            seller_line = f"\n👤 فروشنده: @{username}"
-        caption = f"*{title}*\n{desc}\n💰 قیمت: {price} تومان{seller_line}"
+    items, lines, footer = cart_view(rows)
+    send_product_album(message.chat.id, items, CART_HEADER, footer=footer, lines=lines)
+
+@router.callback("cart_inc", "cart_dec")
+def change_cart_quantity(call):
+    action, arg = parse_callback(call.data)
+    cart_id, start = map(int, arg.split(":"))
+    user_id = call.from_user.id
+
+    with db.transaction() as cur:
+        if action == "cart_inc":
+            cur.execute(
+                "UPDATE cart SET quantity = quantity + 1 WHERE id=? AND user_id=?",
+                (cart_id, user_id)
+            )
+        else:
+            cur.execute(
+                "UPDATE cart SET quantity = quantity - 1 WHERE id=? AND user_id=? AND quantity > 1",
+                (cart_id, user_id)
+            )
+            if not cur.rowcount:
+                # تعداد ۱ بود: آیتم از سبد حذف می‌شود
+                cur.execute("DELETE FROM cart WHERE id=? AND user_id=?", (cart_id, user_id))
+        changed = cur.rowcount
+
+    if not changed:
+        # آیتم قبلاً حذف شده (مثلاً ➖ تکراری)؛ ویرایش با همان متن را تلگرام رد می‌کند
+        api.answer_callback_query(call.id, "این محصول دیگر در سبد خرید نیست.")
+        return
 
-        kb = types.InlineKeyboardMarkup()
-        kb.add(
-            types.InlineKeyboardButton("📩 پیام به فروشنده", callback_data=f"contact_{pid}")
+    # همان پیام فهرست با تعداد و جمع‌های جدید ویرایش می‌شود (پیام تازه فرستاده نمی‌شود)
+    rows = load_cart(user_id)
+    if not rows:
+        api.edit_message_text(
+            "سبد خرید خالی است.",
+            chat_id=call.message.chat.id,
+            message_id=call.message.message_id
         )
+        api.answer_callback_query(call.id)
+        return
 
-        bot.send_photo(message.chat.id, photo, caption=caption, reply_markup=kb)
+    # شماره‌ها باید با آلبومِ فرستاده‌شده یکی بمانند: آیتم‌های همین پیام به همان ترتیب
+    # دوباره ساخته می‌شوند و آیتم حذف‌شده سر جایش با دکمه‌ی غیرفعال می‌ماند.
+    # items و lines تا start خالی‌اند چون album_index از start برش می‌زند.
+    by_id = {row[0]: row for row in rows}
+    items = [None] * start
+    lines = [""] * start
+    for n, cid in enumerate(cart_page(call.message.reply_markup), start + 1):
+        row = by_id.get(cid)
+        if row:
+            item, line = cart_entry(n, row, start)
+        else:
+            item, line = (None, None, [("❌ حذف شد", f"cart_gone:{cid}")]), f"{n}. ❌ از سبد حذف شد"
+        items.append(item)
+        lines.append(line)
+    # جمع‌ها فقط در آخرین پیام فهرست هستند
+    footer = cart_footer(rows) if CART_TOTAL in (call.message.text or "") else None
+    text, kb = album_index(items, start, CART_HEADER, footer, lines)
+    api.edit_message_text(
+        text,
+        chat_id=call.message.chat.id,
+        message_id=call.message.message_id,
+        reply_markup=kb
+    )
+    api.answer_callback_query(call.id)
 
-    bot.send_message(message.chat.id, f"💰 مجموع سبد خرید: {total} تومان")
+@router.callback("cart_gone")
+def cart_item_gone(call):
+    api.answer_callback_query(call.id, "این محصول دیگر در سبد خرید نیست.")
 
 # ===================== CONTACT SELLER (HISTORY) =====================
 
-@bot.callback_query_handler(func=lambda c: c.data.startswith("contact_"))
+@router.callback("contact")
 def contact_seller(call):
     user_id = call.from_user.id
-    product_id = int(call.data.split("_")[1])
+    product_id = int(parse_callback(call.data)[1])
 
     cur = db.cursor()
     cur.execute(
@@ -741,37 +1261,38 @@ def contact_seller(call):
     )
     row = cur.fetchone()
     if not row:
-        bot.answer_callback_query(call.id, "محصول پیدا نشد.")
+        api.answer_callback_query(call.id, "محصول پیدا نشد.")
         return
 
     seller_id, username = row
 
     timestamp = datetime.utcnow().isoformat()
-    cur.execute(
+    db.defer(
         "INSERT INTO history (user_id, product_id, seller_id, timestamp) VALUES (?, ?, ?, ?)",
         (user_id, product_id, seller_id, timestamp)
     )
-    db.commit()
 
-    bot.answer_callback_query(call.id, "در تاریخچه ثبت شد ✔️")
+    api.answer_callback_query(call.id, "در تاریخچه ثبت شد ✔️")
 
     if username:
         link = f"https://t.me/{username}"
-        bot.send_message(
+        api.send_message(
             call.message.chat.id,
             f"برای پیام دادن به فروشنده روی لینک زیر بزن:\n{link}"
         )
     else:
-        bot.send_message(
+        api.send_message(
             call.message.chat.id,
             "این فروشنده یوزرنیم ندارد. نمی‌توان لینک مستقیم ساخت."
         )
 
 # ===================== HISTORY LIST =====================
 
-@bot.message_handler(func=lambda m: m.text == "📜 تاریخچه")
+@router.text("📜 تاریخچه")
 def show_history(message):
     user_id = message.from_user.id
+    # سطرهای history با db.defer ثبت می‌شوند
+    db.flush()
     cur = db.cursor()
     cur.execute(
         "SELECT h.timestamp, p.title, u.username \
@@ -786,7 +1307,7 @@ def show_history(message):
     rows = cur.fetchall()
 
     if not rows:
-        bot.send_message(message.chat.id, "هنوز هیچ پیامی به فروشنده‌ها ثبت نشده.")
+        api.send_message(message.chat.id, "هنوز هیچ پیامی به فروشنده‌ها ثبت نشده.")
         return
 
     lines = ["📜 آخرین پیام‌ها به فروشنده‌ها:"]
@@ -795,153 +1316,221 @@ def show_history(message):
         seller_part = f"@{username}" if username else "بدون یوزرنیم"
         lines.append(f"- {time_str} | {title} | {seller_part}")
 
-    bot.send_message(message.chat.id, "\n".join(lines))
+    api.send_message(message.chat.id, "\n".join(lines))
 
 # ===================== ADMIN FEATURES =====================
 
-@bot.message_handler(func=lambda m: m.text == "➕ افزودن ادمین")
+@router.text("➕ افزودن ادمین")
 def ask_new_admin(message):
     if not is_admin(message.from_user.id):
         return
-    msg = bot.send_message(message.chat.id, "آیدی عددی کاربر را بفرست:")
-    bot.register_next_step_handler(msg, save_new_admin)
+    api.send_message(message.chat.id, "آیدی عددی کاربر را بفرست:")
+    states.set(message.chat.id, save_new_admin)
 
+@states.step
 def save_new_admin(message):
     try:
         uid = int(message.text.strip())
         add_admin(uid)
-        bot.send_message(message.chat.id, "ادمین جدید اضافه شد ✔️")
+        api.send_message(message.chat.id, "ادمین جدید اضافه شد ✔️")
     except:
-        bot.send_message(message.chat.id, "آیدی نامعتبر است.")
+        metrics.swallowed()
+        api.send_message(message.chat.id, "آیدی نامعتبر است.")
 
-@bot.message_handler(func=lambda m: m.text == "❌ حذف ادمین")
+@router.text("❌ حذف ادمین")
 def ask_remove_admin(message):
     if not is_admin(message.from_user.id):
         return
-    msg = bot.send_message(message.chat.id, "آیدی ادمین را بفرست:")
-    bot.register_next_step_handler(msg, remove_admin_handler)
+    api.send_message(message.chat.id, "آیدی ادمین را بفرست:")
+    states.set(message.chat.id, remove_admin_handler)
 
+@states.step
 def remove_admin_handler(message):
     try:
         uid = int(message.text.strip())
         remove_admin(uid)
-        bot.send_message(message.chat.id, "ادمین حذف شد ✔️")
+        api.send_message(message.chat.id, "ادمین حذف شد ✔️")
     except:
-        bot.send_message(message.chat.id, "آیدی نامعتبر است.")
+        metrics.swallowed()
+        api.send_message(message.chat.id, "آیدی نامعتبر است.")
 
-@bot.message_handler(func=lambda m: m.text == "🚫 بن کاربر")
+@router.text("🚫 بن کاربر")
 def ask_ban_user(message):
     if not is_admin(message.from_user.id):
         return
-    msg = bot.send_message(message.chat.id, "آیدی کاربر را بفرست:")
-    bot.register_next_step_handler(msg, ban_user_handler)
+    api.send_message(message.chat.id, "آیدی کاربر را بفرست:")
+    states.set(message.chat.id, ban_user_handler)
 
+@states.step
 def ban_user_handler(message):
     try:
         uid = int(message.text.strip())
-        cur = db.cursor()
-        cur.execute("DELETE FROM users WHERE telegram_id=?", (uid,))
-        db.commit()
-        bot.send_message(message.chat.id, "کاربر بن شد ✔️")
+        with db.transaction() as cur:
+            cur.execute("DELETE FROM users WHERE telegram_id=?", (uid,))
+        identity_cache.invalidate(uid)
+        api.send_message(message.chat.id, "کاربر بن شد ✔️")
     except:
-        bot.send_message(message.chat.id, "آیدی نامعتبر است.")
+        metrics.swallowed()
+        api.send_message(message.chat.id, "آیدی نامعتبر است.")
 
-@bot.message_handler(func=lambda m: m.text == "🔄 تغییر نقش کاربر")
+@router.text("🔄 تغییر نقش کاربر")
 def ask_change_role(message):
     if not is_admin(message.from_user.id):
         return
-    msg = bot.send_message(message.chat.id, "آیدی کاربر را بفرست:")
-    bot.register_next_step_handler(msg, change_role_step2)
+    api.send_message(message.chat.id, "آیدی کاربر را بفرست:")
+    states.set(message.chat.id, change_role_step2)
 
+@states.step
 def change_role_step2(message):
     try:
         uid = int(message.text.strip())
     except:
-        bot.send_message(message.chat.id, "آیدی نامعتبر است.")
+        metrics.swallowed()
+        api.send_message(message.chat.id, "آیدی نامعتبر است.")
         return
-    msg = bot.send_message(message.chat.id, "نقش جدید را وارد کن (buyer/seller):")
-    bot.register_next_step_handler(msg, change_role_final, uid)
+    api.send_message(message.chat.id, "نقش جدید را وارد کن (buyer/seller):")
+    states.set(message.chat.id, change_role_final, uid=uid)
 
+@states.step
 def change_role_final(message, uid):
-    role = message.text.strip()
+    role = (message.text or "").strip()
     if role not in ["buyer", "seller"]:
-        bot.send_message(message.chat.id, "نقش نامعتبر است.")
+        api.send_message(message.chat.id, "نقش نامعتبر است.")
         return
-    cur = db.cursor()
-    cur.execute("UPDATE users SET role=? WHERE telegram_id=?", (role, uid))
-    db.commit()
-    bot.send_message(message.chat.id, "نقش کاربر تغییر کرد ✔️")
+    with db.transaction() as cur:
+        cur.execute("UPDATE users SET role=? WHERE telegram_id=?", (role, uid))
+    identity_cache.invalidate(uid)
+    api.send_message(message.chat.id, "نقش کاربر تغییر کرد ✔️")
+
+@router.command("repair_counters")
+def repair_counters_command(message):
+    # شمارنده‌ها را triggerها دقیق نگه می‌دارند؛ این فقط برای بعد از تغییر دستی دیتابیس است
+    if not is_admin(message.from_user.id):
+        return
+    with db.transaction() as cur:
+        fixed = repair_counters(cur)
+    api.send_message(message.chat.id, f"شمارنده‌ها دوباره حساب شدند ✔️ ({fixed} سطر اصلاح شد)")
+
+@router.command("export")
+def export_command(message):
+    # /export <users|products|cart|history|all> [csv|jsonl]
+    if not is_admin(message.from_user.id):
+        return
+    args = message.text.split()[1:]
+    table = args[0].lower() if args else ""
+    fmt = args[1].lower() if len(args) > 1 else "csv"
+    if table not in exporter.TABLES + ("all",) or fmt not in exporter.FORMATS:
+        api.send_message(
+            message.chat.id,
+            f"استفاده: /export <{'|'.join(exporter.TABLES)}|all> [csv|jsonl]",
+            parse_mode=""
+        )
+        return
+
+    tables = exporter.TABLES if table == "all" else (table,)
+    if exporter_jobs.start(message.chat.id, message.from_user.id, tables, fmt):
+        api.send_message(message.chat.id, "⏳ خروجی در حال آماده شدن است؛ فایل‌ها همین‌جا فرستاده می‌شوند.")
+    else:
+        api.send_message(message.chat.id, "یک خروجی دیگر هنوز در حال انجام است.")
 
-@bot.message_handler(func=lambda m: m.text == "🗑 حذف محصول")
+@router.command("retention")
+def retention_command(message):
+    # اجرای فوری نگهداری تاریخچه (در حالت عادی هر RETENTION_INTERVAL ثانیه خودکار اجرا می‌شود)
+    if not is_admin(message.from_user.id):
+        return
+    if history_retention is None:
+        api.send_message(message.chat.id, "نگهداری تاریخچه خاموش است (RETENTION_DAYS = 0).", parse_mode="")
+        return
+
+    def run():
+        try:
+            result = history_retention.run()
+        except Exception:
+            logger.exception("history retention failed")
+            api.send_message(message.chat.id, "نگهداری تاریخچه به خاطر خطای داخلی متوقف شد.")
+            return
+        if result is None:
+            api.send_message(message.chat.id, "نگهداری تاریخچه همین الان (در این یا پروسه‌ی دیگری) در حال اجراست.")
+            return
+        api.send_message(
+            message.chat.id,
+            f"✔️ {result['archived']} سطر تاریخچه آرشیو شد، {result['freed_pages']} صفحه آزاد شد "
+            f"({result['seconds']:.1f} ثانیه)."
+        )
+
+    threading.Thread(target=run, name="retention-now", daemon=True).start()
+    api.send_message(message.chat.id, f"⏳ آرشیو تاریخچه‌ی قدیمی‌تر از {RETENTION_DAYS} روز شروع شد.")
+
+@router.text("🗑 حذف محصول")
 def ask_delete_product_admin(message):
     if not is_admin(message.from_user.id):
         return
-    msg = bot.send_message(message.chat.id, "آیدی محصول را بفرست:")
-    bot.register_next_step_handler(msg, delete_product_admin)
+    api.send_message(message.chat.id, "آیدی محصول را بفرست:")
+    states.set(message.chat.id, delete_product_admin)
 
+@states.step
 def delete_product_admin(message):
     try:
         pid = int(message.text.strip())
     except:
-        bot.send_message(message.chat.id, "آیدی محصول نامعتبر است.")
+        metrics.swallowed()
+        api.send_message(message.chat.id, "آیدی محصول نامعتبر است.")
         return
-    cur = db.cursor()
-    cur.execute("DELETE FROM products WHERE id=?", (pid,))
-    db.commit()
-    bot.send_message(message.chat.id, "محصول حذف شد ✔️")
+    with db.transaction() as cur:
+        cur.execute("DELETE FROM products WHERE id=?", (pid,))
+    api.send_message(message.chat.id, "محصول حذف شد ✔️")
 
-@bot.message_handler(func=lambda m: m.text == "✏️ ویرایش محصول")
+@router.text("✏️ ویرایش محصول")
 def ask_edit_product_admin(message):
     if not is_admin(message.from_user.id):
         return
-    msg = bot.send_message(message.chat.id, "آیدی محصول را بفرست:")
-    bot.register_next_step_handler(msg, edit_product_admin_step2)
+    api.send_message(message.chat.id, "آیدی محصول را بفرست:")
+    states.set(message.chat.id, edit_product_admin_step2)
 
+ADMIN_EDIT_KEYBOARD = inline_template(
+    [("✏️ عنوان", "admin_edit_title:$pid"), ("📝 توضیحات", "admin_edit_desc:$pid")],
+    [("💰 قیمت", "admin_edit_price:$pid"), ("🖼 عکس", "admin_edit_photo:$pid")]
+)
+
+@states.step
 def edit_product_admin_step2(message):
     try:
         pid = int(message.text.strip())
     except:
-        bot.send_message(message.chat.id, "آیدی محصول نامعتبر است.")
+        metrics.swallowed()
+        api.send_message(message.chat.id, "آیدی محصول نامعتبر است.")
         return
 
-    kb = types.InlineKeyboardMarkup()
-    kb.add(
-        types.InlineKeyboardButton("✏️ عنوان", callback_data=f"admin_edit_title_{pid}"),
-        types.InlineKeyboardButton("📝 توضیحات", callback_data=f"admin_edit_desc_{pid}")
-    )
-    kb.add(
-        types.InlineKeyboardButton("💰 قیمت", callback_data=f"admin_edit_price_{pid}"),
-        types.InlineKeyboardButton("🖼 عکس", callback_data=f"admin_edit_photo_{pid}")
-    )
-    bot.send_message(message.chat.id, "چه چیزی را می‌خوای ویرایش کنی:", reply_markup=kb)
+    kb = ADMIN_EDIT_KEYBOARD.substitute(pid=pid)
+    api.send_message(message.chat.id, "چه چیزی را می‌خوای ویرایش کنی:", reply_markup=kb)
 
-@bot.callback_query_handler(func=lambda c: c.data.startswith("admin_edit_title_"))
+@router.callback("admin_edit_title")
 def admin_edit_title(call):
-    pid = int(call.data.split("_")[-1])
-    msg = bot.send_message(call.message.chat.id, "عنوان جدید را وارد کن:")
-    bot.register_next_step_handler(msg, save_new_title, pid)
+    pid = int(parse_callback(call.data)[1])
+    api.send_message(call.message.chat.id, "عنوان جدید را وارد کن:")
+    states.set(call.message.chat.id, save_new_title, pid=pid)
 
-@bot.callback_query_handler(func=lambda c: c.data.startswith("admin_edit_desc_"))
+@router.callback("admin_edit_desc")
 def admin_edit_desc(call):
-    pid = int(call.data.split("_")[-1])
-    msg = bot.send_message(call.message.chat.id, "توضیحات جدید را وارد کن:")
-    bot.register_next_step_handler(msg, save_new_desc, pid)
+    pid = int(parse_callback(call.data)[1])
+    api.send_message(call.message.chat.id, "توضیحات جدید را وارد کن:")
+    states.set(call.message.chat.id, save_new_desc, pid=pid)
 
-@bot.callback_query_handler(func=lambda c: c.data.startswith("admin_edit_price_"))
+@router.callback("admin_edit_price")
 def admin_edit_price(call):
-    pid = int(call.data.split("_")[-1])
-    msg = bot.send_message(call.message.chat.id, "قیمت جدید را وارد کن:")
-    bot.register_next_step_handler(msg, save_new_price, pid)
+    pid = int(parse_callback(call.data)[1])
+    api.send_message(call.message.chat.id, "قیمت جدید را وارد کن:")
+    states.set(call.message.chat.id, save_new_price, pid=pid)
 
-@bot.callback_query_handler(func=lambda c: c.data.startswith("admin_edit_photo_"))
+@router.callback("admin_edit_photo")
 def admin_edit_photo(call):
-    pid = int(call.data.split("_")[-1])
-    msg = bot.send_message(call.message.chat.id, "عکس جدید محصول را بفرست:")
-    bot.register_next_step_handler(msg, save_new_photo, pid)
+    pid = int(parse_callback(call.data)[1])
+    api.send_message(call.message.chat.id, "عکس جدید محصول را بفرست:")
+    states.set(call.message.chat.id, save_new_photo, pid=pid)
 
 # ===================== CATCH-ALL برای غیر ادمین =====================
 
-@bot.message_handler(func=lambda m: True)
+@router.default
 def catch_all(message):
     user_id = message.from_user.id
     # اگر ادمین است، مزاحمش نشیم (پیام می‌تونه برای مدیریت استفاده شود)
@@ -949,9 +1538,96 @@ def catch_all(message):
         return
     # اگر غیر از کامندها چیزی زد، همون پیام رو براش برگردون
     if not message.text.startswith("/"):
-        bot.send_message(message.chat.id, f"پیام شما:\n{message.text}")
+        api.send_message(message.chat.id, f"پیام شما:\n{message.text}")
 
 # ===================== RUN =====================
 
-print("Bot is running...")
-bot.infinity_polling()
+@router.default_callback
+def expired_button(call):
+    api.answer_callback_query(call.id, "این دکمه دیگر معتبر نیست.")
+
+def create_app(token=TOKEN, run_mode=RUN_MODE):
+    # schema را (در صورت نیاز) به‌روز می‌کند، TeleBot و صف ارسال را می‌سازد و router را نصب می‌کند
+    global bot, api, collages, importer_jobs, exporter_jobs, history_retention
+    ensure_schema()
+
+    # در حالت‌های webhook و async، workerهای خود runtime هندلرها را اجرا می‌کنند
+    bot = telebot.TeleBot(token, parse_mode="Markdown", threaded=run_mode == "polling")
+    api = Outbox(
+        bot,
+        global_rate=OUTBOX_GLOBAL_RATE,
+        chat_rate=OUTBOX_CHAT_RATE,
+        chat_burst=OUTBOX_CHAT_BURST,
+        # در حالت async ارسال‌ها روی event loop انجام می‌شوند و thread لازم نیست
+        workers=0 if run_mode == "async" else OUTBOX_WORKERS
+    )
+    router.install(bot)
+
+    if COLLAGE_ENABLED and COLLAGE_CHAT and collage.available():
+        photos = collage.PhotoCache(db, bot, PHOTO_CACHE_DIR, PHOTO_CACHE_MB * 1024 * 1024)
+        collages = collage.Collages(
+            db, photos,
+            lambda image: api.send_photo(COLLAGE_CHAT, image, disable_notification=True, priority=PRIORITY_BULK),
+            tile=COLLAGE_TILE, max_entries=COLLAGE_CACHE_SIZE
+        )
+
+    importer_jobs = importer.Importer(
+        db, api, importer.telegram_opener(bot),
+        chunk=IMPORT_CHUNK, max_rows=IMPORT_MAX_ROWS, workers=IMPORT_WORKERS,
+        progress_interval=IMPORT_PROGRESS_INTERVAL
+    )
+    exporter_jobs = exporter.Exporter(
+        lambda: connect_db(db.path), api,
+        batch=EXPORT_BATCH, max_bytes=EXPORT_MAX_BYTES, workers=EXPORT_WORKERS
+    )
+    if RETENTION_DAYS > 0:
+        history_retention = retention.Retention(
+            db, HISTORY_ARCHIVE_DIR, days=RETENTION_DAYS, batch=RETENTION_BATCH,
+            vacuum_pages=VACUUM_PAGES, interval=RETENTION_INTERVAL
+        )
+
+    # عمق صف‌ها و آمار کش‌ها هنگام scrape خوانده می‌شوند
+    metrics.gauge("bot_outbox_depth", api.depth, "Messages waiting in the send queue")
+    metrics.gauge("bot_outbox_sent_total", lambda: api.sent, "Telegram API calls delivered", kind="counter")
+    metrics.gauge("bot_outbox_retried_total", lambda: api.retried, "Telegram API calls retried after 429", kind="counter")
+    metrics.gauge("bot_outbox_failed_total", lambda: api.failed, "Telegram API calls given up on", kind="counter")
+    metrics.gauge("bot_db_pending_writes", db.pending, "Deferred writes waiting for group commit")
+    for cache_name, cache in (("identity", identity_cache), ("inline", inline_cache)):
+        metrics.gauge("bot_cache_size", lambda c=cache: c.stats()["size"], "Cached entries", cache=cache_name)
+        metrics.gauge("bot_cache_hits_total", lambda c=cache: c.hits, "Cache hits", kind="counter", cache=cache_name)
+        metrics.gauge("bot_cache_misses_total", lambda c=cache: c.misses, "Cache misses", kind="counter", cache=cache_name)
+    return bot
+
+def main():
+    create_app()
+    print("Bot is running...")
+    if METRICS_PORT:
+        MetricsServer(metrics, METRICS_HOST, METRICS_PORT).start()
+    if history_retention is not None:
+        history_retention.start()
+
+    if RUN_MODE == "webhook":
+        from webhook import WebhookServer
+
+        server = WebhookServer(
+            bot, WEBHOOK_HOST, WEBHOOK_PORT, WEBHOOK_PATH,
+            secret=WEBHOOK_SECRET, workers=WEBHOOK_WORKERS, queue_size=WEBHOOK_QUEUE_SIZE
+        )
+        metrics.gauge("bot_webhook_queue_depth", server.depth, "Updates waiting for a webhook worker")
+        metrics.gauge("bot_webhook_rejected_total", lambda: server.rejected, "Updates refused with 503", kind="counter")
+        if WEBHOOK_URL:
+            bot.set_webhook(url=WEBHOOK_URL, secret_token=WEBHOOK_SECRET or None)
+        server.serve_forever()
+    elif RUN_MODE == "async":
+        import asyncio
+        from async_runtime import run
+
+        asyncio.run(run(
+            bot, api, TOKEN, parse_mode="Markdown",
+            db_workers=ASYNC_DB_WORKERS, send_concurrency=ASYNC_SEND_CONCURRENCY
+        ))
+    else:
+        bot.infinity_polling()
+
+if __name__ == "__main__":
+    main()
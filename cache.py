@@ -0,0 +1,52 @@
+import threading
+import time
+from collections import OrderedDict
+
+class TTLCache:
+    # کش LRU با سقف اندازه و زمان انقضا؛ thread-safe
+    # مقدار None هم کش می‌شود (مثلاً کاربری که هنوز نقش ندارد)
+
+    def __init__(self, maxsize=10000, ttl=300):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self._epoch = 0
+
+    def get_or_load(self, key, loader):
+        now = time.monotonic()
+        with self._lock:
+            item = self._data.get(key)
+            if item is not None and item[1] > now:
+                self._data.move_to_end(key)
+                self.hits += 1
+                return item[0]
+            self.misses += 1
+            epoch = self._epoch
+
+        value = loader(key)
+
+        with self._lock:
+            # اگر وسط خواندن، چیزی invalidate شد مقدار احتمالاً کهنه است؛ ذخیره‌اش نکن
+            if epoch == self._epoch:
+                self._data[key] = (value, now + self.ttl)
+                self._data.move_to_end(key)
+                if len(self._data) > self.maxsize:
+                    self._data.popitem(last=False)
+        return value
+
+    def invalidate(self, key):
+        with self._lock:
+            self._epoch += 1
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._epoch += 1
+            self._data.clear()
+
+    def stats(self):
+        with self._lock:
+            return {"size": len(self._data), "hits": self.hits, "misses": self.misses}
@@ -0,0 +1,236 @@
+import hashlib
+import io
+import logging
+import math
+import os
+import queue
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# کولاژ صفحه‌های لیست (سبد، برای بعداً، محصولات من): به جای آلبومی از ۱۰ عکس،
+# یک عکس شبکه‌ای با شماره‌ی هر محصول روی گوشه‌اش فرستاده می‌شود.
+#
+# - عکس‌های محصولات یک بار با get_file دانلود و بر اساس sha256 محتوا روی دیسک نگه داشته
+#   می‌شوند (PhotoCache)؛ با رسیدن به max_bytes قدیمی‌ترین‌ها (LRU) پاک می‌شوند.
+# - ساختن و آپلود کولاژ روی thread پس‌زمینه (prepare) انجام می‌شود؛ بار اول همان آلبوم فرستاده
+#   می‌شود و کولاژ یک بار در چت ذخیره (مثلاً یک کانال خصوصی) آپلود و file_id آن نگه داشته
+#   می‌شود. نمایش‌های بعدی همان file_id را بدون دانلود و آپلود می‌فرستند.
+#   کلید کولاژ شماره‌ی اولین خانه و file_id عکس‌هاست؛ عوض شدن عکس یک محصول (تنها نسخه‌ای
+#   از محصول که در تصویر دیده می‌شود) کلید جدیدی می‌سازد.
+#
+# file_api هر شیئی با get_file(file_id) و download_file(file_path) است (TeleBot یا نسخه‌ی ساختگی).
+# Pillow اختیاری است؛ بدون آن ربات مثل قبل آلبوم می‌فرستد.
+
+def available():
+    try:
+        import PIL  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+# ===================== PHOTO CACHE =====================
+
+class PhotoCache:
+    def __init__(self, db, file_api, directory, max_bytes):
+        self.db = db
+        self.file_api = file_api
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._total = None
+        self._lock = threading.Lock()
+
+    def _path(self, digest):
+        return os.path.join(self.directory, digest[:2], digest)
+
+    def get(self, file_id):
+        cur = self.db.cursor()
+        row = cur.execute("SELECT digest FROM photo_files WHERE file_id=?", (file_id,)).fetchone()
+        if row:
+            try:
+                with open(self._path(row[0]), "rb") as f:
+                    data = f.read()
+            except FileNotFoundError:
+                pass
+            else:
+                self.db.defer("UPDATE photo_files SET used_at=? WHERE file_id=?", (time.time(), file_id))
+                return data
+
+        info = self.file_api.get_file(file_id)
+        data = self.file_api.download_file(info.file_path)
+        self._store(file_id, data)
+        return data
+
+    def _store(self, file_id, data):
+        digest = hashlib.sha256(data).hexdigest()
+        path = self._path(digest)
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp = f"{path}.{threading.get_ident()}.tmp"
+            with open(tmp, "wb") as f:
+                f.write(data)
+            os.replace(tmp, path)
+
+        with self._lock:
+            total = self.total_bytes()
+            with self.db.transaction() as cur:
+                shared = cur.execute("SELECT 1 FROM photo_files WHERE digest=? LIMIT 1", (digest,)).fetchone()
+                cur.execute(
+                    "INSERT OR REPLACE INTO photo_files (file_id, digest, size, used_at) VALUES (?, ?, ?, ?)",
+                    (file_id, digest, len(data), time.time())
+                )
+            self._total = total + (0 if shared else len(data))
+            if self._total > self.max_bytes:
+                self._evict()
+
+    def total_bytes(self):
+        # اندازه‌ی فایل‌های روی دیسک؛ چند file_id ممکن است به یک محتوا برسند
+        if self._total is None:
+            self._total = self.db.cursor().execute(
+                "SELECT COALESCE(SUM(size), 0) FROM (SELECT MAX(size) AS size FROM photo_files GROUP BY digest)"
+            ).fetchone()[0]
+        return self._total
+
+    def _evict(self):
+        # تا ۹۰٪ سقف پاک می‌کند تا با هر دانلود جدید دوباره evict لازم نشود.
+        # محتوای مشترک چند file_id ممکن است دو بار کم شود؛ بعد از evict اندازه از نو حساب می‌شود.
+        target = self.max_bytes * 0.9
+        cur = self.db.cursor()
+        oldest = cur.execute("SELECT file_id, digest, size FROM photo_files ORDER BY used_at").fetchall()
+        removed = []
+        for file_id, digest, size in oldest:
+            if self._total <= target:
+                break
+            removed.append((file_id, digest, size))
+            self._total -= size
+
+        with self.db.transaction() as cur:
+            cur.executemany("DELETE FROM photo_files WHERE file_id=?", [(f,) for f, _, _ in removed])
+            # فایل فقط وقتی پاک می‌شود که file_id دیگری به همان محتوا اشاره نکند
+            orphans = {
+                digest for _, digest, _ in removed
+                if not cur.execute("SELECT 1 FROM photo_files WHERE digest=? LIMIT 1", (digest,)).fetchone()
+            }
+        for digest in orphans:
+            try:
+                os.remove(self._path(digest))
+            except FileNotFoundError:
+                pass
+        self._total = None
+
+# ===================== RENDER =====================
+
+def render_grid(images, first_number, tile=320):
+    # images: لیست bytes (یا None برای عکسی که دانلود نشد)؛ خروجی JPEG
+    from PIL import Image, ImageDraw, ImageFont, ImageOps
+
+    columns = math.ceil(math.sqrt(len(images)))
+    rows = math.ceil(len(images) / columns)
+    canvas = Image.new("RGB", (columns * tile, rows * tile), "white")
+    draw = ImageDraw.Draw(canvas)
+    radius = tile // 9
+    try:
+        font = ImageFont.load_default(size=radius)
+    except TypeError:
+        # Pillow قدیمی‌تر از 10.1 فقط فونت bitmap ثابت دارد
+        font = ImageFont.load_default()
+
+    for i, data in enumerate(images):
+        x, y = (i % columns) * tile, (i // columns) * tile
+        if data is not None:
+            try:
+                image = ImageOps.exif_transpose(Image.open(io.BytesIO(data))).convert("RGB")
+                canvas.paste(ImageOps.fit(image, (tile, tile)), (x, y))
+            except Exception:
+                logger.warning("could not decode photo for tile %d", first_number + i)
+                data = None
+        if data is None:
+            draw.rectangle((x, y, x + tile - 1, y + tile - 1), fill="#dddddd")
+
+        cx, cy = x + radius + 8, y + radius + 8
+        draw.ellipse((cx - radius, cy - radius, cx + radius, cy + radius), fill="black", outline="white", width=2)
+        draw.text((cx, cy), str(first_number + i), fill="white", font=font, anchor="mm")
+
+    out = io.BytesIO()
+    canvas.save(out, "JPEG", quality=85, optimize=True)
+    return out.getvalue()
+
+# ===================== COLLAGES =====================
+
+class Collages:
+    # upload(image) کولاژ را در چت ذخیره می‌فرستد و Future پیام ارسال‌شده را برمی‌گرداند
+    def __init__(self, db, photos, upload, tile=320, max_entries=10000, workers=1, queue_size=100):
+        self.db = db
+        self.photos = photos
+        self.upload = upload
+        self.tile = tile
+        self.max_entries = max_entries
+        self._stored = 0
+        self._pending = set()
+        self._lock = threading.Lock()
+        self._queue = queue.Queue(queue_size)
+        for i in range(workers):
+            threading.Thread(target=self._worker, name=f"collage-{i}", daemon=True).start()
+
+    def key(self, first_number, photo_ids):
+        raw = f"{self.tile}:{first_number}:" + ",".join(photo_ids)
+        return hashlib.sha1(raw.encode("utf-8")).hexdigest()
+
+    def lookup(self, key):
+        row = self.db.cursor().execute("SELECT file_id FROM collages WHERE key=?", (key,)).fetchone()
+        return row[0] if row else None
+
+    def prepare(self, key, first_number, photo_ids):
+        # کولاژ را برای نمایش‌های بعدی در صف ساخت می‌گذارد؛ هر کلید فقط یک بار در صف است
+        # و با پر بودن صف درخواست دور ریخته می‌شود (نمایش بعدی دوباره درخواست می‌دهد)
+        with self._lock:
+            if key in self._pending:
+                return
+            self._pending.add(key)
+        try:
+            self._queue.put_nowait((key, first_number, photo_ids))
+        except queue.Full:
+            with self._lock:
+                self._pending.discard(key)
+
+    def _worker(self):
+        while True:
+            key, first_number, photo_ids = self._queue.get()
+            try:
+                image = self.render(first_number, photo_ids)
+                self._store(key, self.upload(image).result(timeout=300))
+            except Exception:
+                logger.warning("could not prepare collage %s", key, exc_info=True)
+            finally:
+                with self._lock:
+                    self._pending.discard(key)
+
+    def render(self, first_number, photo_ids):
+        images = []
+        for photo_id in photo_ids:
+            try:
+                images.append(self.photos.get(photo_id))
+            except Exception:
+                logger.warning("could not download photo %s", photo_id, exc_info=True)
+                images.append(None)
+        if all(image is None for image in images):
+            raise RuntimeError("no photo could be downloaded")
+        return render_grid(images, first_number, self.tile)
+
+    def _store(self, key, message):
+        photo = getattr(message, "photo", None)
+        if not photo:
+            return
+        self.db.defer(
+            "INSERT OR REPLACE INTO collages (key, file_id, created_at) VALUES (?, ?, ?)",
+            (key, photo[-1].file_id, time.time())
+        )
+        self._stored += 1
+        if self._stored % 100 == 0:
+            # قدیمی‌ترین کولاژها (FIFO) پاک می‌شوند؛ file_idشان در تلگرام هنوز معتبر است ولی لازم نیست
+            self.db.defer(
+                "DELETE FROM collages WHERE key IN ( \
+                     SELECT key FROM collages ORDER BY created_at DESC LIMIT -1 OFFSET ?)",
+                (self.max_entries,)
+            )
@@ -1,2 +1,81 @@
 TOKEN = "your token"
 DB_NAME = "shop.db"
+
+# صف ارسال (محدودیت‌های تلگرام: حدود ۳۰ پیام در ثانیه کلی و ۱ پیام در ثانیه برای هر چت)
+OUTBOX_GLOBAL_RATE = 30
+OUTBOX_CHAT_RATE = 1
+OUTBOX_CHAT_BURST = 3
+OUTBOX_WORKERS = 4
+
+# تنظیمات SQLite
+DB_BUSY_TIMEOUT = 5            # ثانیه انتظار برای قفل نوشتن
+DB_CACHE_KB = 20000            # حافظه‌ی cache هر اتصال (کیلوبایت)
+DB_MMAP_SIZE = 256 * 1024 * 1024
+DB_FLUSH_INTERVAL = 0.05       # ثانیه؛ نوشتن‌های صف‌شده (db.defer) با این فاصله گروهی commit می‌شوند
+DB_FLUSH_BATCH = 500           # با رسیدن صف به این اندازه بدون صبر commit می‌شود
+
+# کش نقش و ادمین بودن کاربران
+USER_CACHE_SIZE = 10000
+USER_CACHE_TTL = 300           # ثانیه
+
+# حالت اجرا: "polling"، "webhook" یا "async"
+RUN_MODE = "polling"
+
+# webhook (TLS توسط reverse proxy جلوی سرور انجام می‌شود)
+WEBHOOK_URL = ""               # آدرس عمومی، مثلاً https://example.com/bot ؛ خالی = setWebhook صدا زده نشود
+WEBHOOK_HOST = "0.0.0.0"
+WEBHOOK_PORT = 8080
+WEBHOOK_PATH = "/bot"
+WEBHOOK_SECRET = ""
+WEBHOOK_WORKERS = 8
+WEBHOOK_QUEUE_SIZE = 1000
+
+# حالت async (RUN_MODE = "async")
+ASYNC_DB_WORKERS = 4           # threadهای اجرای هندلرها (کار با SQLite)
+ASYNC_SEND_CONCURRENCY = 100   # حداکثر درخواست هم‌زمان به تلگرام
+
+# گفتگوهای نیمه‌کاره (مثلاً ثبت محصول) بعد از این مدت منقضی می‌شوند
+STATE_TTL = 3600               # ثانیه
+
+# حالت inline (@bot عبارت) — باید در BotFather با /setinline فعال شود
+INLINE_PAGE_SIZE = 20          # حداکثر ۵۰
+INLINE_CACHE_SIZE = 1000       # تعداد (عبارت، صفحه)های نگه‌داشته‌شده در حافظه
+INLINE_CACHE_TTL = 60          # ثانیه
+INLINE_CACHE_TIME = 60         # ثانیه‌ای که خود تلگرام نتایج را کش می‌کند
+
+# متریک‌های Prometheus روی http://METRICS_HOST:METRICS_PORT/metrics ؛ 0 = بدون سرور
+METRICS_HOST = "127.0.0.1"
+METRICS_PORT = 9100
+
+# لاگ کوئری‌های کند (JSONL چرخشی)؛ خالی = خاموش. خلاصه: python slowlog.py slow_queries.jsonl*
+SLOW_QUERY_LOG = ""            # مثلاً "slow_queries.jsonl"
+SLOW_QUERY_MS = 100
+SLOW_QUERY_LOG_BYTES = 10 * 1024 * 1024
+SLOW_QUERY_LOG_BACKUPS = 5
+
+# کولاژ صفحه‌های لیست (نیاز به Pillow؛ بدون آن آلبوم فرستاده می‌شود)
+COLLAGE_ENABLED = True
+COLLAGE_CHAT = 0               # چت ذخیره‌ی کولاژها (مثلاً کانال خصوصی که ربات ادمین آن است)؛ 0 = خاموش
+COLLAGE_TILE = 320             # پیکسل، اندازه‌ی هر خانه
+COLLAGE_CACHE_SIZE = 10000     # تعداد file_id کولاژهای نگه‌داشته‌شده
+PHOTO_CACHE_DIR = "photo_cache"
+PHOTO_CACHE_MB = 200
+
+# ورود گروهی محصولات از فایل CSV/JSONL (دکمه‌ی «📥 ورود گروهی» یا /import)
+IMPORT_MAX_BYTES = 20 * 1024 * 1024   # بزرگ‌ترین فایلی که ربات‌ها می‌توانند از تلگرام دانلود کنند
+IMPORT_MAX_ROWS = 20000        # حداکثر محصول در هر فایل
+IMPORT_CHUNK = 500             # سطر در هر تراکنش
+IMPORT_WORKERS = 2             # ورودهای هم‌زمان
+IMPORT_PROGRESS_INTERVAL = 3   # ثانیه بین ویرایش‌های پیام وضعیت
+
+# خروجی جدول‌ها برای ادمین (/export)
+EXPORT_BATCH = 1000            # سطر در هر fetchmany
+EXPORT_MAX_BYTES = 50 * 1024 * 1024   # بزرگ‌ترین document که ربات‌ها می‌توانند آپلود کنند
+EXPORT_WORKERS = 1             # خروجی‌های هم‌زمان
+
+# نگهداری تاریخچه: سطرهای قدیمی‌تر از RETENTION_DAYS روز جمع روزانه، آرشیو (gzip) و حذف می‌شوند
+RETENTION_DAYS = 90            # 0 = خاموش
+RETENTION_INTERVAL = 24 * 3600 # ثانیه بین اجراها
+RETENTION_BATCH = 2000         # سطر در هر تراکنش (قفل نوشتن حدود ۲۵ میلی‌ثانیه)
+HISTORY_ARCHIVE_DIR = "history_archive"
+VACUUM_PAGES = 1000            # صفحه در هر قدم incremental_vacuum
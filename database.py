@@ -1,10 +1,212 @@
+import atexit
+import logging
+import re
 import sqlite3
-from config import DB_NAME
+import threading
+import time
+from contextlib import contextmanager
+from functools import lru_cache
 
-def connect_db():
-    return sqlite3.connect(DB_NAME, check_same_thread=False)
+from config import (
+    DB_NAME, DB_BUSY_TIMEOUT, DB_CACHE_KB, DB_MMAP_SIZE, DB_FLUSH_INTERVAL, DB_FLUSH_BATCH,
+    SLOW_QUERY_LOG, SLOW_QUERY_MS, SLOW_QUERY_LOG_BYTES, SLOW_QUERY_LOG_BACKUPS
+)
+from metrics import metrics
+from search import normalize
+from slowlog import SlowQueryLog
 
-db = connect_db()
+logger = logging.getLogger(__name__)
+
+_STATEMENT_TABLE = re.compile(
+    r"\b(?:FROM|INTO|UPDATE|TABLE|INDEX|TRIGGER)\s+(?:IF\s+(?:NOT\s+)?EXISTS\s+)?(?:\w+\.)?(\w+)", re.IGNORECASE
+)
+
+@lru_cache(maxsize=1024)
+def statement_labels(sql):
+    # برچسب کم‌تنوع برای متریک‌ها: نوع دستور و اولین جدول، مثلاً ("select", "products")
+    parts = sql.split(None, 1)
+    table = _STATEMENT_TABLE.search(sql)
+    return (parts[0].lower() if parts else "", table.group(1).lower() if table else "")
+
+@lru_cache(maxsize=1024)
+def _statement_histogram(sql):
+    op, table = statement_labels(sql)
+    return metrics.histogram("bot_db_seconds", op=op, table=table)
+
+# None = خاموش؛ با SLOW_QUERY_LOG در config یا مستقیم (مثلاً در بنچمارک‌ها) روشن می‌شود
+slow_log = SlowQueryLog(
+    SLOW_QUERY_LOG, SLOW_QUERY_MS, SLOW_QUERY_LOG_BYTES, SLOW_QUERY_LOG_BACKUPS
+) if SLOW_QUERY_LOG else None
+
+def _timed(cursor, run, sql, params, many=False):
+    # زمان هر execute در histogram bot_db_seconds ثبت می‌شود (fetch بعدی حساب نمی‌شود)
+    start = time.perf_counter()
+    try:
+        return run(sql, params)
+    except sqlite3.Error:
+        op, table = statement_labels(sql)
+        metrics.inc("bot_db_errors_total", op=op, table=table)
+        raise
+    finally:
+        elapsed = time.perf_counter() - start
+        _statement_histogram(sql).observe(elapsed)
+        if slow_log is not None and elapsed >= slow_log.threshold:
+            slow_log.record(cursor.connection, sql, params, elapsed, many=many)
+
+class InstrumentedCursor(sqlite3.Cursor):
+    def execute(self, sql, params=()):
+        return _timed(self, super().execute, sql, params)
+
+    def executemany(self, sql, seq_of_params):
+        return _timed(self, super().executemany, sql, seq_of_params, many=True)
+
+class InstrumentedConnection(sqlite3.Connection):
+    def cursor(self, factory=InstrumentedCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, params=()):
+        return self.cursor().execute(sql, params)
+
+    def executemany(self, sql, seq_of_params):
+        return self.cursor().executemany(sql, seq_of_params)
+
+def connect_db(path=DB_NAME):
+    conn = sqlite3.connect(path, timeout=DB_BUSY_TIMEOUT, factory=InstrumentedConnection)
+    # فقط روی فایل تازه (قبل از WAL و اولین جدول) اثر دارد؛ صفحه‌های آزاد با retention.py برمی‌گردند.
+    # دیتابیس موجود: python retention.py --enable-incremental-vacuum
+    conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+    # WAL: خواننده‌ها هم‌زمان با نویسنده کار می‌کنند و منتظر هم نمی‌مانند
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute(f"PRAGMA cache_size=-{DB_CACHE_KB}")
+    conn.execute(f"PRAGMA mmap_size={DB_MMAP_SIZE}")
+    # triggerهای جستجو به این تابع نیاز دارند؛ هر برنامه‌ی دیگری که محصولات را
+    # تغییر می‌دهد هم باید آن را ثبت کند
+    conn.create_function("fa_normalize", 1, normalize, deterministic=True)
+    return conn
+
+class Database:
+    # هر thread اتصال خودش را دارد تا cursor و commit هندلرهای هم‌زمان قاطی نشوند.
+    # نوشتن‌ها با write_lock سریالی می‌شوند: یک نویسنده، چند خواننده.
+    #
+    # نوشتن‌های پرتعداد و غیرحیاتی (تاریخچه، سبد، ...) با defer در صف می‌روند و هر
+    # flush_interval ثانیه همه با هم در یک تراکنش commit می‌شوند (group commit).
+    # transaction() اول صف را خالی می‌کند تا ترتیب نوشتن‌ها به هم نخورد؛ نوشتنی که باید
+    # قبل از پاسخ به کاربر قطعی شود یا از transaction() استفاده کند یا بعدش flush() بزند.
+
+    def __init__(self, path=DB_NAME, flush_interval=DB_FLUSH_INTERVAL, flush_batch=DB_FLUSH_BATCH):
+        self.path = path
+        self.flush_interval = flush_interval
+        self.flush_batch = flush_batch
+        self.write_lock = threading.RLock()
+        self._local = threading.local()
+        self._pending = []
+        self._pending_cond = threading.Condition()
+        self._unflushed = 0      # نوشتن‌های صف‌شده‌ای که هنوز commit نشده‌اند (در صف یا در حال اجرا)
+        self._flusher = None
+
+    def connection(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = self._local.conn = connect_db(self.path)
+        return conn
+
+    def cursor(self):
+        return self.connection().cursor()
+
+    def commit(self):
+        self.connection().commit()
+
+    def rollback(self):
+        self.connection().rollback()
+
+    @contextmanager
+    def transaction(self):
+        with self.write_lock:
+            self._apply_pending()
+            conn = self.connection()
+            cur = conn.cursor()
+            try:
+                yield cur
+            except:
+                conn.rollback()
+                raise
+            conn.commit()
+
+    # ---------- write-behind ----------
+
+    def defer(self, sql, params=()):
+        with self._pending_cond:
+            self._pending.append((sql, params))
+            self._unflushed += 1
+            if self._flusher is None:
+                self._flusher = threading.Thread(target=self._flush_loop, name="db-flush", daemon=True)
+                self._flusher.start()
+                atexit.register(self.flush)
+            self._pending_cond.notify()
+
+    def flush(self):
+        # هندلرهایی که نوشتن‌های صف‌شده را می‌خوانند قبل از SELECT صدا می‌زنند؛
+        # وقتی چیزی در راه نیست قفل نوشتن گرفته نمی‌شود
+        if not self._unflushed:
+            return
+        with self.write_lock:
+            self._apply_pending()
+
+    def pending(self):
+        with self._pending_cond:
+            return len(self._pending)
+
+    def _flush_loop(self):
+        while True:
+            with self._pending_cond:
+                self._pending_cond.wait_for(lambda: self._pending)
+                # کمی صبر تا نوشتن‌های بیشتری برسند، مگر اینکه صف پر شده باشد
+                self._pending_cond.wait_for(
+                    lambda: len(self._pending) >= self.flush_batch, self.flush_interval
+                )
+            try:
+                self.flush()
+            except Exception:
+                logger.exception("write-behind flush failed")
+
+    def _apply_pending(self):
+        # فقط با write_lock صدا زده می‌شود
+        with self._pending_cond:
+            batch, self._pending = self._pending, []
+        if not batch:
+            return
+        try:
+            self._execute_batch(batch)
+        finally:
+            with self._pending_cond:
+                self._unflushed -= len(batch)
+
+    def _execute_batch(self, batch):
+        conn = self.connection()
+        cur = conn.cursor()
+        try:
+            cur.execute("BEGIN")
+            for sql, params in batch:
+                cur.execute(sql, params)
+            conn.commit()
+            return
+        except sqlite3.Error:
+            conn.rollback()
+            if len(batch) == 1:
+                logger.exception("deferred write failed: %s", batch[0][0])
+                return
+
+        # یک دستور خراب نباید بقیه‌ی دسته را از بین ببرد: تک‌تک دوباره اجرا می‌شوند
+        for sql, params in batch:
+            try:
+                cur.execute(sql, params)
+                conn.commit()
+            except sqlite3.Error:
+                conn.rollback()
+                logger.exception("deferred write failed: %s", sql)
+
+db = Database()
 
 def create_tables():
     cur = db.cursor()
@@ -73,4 +275,281 @@ def create_tables():
     db.commit()
     print("Tables created successfully!")
 
-create_tables()
+    migrate()
+
+# ===================== MIGRATIONS =====================
+# هر مهاجرت فقط یک بار اجرا می‌شود؛ شماره‌ی آخرین مهاجرت در PRAGMA user_version ذخیره می‌شود.
+# مهاجرت جدید را فقط به انتهای لیست اضافه کن و مهاجرت‌های قبلی را تغییر نده.
+
+def migration_1_indexes(cur):
+    # قبل از ساخت ایندکس یکتا، ردیف‌های تکراری «برای بعداً» حذف می‌شوند
+    cur.execute("""
+    DELETE FROM later WHERE id NOT IN (
+        SELECT MIN(id) FROM later GROUP BY user_id, product_id
+    )
+    """)
+    cur.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_later_user_product ON later (user_id, product_id)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_products_seller ON products (seller_id)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_cart_user ON cart (user_id)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_history_user ON history (user_id, id)")
+
+def migration_2_states(cur):
+    # وضعیت گفتگوی هر چت (جایگزین next-step handlerهای درون حافظه)
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS states (
+        chat_id INTEGER PRIMARY KEY,
+        state TEXT NOT NULL,
+        data TEXT NOT NULL,
+        expires_at REAL NOT NULL
+    )
+    """)
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_states_expires ON states (expires_at)")
+
+def migration_3_search(cur):
+    # ایندکس متنی محصولات؛ متن قبل از ایندکس شدن مثل عبارت جستجو یکسان‌سازی می‌شود (ي/ی، ك/ک، ارقام)
+    cur.execute("""
+    CREATE VIRTUAL TABLE IF NOT EXISTS products_fts USING fts5(
+        title, description,
+        tokenize = 'unicode61 remove_diacritics 2'
+    )
+    """)
+    cur.execute("""
+    CREATE TRIGGER IF NOT EXISTS products_fts_insert AFTER INSERT ON products BEGIN
+        INSERT INTO products_fts (rowid, title, description) VALUES (new.id, fa_normalize(new.title), fa_normalize(new.description));
+    END
+    """)
+    cur.execute("""
+    CREATE TRIGGER IF NOT EXISTS products_fts_update AFTER UPDATE OF title, description ON products BEGIN
+        UPDATE products_fts SET title = fa_normalize(new.title), description = fa_normalize(new.description) WHERE rowid = new.id;
+    END
+    """)
+    cur.execute("""
+    CREATE TRIGGER IF NOT EXISTS products_fts_delete AFTER DELETE ON products BEGIN
+        DELETE FROM products_fts WHERE rowid = old.id;
+    END
+    """)
+    cur.execute("""
+    INSERT INTO products_fts (rowid, title, description)
+    SELECT id, fa_normalize(title), fa_normalize(description) FROM products
+    """)
+    # فیلتر بازه‌ی قیمت
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_products_price ON products (price)")
+
+def migration_4_cart_quantity(cur):
+    # ردیف‌های تکراری سبد به یک ردیف با quantity تبدیل می‌شوند (کوچک‌ترین id حفظ می‌شود)
+    cur.execute("""
+    CREATE TABLE cart_new (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER NOT NULL,
+        product_id INTEGER NOT NULL,
+        quantity INTEGER NOT NULL DEFAULT 1 CHECK (quantity > 0),
+        UNIQUE (user_id, product_id)
+    )
+    """)
+    cur.execute("""
+    INSERT INTO cart_new (id, user_id, product_id, quantity)
+    SELECT MIN(id), user_id, product_id, COUNT(*) FROM cart GROUP BY user_id, product_id
+    """)
+    # ایندکس idx_cart_user با جدول قدیمی حذف می‌شود؛ UNIQUE (user_id, ...) جایش را می‌گیرد
+    cur.execute("DROP TABLE cart")
+    cur.execute("ALTER TABLE cart_new RENAME TO cart")
+
+def migration_5_counters(cur):
+    # شمارنده‌های از پیش حساب‌شده؛ triggerها دقیق نگهشان می‌دارند و repair_counters از نو می‌سازدشان
+    cur.execute("ALTER TABLE users ADD COLUMN product_count INTEGER NOT NULL DEFAULT 0")
+    cur.execute("ALTER TABLE products ADD COLUMN contact_count INTEGER NOT NULL DEFAULT 0")
+    cur.execute("ALTER TABLE products ADD COLUMN cart_count INTEGER NOT NULL DEFAULT 0")
+
+    # تعداد محصولات هر فروشنده
+    cur.execute("""
+    CREATE TRIGGER IF NOT EXISTS products_count_insert AFTER INSERT ON products BEGIN
+        UPDATE users SET product_count = product_count + 1 WHERE telegram_id = new.seller_id;
+    END
+    """)
+    cur.execute("""
+    CREATE TRIGGER IF NOT EXISTS products_count_delete AFTER DELETE ON products BEGIN
+        UPDATE users SET product_count = product_count - 1 WHERE telegram_id = old.seller_id;
+    END
+    """)
+    cur.execute("""
+    CREATE TRIGGER IF NOT EXISTS products_count_update AFTER UPDATE OF seller_id ON products BEGIN
+        UPDATE users SET product_count = product_count - 1 WHERE telegram_id = old.seller_id;
+        UPDATE users SET product_count = product_count + 1 WHERE telegram_id = new.seller_id;
+    END
+    """)
+    # کاربری که بن شده و دوباره /start می‌زند محصولات قبلی‌اش هنوز هستند
+    cur.execute("""
+    CREATE TRIGGER IF NOT EXISTS users_count_insert AFTER INSERT ON users BEGIN
+        UPDATE users SET product_count = (SELECT COUNT(*) FROM products WHERE seller_id = new.telegram_id)
+        WHERE telegram_id = new.telegram_id;
+    END
+    """)
+
+    # تعداد پیام به فروشنده برای هر محصول
+    cur.execute("""
+    CREATE TRIGGER IF NOT EXISTS history_count_insert AFTER INSERT ON history BEGIN
+        UPDATE products SET contact_count = contact_count + 1 WHERE id = new.product_id;
+    END
+    """)
+    cur.execute("""
+    CREATE TRIGGER IF NOT EXISTS history_count_delete AFTER DELETE ON history BEGIN
+        UPDATE products SET contact_count = contact_count - 1 WHERE id = old.product_id;
+    END
+    """)
+
+    # تعداد کل این محصول در سبدها (جمع quantity)
+    cur.execute("""
+    CREATE TRIGGER IF NOT EXISTS cart_count_insert AFTER INSERT ON cart BEGIN
+        UPDATE products SET cart_count = cart_count + new.quantity WHERE id = new.product_id;
+    END
+    """)
+    cur.execute("""
+    CREATE TRIGGER IF NOT EXISTS cart_count_delete AFTER DELETE ON cart BEGIN
+        UPDATE products SET cart_count = cart_count - old.quantity WHERE id = old.product_id;
+    END
+    """)
+    cur.execute("""
+    CREATE TRIGGER IF NOT EXISTS cart_count_update AFTER UPDATE OF quantity, product_id ON cart BEGIN
+        UPDATE products SET cart_count = cart_count - old.quantity WHERE id = old.product_id;
+        UPDATE products SET cart_count = cart_count + new.quantity WHERE id = new.product_id;
+    END
+    """)
+
+    repair_counters(cur)
+
+def migration_6_collages(cur):
+    # عکس‌های دانلودشده‌ی محصولات (محتوا روی دیسک با نام sha256) و کولاژهای ارسال‌شده
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS photo_files (
+        file_id TEXT PRIMARY KEY,
+        digest TEXT NOT NULL,
+        size INTEGER NOT NULL,
+        used_at REAL NOT NULL
+    )
+    """)
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_photo_files_digest ON photo_files (digest)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_photo_files_used ON photo_files (used_at)")
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS collages (
+        key TEXT PRIMARY KEY,
+        file_id TEXT NOT NULL,
+        created_at REAL NOT NULL
+    )
+    """)
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_collages_created ON collages (created_at)")
+
+def migration_7_history_rollups(cur):
+    # جمع روزانه‌ی سطرهای آرشیوشده‌ی history (retention.py) و اندازه‌ی commit‌شده‌ی فایل‌های آرشیو
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS history_daily_product (
+        product_id INTEGER NOT NULL,
+        day TEXT NOT NULL,
+        seller_id INTEGER,
+        contacts INTEGER NOT NULL,
+        PRIMARY KEY (product_id, day)
+    )
+    """)
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS history_daily_seller (
+        seller_id INTEGER NOT NULL,
+        day TEXT NOT NULL,
+        contacts INTEGER NOT NULL,
+        PRIMARY KEY (seller_id, day)
+    )
+    """)
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS history_archive_files (
+        name TEXT PRIMARY KEY,
+        size INTEGER NOT NULL
+    )
+    """)
+    # contact_count شمارش کل است؛ آرشیو شدن سطرها نباید کمش کند (repair_counters جمع روزانه را هم می‌شمارد)
+    cur.execute("DROP TRIGGER IF EXISTS history_count_delete")
+
+def migration_8_leases(cur):
+    # قفل کارهای دوره‌ای بین پروسه‌ها (مثلاً نگهداری تاریخچه)؛ صاحب lease تا expires_at آن را دارد
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS leases (
+        name TEXT PRIMARY KEY,
+        owner TEXT NOT NULL,
+        expires_at REAL NOT NULL
+    )
+    """)
+
+MIGRATIONS = [
+    migration_1_indexes,
+    migration_2_states,
+    migration_3_search,
+    migration_4_cart_quantity,
+    migration_5_counters,
+    migration_6_collages,
+    migration_7_history_rollups,
+    migration_8_leases,
+]
+
+def repair_counters(cur):
+    # همه‌ی شمارنده‌ها را از روی جدول‌های اصلی از نو حساب می‌کند؛ هر جدول با یک GROUP BY
+    # (نه یک COUNT جدا برای هر سطر). خروجی: تعداد سطرهایی که مقدارشان غلط بود.
+    # contact_count = سطرهای history + جمع روزانه‌ی سطرهای آرشیوشده (از migration 7 به بعد)
+    archived = ""
+    if cur.execute("SELECT 1 FROM sqlite_master WHERE name='history_daily_product'").fetchone():
+        archived = "UNION ALL SELECT product_id, SUM(contacts) FROM history_daily_product GROUP BY product_id"
+    cur.execute(f"""
+    CREATE TEMP TABLE counters_fix AS
+    SELECT 'user' AS kind, u.telegram_id AS id, COALESCE(p.n, 0) AS a, 0 AS b
+    FROM users u LEFT JOIN (
+        SELECT seller_id, COUNT(*) AS n FROM products GROUP BY seller_id
+    ) p ON p.seller_id = u.telegram_id
+    WHERE u.product_count IS NOT COALESCE(p.n, 0)
+    UNION ALL
+    SELECT 'product', p.id, COALESCE(h.n, 0), COALESCE(c.n, 0)
+    FROM products p
+    LEFT JOIN (
+        SELECT product_id, SUM(n) AS n FROM (
+            SELECT product_id, COUNT(*) AS n FROM history GROUP BY product_id
+            {archived}
+        ) GROUP BY product_id
+    ) h ON h.product_id = p.id
+    LEFT JOIN (SELECT product_id, SUM(quantity) AS n FROM cart GROUP BY product_id) c ON c.product_id = p.id
+    WHERE p.contact_count IS NOT COALESCE(h.n, 0) OR p.cart_count IS NOT COALESCE(c.n, 0)
+    """)
+    cur.execute("""
+    UPDATE users SET product_count = f.a
+    FROM temp.counters_fix f WHERE f.kind = 'user' AND f.id = users.telegram_id
+    """)
+    cur.execute("""
+    UPDATE products SET contact_count = f.a, cart_count = f.b
+    FROM temp.counters_fix f WHERE f.kind = 'product' AND f.id = products.id
+    """)
+    fixed = cur.execute("SELECT COUNT(*) FROM temp.counters_fix").fetchone()[0]
+    cur.execute("DROP TABLE temp.counters_fix")
+    return fixed
+
+def migrate():
+    cur = db.cursor()
+    version = cur.execute("PRAGMA user_version").fetchone()[0]
+
+    for number, migration in enumerate(MIGRATIONS[version:], version + 1):
+        with db.write_lock:
+            cur.execute("BEGIN")
+            try:
+                migration(cur)
+                cur.execute(f"PRAGMA user_version = {number}")
+            except:
+                db.rollback()
+                raise
+            db.commit()
+        print(f"Database migrated to version {number}")
+
+    if version < len(MIGRATIONS):
+        # آمار جدید برای انتخاب ایندکس‌ها توسط planner
+        cur.execute("ANALYZE")
+        db.commit()
+
+def ensure_schema():
+    # در حالت عادی فقط یک PRAGMA خوانده می‌شود؛ DDL و مهاجرت‌ها فقط برای دیتابیس جدید یا قدیمی اجرا می‌شوند
+    version = db.cursor().execute("PRAGMA user_version").fetchone()[0]
+    if version == len(MIGRATIONS):
+        return False
+    create_tables()
+    return True
@@ -0,0 +1,141 @@
+import argparse
+import csv
+import gzip
+import io
+import json
+import logging
+import sys
+import tempfile
+import time
+
+from jobs import BackgroundJobs
+from metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+# خروجی جدول‌ها برای ادمین (/export) به صورت CSV یا JSONL فشرده با gzip:
+# - همه‌ی جدول‌های یک درخواست در یک تراکنش خواندنی روی اتصال جداگانه خوانده می‌شوند؛
+#   در WAL این یک snapshot ثابت است و نوشتن‌های هم‌زمان هندلرها را نگه نمی‌دارد
+# - سطرها با fetchmany دسته‌ای خوانده و مستقیم در فایل gzip موقت روی دیسک نوشته می‌شوند؛
+#   حافظه به اندازه‌ی جدول بستگی ندارد
+#
+#   python exporter.py products --format jsonl -o products.jsonl.gz   # همین کار از خط فرمان
+
+TABLES = ("users", "products", "cart", "history", "history_daily_product", "history_daily_seller")
+FORMATS = ("csv", "jsonl")
+
+# فشرده‌سازی بیشتر وقت خروجی را می‌گیرد؛ سطح ۱ دو برابر سطح ۶ سریع‌تر و فقط حدود ۲۰٪ بزرگ‌تر است
+COMPRESS_LEVEL = 1
+
+def export_table(conn, table, fmt, out, batch=1000):
+    # out: فایل باینری؛ خروجی تعداد سطرها. conn باید از قبل داخل تراکنش باشد تا snapshot ثابت بماند
+    if table not in TABLES:
+        raise ValueError(f"unknown table {table!r}")
+    cur = conn.execute(f"SELECT * FROM {table} ORDER BY rowid")
+    columns = [d[0] for d in cur.description]
+
+    rows = 0
+    with gzip.GzipFile(fileobj=out, mode="wb", compresslevel=COMPRESS_LEVEL) as gz:
+        # BOM برای باز شدن درست فارسی در Excel
+        text = io.TextIOWrapper(gz, encoding="utf-8-sig" if fmt == "csv" else "utf-8", newline="")
+        writer = csv.writer(text) if fmt == "csv" else None
+        encode = json.JSONEncoder(ensure_ascii=False).encode
+        if writer:
+            writer.writerow(columns)
+        while True:
+            chunk = cur.fetchmany(batch)
+            if not chunk:
+                break
+            if writer:
+                writer.writerows(chunk)
+            else:
+                text.writelines(encode(dict(zip(columns, row))) + "\n" for row in chunk)
+            rows += len(chunk)
+        text.flush()
+        # TextIOWrapper بسته نمی‌شود تا GzipFile و out را نبندد
+        text.detach()
+    return rows
+
+def snapshot(connect):
+    # اتصال جدا با یک تراکنش خواندنی باز؛ اولین SELECT، snapshot را ثابت می‌کند
+    conn = connect()
+    conn.execute("BEGIN")
+    return conn
+
+# ===================== BACKGROUND RUNNER =====================
+
+class Exporter:
+    # خروجی روی thread جدا (BackgroundJobs) ساخته و به صورت document فرستاده می‌شود؛
+    # حداکثر workers خروجی هم‌زمان و برای هر کاربر فقط یکی
+    def __init__(self, connect, api, batch=1000, max_bytes=50 * 1024 * 1024, workers=1):
+        self.connect = connect
+        self.api = api
+        self.batch = batch
+        self.max_bytes = max_bytes
+        self.jobs = BackgroundJobs("export", workers)
+
+    def start(self, chat_id, user_id, tables, fmt):
+        return self.jobs.start(user_id, self._run, chat_id, tables, fmt)
+
+    def _run(self, chat_id, tables, fmt):
+        try:
+            with self.jobs.slot:
+                self._export(chat_id, tables, fmt)
+        except Exception:
+            self.api.send_message(chat_id, "ساخت خروجی به خاطر خطای داخلی متوقف شد.", parse_mode="")
+            raise
+
+    def _export(self, chat_id, tables, fmt):
+        stamp = time.strftime("%Y%m%d-%H%M%S")
+        conn = snapshot(self.connect)
+        try:
+            for table in tables:
+                out = tempfile.TemporaryFile()
+                start = time.perf_counter()
+                rows = export_table(conn, table, fmt, out, self.batch)
+                metrics.observe("bot_export_seconds", time.perf_counter() - start, table=table)
+                metrics.inc("bot_export_rows_total", rows, table=table)
+
+                size = out.tell()
+                if size > self.max_bytes:
+                    out.close()
+                    # محدودیت آپلود document برای ربات‌ها در Bot API
+                    self.api.send_message(
+                        chat_id, f"{table}: خروجی ({size // (1024 * 1024)} مگابایت) از سقف ارسال تلگرام بزرگ‌تر است.",
+                        parse_mode=""
+                    )
+                    continue
+                out.seek(0)
+                future = self.api.send_document(
+                    chat_id, out, visible_file_name=f"{table}-{stamp}.{fmt}.gz",
+                    caption=f"{table}: {rows} سطر", parse_mode=""
+                )
+                future.add_done_callback(lambda f, out=out: out.close())
+        finally:
+            conn.rollback()
+            conn.close()
+
+# ===================== CLI =====================
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Export a table as gzip-compressed CSV or JSONL")
+    parser.add_argument("table", choices=TABLES)
+    parser.add_argument("--format", choices=FORMATS, default="csv")
+    parser.add_argument("-o", "--output", help="default: <table>.<format>.gz")
+    parser.add_argument("--batch", type=int, default=1000)
+    args = parser.parse_args(argv)
+
+    from database import connect_db
+
+    path = args.output or f"{args.table}.{args.format}.gz"
+    conn = snapshot(connect_db)
+    try:
+        with open(path, "wb") as out:
+            rows = export_table(conn, args.table, args.format, out, args.batch)
+    finally:
+        conn.rollback()
+        conn.close()
+    print(f"{rows} rows -> {path}", file=sys.stderr)
+
+if __name__ == "__main__":
+    main()
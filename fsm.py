@@ -0,0 +1,65 @@
+import json
+import time
+
+# وضعیت گفتگوی هر چت (مثلاً مرحله‌ی ثبت محصول) به جای closureهای next-step در حافظه،
+# در جدول states ذخیره می‌شود: بعد از ری‌استارت باقی می‌ماند، بین چند پروسه مشترک است
+# و گفتگوهای نیمه‌کاره بعد از ttl ثانیه پاک می‌شوند.
+#
+# هر state همان نام تابع هندلر مرحله است و data آرگومان‌های آن (باید JSON-پذیر باشند).
+
+class StateStore:
+    def __init__(self, db, ttl=3600, cleanup_interval=300):
+        self.db = db
+        self.ttl = ttl
+        self.cleanup_interval = cleanup_interval
+        self.handlers = {}
+        self._next_cleanup = 0
+
+    def step(self, handler):
+        self.handlers[handler.__name__] = handler
+        return handler
+
+    def set(self, chat_id, handler, **data):
+        with self.db.transaction() as cur:
+            cur.execute(
+                "INSERT OR REPLACE INTO states (chat_id, state, data, expires_at) VALUES (?, ?, ?, ?)",
+                (chat_id, handler.__name__, json.dumps(data), time.time() + self.ttl)
+            )
+
+    def clear(self, chat_id):
+        with self.db.transaction() as cur:
+            cur.execute("DELETE FROM states WHERE chat_id=?", (chat_id,))
+
+    def consume(self, chat_id):
+        # مثل next-step handlerهای telebot: state بعد از یک بار استفاده حذف می‌شود
+        # و هندلر اگر مرحله‌ی بعدی دارد دوباره set می‌کند
+        now = time.time()
+        if now >= self._next_cleanup:
+            self._next_cleanup = now + self.cleanup_interval
+            self.cleanup(now)
+
+        # بیشتر پیام‌ها state ندارند؛ بررسی بدون قفل نوشتن انجام می‌شود
+        cur = self.db.cursor()
+        if not cur.execute(
+            "SELECT 1 FROM states WHERE chat_id=? AND expires_at > ?", (chat_id, now)
+        ).fetchone():
+            return None
+
+        # خواندن و حذف در یک دستور: از دو پیام هم‌زمان یک چت فقط یکی state را می‌گیرد
+        with self.db.transaction() as cur:
+            row = cur.execute(
+                "DELETE FROM states WHERE chat_id=? AND expires_at > ? RETURNING state, data",
+                (chat_id, now)
+            ).fetchone()
+        if not row:
+            return None
+
+        state, data = row
+        handler = self.handlers.get(state)
+        if handler is None:
+            return None
+        return handler, json.loads(data)
+
+    def cleanup(self, now=None):
+        with self.db.transaction() as cur:
+            cur.execute("DELETE FROM states WHERE expires_at <= ?", (now or time.time(),))
@@ -0,0 +1,383 @@
+import argparse
+import csv
+import io
+import json
+import logging
+import os
+import re
+import sys
+import tempfile
+import time
+from contextlib import closing
+
+from jobs import BackgroundJobs
+from metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+# ورود گروهی محصولات از یک فایل CSV (با سرستون) یا JSONL (هر خط یک شیء JSON) با ستون‌های
+#   title, description, price, photo   و seller_id (فقط ادمین می‌تواند برای فروشنده‌ی دیگری ثبت کند)
+#
+# - فایل سطر به سطر از تلگرام دانلود و پردازش می‌شود؛ حافظه به اندازه‌ی فایل بستگی ندارد
+# - سطرهای معتبر با executemany در تراکنش‌های chunk تایی ثبت می‌شوند تا قفل نوشتن
+#   بین ورود و هندلرهای دیگر تقسیم شود
+# - پیشرفت با ویرایش یک پیام وضعیت نشان داده می‌شود؛ سطرهای نامعتبر در یک CSV روی دیسک
+#   جمع و آخر کار فرستاده می‌شوند
+#
+#   python importer.py products.csv --seller 123     # همین کار از خط فرمان
+
+# caption کارت محصول (عنوان + توضیحات + قیمت + فروشنده) باید زیر ۱۰۲۴ کاراکتر تلگرام بماند
+MAX_TITLE = 200
+MAX_DESCRIPTION = 700
+MAX_PRICE = 10 ** 12
+MAX_LINE = 64 * 1024           # طولانی‌ترین خط JSONL؛ بیشتر از آن خوانده نمی‌شود
+MAX_REPORT_CHARS = 300         # مقدار سطر در گزارش خطا کوتاه می‌شود
+
+# فقط file_id تلگرام: نتایج inline (InlineQueryResultCachedPhoto) و PhotoCache کولاژ
+# به file_id نیاز دارند و با آدرس http کار نمی‌کنند
+_PHOTO = re.compile(r"[\w-]{20,}", re.ASCII)
+
+INSERT_PRODUCT = "INSERT INTO products (seller_id, title, description, price, photo) VALUES (?, ?, ?, ?, ?)"
+
+class RowError(ValueError):
+    pass
+
+class ImportAborted(Exception):
+    pass
+
+# ===================== PARSING =====================
+
+def detect_format(file_name, mime_type=None):
+    ext = os.path.splitext(file_name or "")[1].lower()
+    if ext == ".csv" or mime_type in ("text/csv", "application/csv"):
+        return "csv"
+    if ext in (".jsonl", ".ndjson", ".json") or mime_type in ("application/jsonl", "application/x-ndjson"):
+        return "jsonl"
+    return None
+
+def _lines(stream):
+    # مثل iter(stream) ولی خط بیشتر از MAX_LINE به جای خوانده شدن کامل None برمی‌گرداند
+    while True:
+        line = stream.readline(MAX_LINE)
+        if not line:
+            return
+        if len(line) == MAX_LINE and not line.endswith("\n"):
+            while True:
+                rest = stream.readline(MAX_LINE)
+                if not rest or rest.endswith("\n"):
+                    break
+            yield None
+            continue
+        yield line
+
+def read_rows(stream, fmt):
+    # (شماره‌ی خط، dict یا RowError)؛ stream متنی است
+    if fmt == "jsonl":
+        for number, line in enumerate(_lines(stream), 1):
+            if line is None:
+                yield number, RowError("خط خیلی طولانی است")
+                continue
+            if not line.strip():
+                continue
+            try:
+                row = json.loads(line)
+            except ValueError:
+                yield number, RowError("JSON نامعتبر")
+                continue
+            yield number, row
+        return
+
+    reader = csv.reader(stream)
+    header = None
+    while True:
+        try:
+            values = next(reader)
+        except StopIteration:
+            return
+        except csv.Error as e:
+            yield reader.line_num, RowError(f"CSV نامعتبر: {e}")
+            continue
+        if not any(v.strip() for v in values):
+            continue
+        if header is None:
+            header = [name.strip().lower() for name in values]
+            if "title" not in header:
+                raise ImportAborted("سطر اول CSV باید سرستون‌ها (title, description, price, photo) باشد")
+            continue
+        if len(values) > len(header):
+            yield reader.line_num, RowError("تعداد ستون‌ها بیشتر از سرستون است")
+            continue
+        yield reader.line_num, dict(zip(header, values))
+
+# ===================== VALIDATION =====================
+
+def _text(value):
+    if value is None:
+        return ""
+    if not isinstance(value, str):
+        raise RowError("مقدار متنی نیست")
+    return value.strip()
+
+def _price(value):
+    if isinstance(value, bool):
+        raise RowError("قیمت نامعتبر است")
+    if isinstance(value, float) and value.is_integer():
+        value = int(value)
+    if isinstance(value, str):
+        try:
+            # int ارقام فارسی را هم می‌پذیرد؛ جداکننده‌ی هزارگان حذف می‌شود
+            value = int(value.strip().replace(",", "").replace("٬", ""))
+        except ValueError:
+            raise RowError("قیمت باید عدد صحیح باشد") from None
+    if not isinstance(value, int):
+        raise RowError("قیمت باید عدد صحیح باشد")
+    if not 0 <= value <= MAX_PRICE:
+        raise RowError("قیمت خارج از محدوده است")
+    return value
+
+def clean_row(row, seller_id, any_seller=None):
+    # خروجی: پارامترهای INSERT_PRODUCT. seller_id فروشنده‌ی پیش‌فرض است (None = ستون لازم است)؛
+    # any_seller(uid) فقط برای ادمین داده می‌شود و فروشنده بودن seller_id هر سطر را چک می‌کند
+    if not isinstance(row, dict):
+        raise RowError("سطر باید یک شیء با ستون‌های محصول باشد")
+
+    title = _text(row.get("title"))
+    if not title:
+        raise RowError("عنوان خالی است")
+    if len(title) > MAX_TITLE:
+        raise RowError(f"عنوان بیشتر از {MAX_TITLE} کاراکتر است")
+
+    desc = _text(row.get("description"))
+    if len(desc) > MAX_DESCRIPTION:
+        raise RowError(f"توضیحات بیشتر از {MAX_DESCRIPTION} کاراکتر است")
+
+    price = _price(row.get("price"))
+
+    photo = _text(row.get("photo"))
+    if not _PHOTO.fullmatch(photo):
+        raise RowError("photo باید file_id عکسی در تلگرام باشد (آدرس اینترنتی پذیرفته نمی‌شود)")
+
+    owner = row.get("seller_id")
+    if owner not in (None, ""):
+        try:
+            owner = int(owner)
+        except (TypeError, ValueError):
+            raise RowError("seller_id نامعتبر است") from None
+        if owner != seller_id:
+            if any_seller is None:
+                raise RowError("فقط ادمین می‌تواند برای فروشنده‌ی دیگری محصول ثبت کند")
+            if not any_seller(owner):
+                raise RowError(f"کاربر {owner} فروشنده نیست")
+    elif seller_id is None:
+        raise RowError("ستون seller_id لازم است")
+    else:
+        owner = seller_id
+
+    return owner, title, desc, price, photo
+
+# ===================== IMPORT =====================
+
+class CountingReader(io.RawIOBase):
+    # بایت‌های خوانده‌شده از فایل (برای درصد پیشرفت)
+    def __init__(self, raw):
+        self.raw = raw
+        self.count = 0
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        n = self.raw.readinto(buffer)
+        self.count += n or 0
+        return n
+
+class ImportJob:
+    def __init__(self, db, seller_id, admin=False, chunk=500, max_rows=20000, report=None, progress=None):
+        self.db = db
+        self.seller_id = seller_id
+        self.admin = admin
+        self.chunk = chunk
+        self.max_rows = max_rows
+        self.progress = progress
+        self.imported = 0
+        self.failed = 0
+        self.line = 0
+        self._report = csv.writer(report) if report is not None else None
+        if self._report:
+            self._report.writerow(["line", "error", "row"])
+
+    def is_seller(self, user_id):
+        row = self.db.cursor().execute("SELECT role FROM users WHERE telegram_id=?", (user_id,)).fetchone()
+        return bool(row) and row[0] == "seller"
+
+    def run(self, stream, fmt):
+        any_seller = self.is_seller if self.admin else None
+        batch = []
+        for number, row in read_rows(stream, fmt):
+            self.line = number
+            if self.imported + len(batch) >= self.max_rows:
+                self._insert(batch)
+                raise ImportAborted(f"حداکثر {self.max_rows} محصول در هر فایل")
+            try:
+                if isinstance(row, RowError):
+                    raise row
+                batch.append(clean_row(row, self.seller_id, any_seller))
+            except RowError as e:
+                self._error(number, e, row)
+                continue
+
+            if len(batch) >= self.chunk:
+                self._insert(batch)
+        self._insert(batch)
+
+    def _insert(self, batch):
+        if batch:
+            with self.db.transaction() as cur:
+                cur.executemany(INSERT_PRODUCT, batch)
+            self.imported += len(batch)
+            metrics.inc("bot_import_rows_total", len(batch), result="imported")
+            batch.clear()
+        if self.progress:
+            self.progress(self)
+
+    def _error(self, number, error, row):
+        self.failed += 1
+        metrics.inc("bot_import_rows_total", result="failed")
+        if self._report:
+            raw = "" if isinstance(row, RowError) else json.dumps(row, ensure_ascii=False)
+            self._report.writerow([number, str(error), raw[:MAX_REPORT_CHARS]])
+
+# ===================== BACKGROUND RUNNER =====================
+
+def telegram_opener(bot):
+    # open_file برای Importer: فایل از سرور تلگرام به صورت stream (بدون نگه داشتن کل آن) خوانده می‌شود
+    def open_file(file_id):
+        import requests
+        from telebot import apihelper
+
+        url = apihelper.get_file_url(bot.token, file_id)
+        response = requests.get(url, stream=True, timeout=(10, 60), proxies=apihelper.proxy)
+        response.raise_for_status()
+        response.raw.decode_content = True
+        return response.raw
+    return open_file
+
+class Importer:
+    # هر ورود روی thread جدای خودش اجرا می‌شود (BackgroundJobs)؛
+    # حداکثر workers ورود هم‌زمان و برای هر کاربر فقط یکی
+    def __init__(self, db, api, open_file, chunk=500, max_rows=20000, workers=2, progress_interval=3):
+        self.db = db
+        self.api = api
+        self.open_file = open_file
+        self.chunk = chunk
+        self.max_rows = max_rows
+        self.progress_interval = progress_interval
+        self.jobs = BackgroundJobs("import", workers)
+
+    def start(self, chat_id, user_id, file_id, file_name, file_size, fmt, admin=False, seller=True):
+        return self.jobs.start(
+            user_id, self._run, chat_id, user_id, file_id, file_name, file_size, fmt, admin, seller
+        )
+
+    def _run(self, chat_id, user_id, file_id, file_name, file_size, fmt, admin, seller):
+        status = None
+        try:
+            status = self._send_status(chat_id, f"📥 {file_name}: در صف ورود…")
+            with self.jobs.slot:
+                self._import(chat_id, user_id, file_id, file_name, file_size, fmt, admin, seller, status)
+        except Exception:
+            self._update(chat_id, status, f"📥 {file_name}: ورود به خاطر خطای داخلی متوقف شد.")
+            raise
+
+    def _import(self, chat_id, user_id, file_id, file_name, file_size, fmt, admin, seller, status):
+        last = [time.monotonic()]
+
+        def progress(job):
+            now = time.monotonic()
+            if now - last[0] >= self.progress_interval:
+                last[0] = now
+                percent = min(99, counter.count * 100 // file_size) if file_size else 0
+                self._update(chat_id, status, f"📥 {file_name}: {percent}٪\n{self._counts(job)}")
+
+        # گزارش خطا روی دیسک نوشته می‌شود؛ BOM برای باز شدن درست فارسی در Excel
+        report = tempfile.TemporaryFile("w+", encoding="utf-8-sig", newline="")
+        job = ImportJob(
+            self.db, user_id if seller else None, admin=admin,
+            chunk=self.chunk, max_rows=self.max_rows, report=report, progress=progress
+        )
+        note = ""
+        try:
+            with closing(self.open_file(file_id)) as raw:
+                counter = CountingReader(raw)
+                text = io.TextIOWrapper(io.BufferedReader(counter, 64 * 1024), encoding="utf-8-sig", newline="")
+                job.run(text, fmt)
+        except ImportAborted as e:
+            note = f"\n⚠️ {e}؛ بقیه‌ی فایل خوانده نشد."
+        except UnicodeDecodeError:
+            note = f"\n⚠️ فایل باید UTF-8 باشد؛ ورود در خط {job.line + 1} متوقف شد."
+
+        self._update(chat_id, status, f"📥 {file_name}: تمام شد ✔️\n{self._counts(job)}{note}")
+        if not job.failed:
+            report.close()
+            return
+        report.flush()
+        report.seek(0)
+        future = self.api.send_document(
+            chat_id, report.buffer, visible_file_name="import_errors.csv",
+            caption=f"{job.failed} سطر نامعتبر"
+        )
+        future.add_done_callback(lambda f: report.close())
+
+    def _counts(self, job):
+        return f"✔️ {job.imported} محصول ثبت شد\n❌ {job.failed} سطر نامعتبر"
+
+    def _send_status(self, chat_id, text):
+        try:
+            return self.api.send_message(chat_id, text, parse_mode="").result(timeout=60).message_id
+        except Exception:
+            # بدون پیام وضعیت هم ورود انجام و نتیجه آخر کار فرستاده می‌شود
+            logger.warning("could not send import status to %s", chat_id, exc_info=True)
+            return None
+
+    def _update(self, chat_id, message_id, text):
+        # متن ساده (parse_mode خالی)؛ نام فایل ممکن است _ یا * داشته باشد و Markdown را خراب کند
+        if message_id is None:
+            self.api.send_message(chat_id, text, parse_mode="")
+        else:
+            self.api.edit_message_text(text, chat_id=chat_id, message_id=message_id, parse_mode="")
+
+# ===================== CLI =====================
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Bulk-import products from a CSV or JSONL file")
+    parser.add_argument("path")
+    parser.add_argument("--seller", type=int, help="default seller_id for rows without one")
+    parser.add_argument("--format", choices=("csv", "jsonl"))
+    parser.add_argument("--report", help="write rejected rows to this CSV file")
+    parser.add_argument("--chunk", type=int, default=500)
+    parser.add_argument("--max-rows", type=int, default=10 ** 9)
+    args = parser.parse_args(argv)
+
+    from database import db, ensure_schema
+
+    fmt = args.format or detect_format(args.path)
+    if fmt is None:
+        sys.exit("unknown file format, pass --format")
+    ensure_schema()
+
+    report = open(args.report, "w", encoding="utf-8-sig", newline="") if args.report else None
+    # از خط فرمان seller_id هر سطر هم پذیرفته می‌شود (مثل ادمین)
+    job = ImportJob(db, args.seller, admin=True, chunk=args.chunk, max_rows=args.max_rows, report=report)
+    try:
+        with open(args.path, encoding="utf-8-sig", newline="") as f:
+            job.run(f, fmt)
+    except ImportAborted as e:
+        print(e, file=sys.stderr)
+    finally:
+        if report:
+            report.close()
+        db.flush()
+    print(f"{job.imported} imported, {job.failed} rejected")
+
+if __name__ == "__main__":
+    main()
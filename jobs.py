@@ -0,0 +1,36 @@
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+class BackgroundJobs:
+    # کارهای طولانی (ورود و خروجی گروهی) روی thread جدای خودشان اجرا می‌شوند تا هندلرها
+    # منتظر نمانند؛ برای هر کاربر فقط یک کار در جریان است و بخش سنگین هر کار داخل
+    # `with jobs.slot` اجرا می‌شود تا حداکثر workers کار هم‌زمان باشد.
+
+    def __init__(self, name, workers=1):
+        self.name = name
+        self.slot = threading.BoundedSemaphore(workers)
+        self._active = set()
+        self._lock = threading.Lock()
+
+    def start(self, user_id, target, *args):
+        # خروجی False یعنی کار دیگری از همین کاربر هنوز تمام نشده است
+        with self._lock:
+            if user_id in self._active:
+                return False
+            self._active.add(user_id)
+        threading.Thread(
+            target=self._run, args=(user_id, target, args), name=f"{self.name}-{user_id}", daemon=True
+        ).start()
+        return True
+
+    def _run(self, user_id, target, args):
+        try:
+            target(*args)
+        except Exception:
+            # target خودش کاربر را از خطا باخبر می‌کند و دوباره raise می‌کند
+            logger.exception("%s for %s failed", self.name, user_id)
+        finally:
+            with self._lock:
+                self._active.discard(user_id)
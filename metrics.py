@@ -0,0 +1,213 @@
+import bisect
+import logging
+import sys
+import threading
+
+logger = logging.getLogger(__name__)
+
+# متریک‌های درون‌پروسه‌ای با خروجی متنی Prometheus:
+# - histogram زمان هر هندلر، هر دستور SQL و هر متد API تلگرام
+# - شمارنده‌ی خطاها (شامل خطاهایی که هندلرها با except: می‌بلعند)
+# - gaugeهایی مثل عمق صف‌ها که هنگام scrape از یک تابع خوانده می‌شوند
+#
+# ثبت هر مقدار یک جستجوی dict و یک bisect زیر قفل است؛ برای روشن ماندن در production کافی است.
+
+# ثانیه؛ از زیر میلی‌ثانیه (SQLite) تا چند ثانیه (HTTP تلگرام)
+LATENCY_BUCKETS = (
+    0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025,
+    0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0,
+)
+
+class Histogram:
+    __slots__ = ("buckets", "counts", "count", "total", "worst", "_lock")
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)   # آخری: بیشتر از بزرگ‌ترین bucket
+        self.count = 0
+        self.total = 0.0
+        self.worst = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[i] += 1
+            self.count += 1
+            self.total += value
+            if value > self.worst:
+                self.worst = value
+
+    def snapshot(self):
+        with self._lock:
+            return list(self.counts), self.count, self.total, self.worst
+
+class Registry:
+    def __init__(self):
+        self._histograms = {}
+        self._counters = {}
+        self._gauges = {}
+        self._help = {}
+        self._lock = threading.Lock()
+
+    def describe(self, name, kind, text):
+        self._help[name] = (kind, text)
+
+    # ---------- recording ----------
+
+    def histogram(self, name, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        hist = self._histograms.get(key)
+        if hist is None:
+            with self._lock:
+                hist = self._histograms.setdefault(key, Histogram())
+        return hist
+
+    def observe(self, name, value, **labels):
+        self.histogram(name, **labels).observe(value)
+
+    def inc(self, name, amount=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + amount
+
+    def gauge(self, name, fn, text="", kind="gauge", **labels):
+        # fn هنگام scrape صدا زده می‌شود (مثلاً outbox.depth)؛ kind="counter" برای شمارنده‌هایی
+        # که خود شیء نگه می‌دارد (مثلاً outbox.sent)
+        if text:
+            self.describe(name, kind, text)
+        with self._lock:
+            self._gauges[(name, tuple(sorted(labels.items())))] = fn
+
+    def swallowed(self):
+        # داخل except: صدا زده می‌شود تا خطاهایی که به کاربر فقط «نامعتبر است» نشان می‌دهند گم نشوند
+        error = sys.exc_info()[0]
+        self.inc(
+            "bot_swallowed_errors_total",
+            handler=current_handler() or "",
+            type=error.__name__ if error else ""
+        )
+
+    # ---------- reading ----------
+
+    def histograms(self, name):
+        # {labels: (count, total, worst)} برای استفاده‌ی داخلی (مثلاً router.stats)
+        with self._lock:
+            items = [(labels, hist) for (n, labels), hist in self._histograms.items() if n == name]
+        return {labels: hist.snapshot()[1:] for labels, hist in items}
+
+    def render(self):
+        with self._lock:
+            histograms = list(self._histograms.items())
+            counters = list(self._counters.items())
+            gauges = list(self._gauges.items())
+
+        families = {}
+        for (name, labels), hist in histograms:
+            counts, count, total, _ = hist.snapshot()
+            lines = families.setdefault((name, "histogram"), [])
+            cumulative = 0
+            for bound, n in zip(hist.buckets + (float("inf"),), counts):
+                cumulative += n
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                lines.append(f"{name}_bucket{_labels(labels + (('le', le),))} {cumulative}")
+            lines.append(f"{name}_sum{_labels(labels)} {total}")
+            lines.append(f"{name}_count{_labels(labels)} {count}")
+        for (name, labels), value in counters:
+            families.setdefault((name, "counter"), []).append(f"{name}{_labels(labels)} {value}")
+        for (name, labels), fn in gauges:
+            try:
+                value = fn()
+            except Exception:
+                logger.exception("metric %s failed", name)
+                continue
+            kind = self._help.get(name, ("gauge",))[0]
+            families.setdefault((name, kind), []).append(f"{name}{_labels(labels)} {value}")
+
+        out = []
+        for (name, kind), lines in sorted(families.items()):
+            text = self._help.get(name, (kind, ""))[1]
+            if text:
+                out.append(f"# HELP {name} {text}")
+            out.append(f"# TYPE {name} {kind}")
+            out.extend(lines)
+        return "\n".join(out) + "\n"
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def _labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{k}="{_escape(v)}"' for k, v in labels) + "}"
+
+# ===================== CURRENT HANDLER =====================
+# router.dispatch نام هندلر در حال اجرا را اینجا می‌گذارد تا خطاها (و لاگ‌های دیتابیس)
+# بدانند از کدام هندلر آمده‌اند
+
+_context = threading.local()
+
+def current_handler():
+    return getattr(_context, "handler", None)
+
+def set_current_handler(name):
+    previous = getattr(_context, "handler", None)
+    _context.handler = name
+    return previous
+
+metrics = Registry()
+metrics.describe("bot_handler_seconds", "histogram", "Handler latency")
+metrics.describe("bot_handler_errors_total", "counter", "Exceptions raised by handlers")
+metrics.describe("bot_swallowed_errors_total", "counter", "Exceptions caught by bare except in handlers")
+metrics.describe("bot_db_seconds", "histogram", "SQLite statement latency by operation and table")
+metrics.describe("bot_db_errors_total", "counter", "Failed SQLite statements")
+metrics.describe("bot_api_seconds", "histogram", "Telegram API call latency by method")
+metrics.describe("bot_api_errors_total", "counter", "Failed Telegram API calls by method and error code")
+metrics.describe("bot_import_rows_total", "counter", "Bulk import rows by result")
+metrics.describe("bot_export_seconds", "histogram", "Admin export duration by table")
+metrics.describe("bot_export_rows_total", "counter", "Rows written by admin exports")
+metrics.describe("bot_retention_seconds", "histogram", "History retention run duration")
+metrics.describe("bot_retention_archived_rows_total", "counter", "History rows rolled up and archived")
+
+# ===================== HTTP =====================
+
+class MetricsServer:
+    # فقط GET /metrics؛ پیش‌فرض روی 127.0.0.1 تا از بیرون در دسترس نباشد
+    def __init__(self, registry, host="127.0.0.1", port=9100):
+        # http.server فقط وقتی سرور واقعاً ساخته می‌شود import می‌شود
+        from http.server import ThreadingHTTPServer
+
+        self.registry = registry
+        self.httpd = ThreadingHTTPServer((host, port), self._handler_class())
+        self.httpd.daemon_threads = True
+
+    def start(self):
+        threading.Thread(target=self.httpd.serve_forever, name="metrics-http", daemon=True).start()
+
+    def shutdown(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def _handler_class(self):
+        from http.server import BaseHTTPRequestHandler
+
+        registry = self.registry
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path != "/metrics":
+                    self.send_response(404)
+                    self.send_header("Content-Length", "0")
+                    self.end_headers()
+                    return
+                data = registry.render().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, format, *args):
+                logger.debug(format, *args)
+
+        return Handler
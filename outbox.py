@@ -0,0 +1,308 @@
+import heapq
+import itertools
+import logging
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+from functools import partial
+
+from metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+# اولویت‌ها: عدد کمتر زودتر ارسال می‌شود
+PRIORITY_CALLBACK = 0
+PRIORITY_NORMAL = 1
+PRIORITY_BULK = 2
+
+# متدهایی که به یک چت خاص ارسال نمی‌شوند (شامل محدودیت هر چت نیستند)
+CHATLESS_METHODS = {"answer_callback_query", "answer_inline_query"}
+
+def _is_chat(key):
+    return not (isinstance(key, tuple) and key[0] == "job")
+
+# ===================== TOKEN BUCKET =====================
+
+class TokenBucket:
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, now):
+        # چند ثانیه تا آزاد شدن یک توکن مانده (۰ یعنی همین الان)
+        self._refill(now)
+        if self.tokens >= 1:
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    def take(self, now):
+        self._refill(now)
+        self.tokens -= 1
+
+    def pause(self, now, seconds):
+        # بعد از 429: تا retry_after ثانیه هیچ توکنی نده
+        self._refill(now)
+        self.tokens = min(self.tokens, 1) - seconds * self.rate
+
+    def is_full(self, now):
+        self._refill(now)
+        return self.tokens >= self.capacity
+
+# ===================== OUTBOX =====================
+
+def _seekable(value):
+    # فایل‌هایی که ارسال می‌شوند (document/photo)؛ str و bytes متد seek ندارند
+    try:
+        return hasattr(value, "read") and value.seekable()
+    except Exception:
+        return False
+
+class _Job:
+    __slots__ = ("priority", "seq", "method", "args", "kwargs", "future", "attempts", "files")
+
+    def __init__(self, priority, seq, method, args, kwargs):
+        self.priority = priority
+        self.seq = seq
+        self.method = method
+        self.args = args
+        self.kwargs = kwargs
+        self.future = Future()
+        self.attempts = 0
+        # مکان فایل‌ها هنگام submit؛ بعد از 429 تلاش قبلی فایل را تا انتها خوانده است
+        self.files = [
+            (value, value.tell()) for value in itertools.chain(args, kwargs.values()) if _seekable(value)
+        ]
+
+    def rewind(self):
+        for value, position in self.files:
+            value.seek(position)
+
+class Outbox:
+    # صف ارسال بین هندلرها و TeleBot:
+    # هر چت یک صف FIFO دارد و فقط سرِ صف هر چت در heap اولویت‌ها قرار می‌گیرد،
+    # پس ترتیب پیام‌های یک چت حفظ می‌شود و انتخاب کار بعدی O(log n) است.
+
+    def __init__(self, bot, global_rate=30, chat_rate=1, chat_burst=3, workers=4, max_retries=5):
+        self.bot = bot
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.max_retries = max_retries
+
+        self._global = TokenBucket(global_rate, global_rate)
+        self._buckets = {}
+        self._queues = {}
+        self._ready = []     # (priority, seq, key)
+        self._delayed = []   # (not_before, seq, key)
+        self._busy = set()
+        self._cond = threading.Condition()
+        self._seq = itertools.count()
+
+        self.sent = 0
+        self.retried = 0
+        self.failed = 0
+
+        for i in range(workers):
+            threading.Thread(target=self._worker, name=f"outbox-{i}", daemon=True).start()
+
+    def __getattr__(self, name):
+        # api.send_message(...) همان امضای bot.send_message را دارد ولی فقط صف می‌کند
+        if name.startswith("_") or not hasattr(self.bot, name):
+            raise AttributeError(name)
+        return partial(self.submit, name)
+
+    def submit(self, method, *args, priority=None, **kwargs):
+        seq = next(self._seq)
+        if method in CHATLESS_METHODS:
+            key = ("job", seq)
+            if priority is None:
+                priority = PRIORITY_CALLBACK
+        else:
+            key = kwargs.get("chat_id", args[0] if args else None)
+            if priority is None:
+                priority = PRIORITY_NORMAL
+
+        job = _Job(priority, seq, method, args, kwargs)
+        with self._cond:
+            queue = self._queues.setdefault(key, deque())
+            queue.append(job)
+            if len(queue) == 1 and key not in self._busy:
+                heapq.heappush(self._ready, (priority, seq, key))
+                self._cond.notify()
+        return job.future
+
+    # ---------- metrics ----------
+
+    def depth(self):
+        with self._cond:
+            return sum(len(q) for q in self._queues.values())
+
+    def stats(self):
+        return {
+            "depth": self.depth(),
+            "sent": self.sent,
+            "retried": self.retried,
+            "failed": self.failed,
+        }
+
+    def join(self, timeout=None):
+        # منتظر می‌ماند تا صف خالی شود (برای خاموش شدن تمیز و تست‌ها)
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._cond:
+            while self._queues or self._busy:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._cond.wait(remaining)
+        return True
+
+    # ---------- scheduling ----------
+
+    def _chat_bucket(self, key):
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = self._buckets[key] = TokenBucket(self.chat_rate, self.chat_burst)
+        return bucket
+
+    def _next_job(self, timeout=None):
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._cond:
+            while True:
+                now = time.monotonic()
+                if deadline is not None and now >= deadline:
+                    return None
+                while self._delayed and self._delayed[0][0] <= now:
+                    _, seq, key = heapq.heappop(self._delayed)
+                    job = self._queues[key][0]
+                    heapq.heappush(self._ready, (job.priority, job.seq, key))
+
+                wait = None
+                if self._ready:
+                    wait = self._global.wait_time(now)
+                    if wait == 0:
+                        picked = self._pick(now)
+                        if picked:
+                            return picked
+                        wait = None
+                if self._delayed:
+                    until_delayed = self._delayed[0][0] - now
+                    wait = until_delayed if wait is None else min(wait, until_delayed)
+                if deadline is not None:
+                    wait = deadline - now if wait is None else min(wait, deadline - now)
+                self._cond.wait(wait)
+
+    def _pick(self, now):
+        while self._ready:
+            _, seq, key = heapq.heappop(self._ready)
+            queue = self._queues[key]
+            if _is_chat(key):
+                bucket = self._chat_bucket(key)
+                wait = bucket.wait_time(now)
+                if wait > 0:
+                    heapq.heappush(self._delayed, (now + wait, seq, key))
+                    continue
+                bucket.take(now)
+            self._global.take(now)
+            job = queue.popleft()
+            self._busy.add(key)
+            return key, job
+        return None
+
+    def _finish(self, key, ok=True, retry_after=None, job=None):
+        with self._cond:
+            self._busy.discard(key)
+            if ok:
+                self.sent += 1
+            elif retry_after is None:
+                self.failed += 1
+            queue = self._queues[key]
+            now = time.monotonic()
+            if retry_after is not None:
+                queue.appendleft(job)
+                self.retried += 1
+                if _is_chat(key):
+                    self._chat_bucket(key).pause(now, retry_after)
+                else:
+                    self._global.pause(now, retry_after)
+                heapq.heappush(self._delayed, (now + retry_after, job.seq, key))
+            elif queue:
+                head = queue[0]
+                heapq.heappush(self._ready, (head.priority, head.seq, key))
+            else:
+                del self._queues[key]
+                bucket = self._buckets.get(key)
+                if bucket is not None and bucket.is_full(now):
+                    del self._buckets[key]
+            self._cond.notify_all()
+
+    # ---------- delivery ----------
+
+    def _worker(self):
+        while True:
+            picked = self._next_job()
+            if picked:
+                key, job = picked
+                start = time.perf_counter()
+                try:
+                    job.rewind()
+                    result = getattr(self.bot, job.method)(*job.args, **job.kwargs)
+                except Exception as e:
+                    self._failed(key, job, e)
+                else:
+                    job.future.set_result(result)
+                    self._finish(key)
+                finally:
+                    metrics.observe("bot_api_seconds", time.perf_counter() - start, method=job.method)
+
+    async def run_async(self, abot, concurrency=100):
+        # حالت asyncio: یک thread فقط زمان‌بندی می‌کند و ارسال‌ها به‌صورت
+        # coroutine هم‌زمان روی AsyncTeleBot اجرا می‌شوند (حداکثر concurrency تا).
+        import asyncio
+
+        loop = asyncio.get_running_loop()
+        semaphore = asyncio.Semaphore(concurrency)
+        while True:
+            await semaphore.acquire()
+            picked = await loop.run_in_executor(None, self._next_job, 1.0)
+            if not picked:
+                semaphore.release()
+                continue
+            loop.create_task(self._deliver_async(abot, picked, semaphore))
+
+    async def _deliver_async(self, abot, picked, semaphore):
+        key, job = picked
+        start = time.perf_counter()
+        try:
+            job.rewind()
+            result = await getattr(abot, job.method)(*job.args, **job.kwargs)
+        except Exception as e:
+            self._failed(key, job, e)
+        else:
+            job.future.set_result(result)
+            self._finish(key)
+        finally:
+            metrics.observe("bot_api_seconds", time.perf_counter() - start, method=job.method)
+            semaphore.release()
+
+    def _failed(self, key, job, e):
+        # خطاهای API تلگرام (نسخه‌ی sync و async) هر دو error_code و result_json دارند
+        error_code = getattr(e, "error_code", None)
+        metrics.inc("bot_api_errors_total", method=job.method, code=error_code or type(e).__name__)
+        if error_code == 429 and job.attempts < self.max_retries:
+            retry_after = (e.result_json.get("parameters") or {}).get("retry_after", 1)
+            job.attempts += 1
+            logger.warning("%s throttled, retrying in %ss", job.method, retry_after)
+            self._finish(key, ok=False, retry_after=retry_after, job=job)
+            return
+        if error_code is not None:
+            logger.warning("%s failed: %s", job.method, e.description)
+        else:
+            logger.error("%s failed", job.method, exc_info=e)
+        job.future.set_exception(e)
+        self._finish(key, ok=False)
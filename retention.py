@@ -0,0 +1,273 @@
+import argparse
+import gzip
+import json
+import logging
+import os
+import socket
+import threading
+import time
+import uuid
+from datetime import datetime, timedelta
+
+from metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+# نگهداری تاریخچه: history فقط به انتهایش اضافه می‌شود ولی «📜 تاریخچه» فقط ۲۰ سطر آخر را
+# می‌خواند. سطرهای قدیمی‌تر از days روز:
+# - در جدول‌های روزانه‌ی history_daily_product و history_daily_seller جمع زده می‌شوند
+#   (contact_count محصولات تغییر نمی‌کند؛ شمارش کل = history + history_daily_product)
+# - به صورت JSONL در فایل‌های ماهانه‌ی gzip (history-YYYY-MM.jsonl.gz) در archive_dir نوشته
+#   و از history حذف می‌شوند؛ هر دسته یک member جدید gzip است و zcat همه را پشت هم می‌خواند
+# - صفحه‌های آزادشده با PRAGMA incremental_vacuum در قدم‌های کوچک به سیستم‌عامل برمی‌گردند
+#
+# اندازه‌ی فایل‌های آرشیو بعد از هر دسته در همان تراکنش حذف سطرها ثبت می‌شود؛ اگر پروسه
+# بین نوشتن فایل و commit بمیرد، اجرای بعدی فایل را به اندازه‌ی ثبت‌شده کوتاه می‌کند و
+# سطری دو بار آرشیو نمی‌شود.
+#
+# هر پروسه‌ی ربات (و cron) این کار را زمان‌بندی می‌کند ولی در هر لحظه فقط صاحب lease
+# «history_retention» در جدول leases اجرا می‌کند؛ lease در همان تراکنش هر دسته تمدید
+# می‌شود و اگر پروسه‌ی دیگری آن را گرفته باشد (مثلاً بعد از گیر کردن طولانی) دسته rollback
+# و اجرا متوقف می‌شود.
+#
+#   python retention.py --days 90                 # یک بار اجرا (مثلاً از cron)
+#   python retention.py --enable-incremental-vacuum   # یک بار، با ربات خاموش (VACUUM کامل)
+
+AUTO_VACUUM_INCREMENTAL = 2
+
+LEASE = "history_retention"
+
+# lease را می‌گیرد اگر آزاد، منقضی یا از قبل مال همین صاحب باشد
+CLAIM_LEASE = """
+INSERT INTO leases (name, owner, expires_at) VALUES (?, ?, ?)
+ON CONFLICT (name) DO UPDATE SET owner = excluded.owner, expires_at = excluded.expires_at
+WHERE leases.owner = excluded.owner OR leases.expires_at <= ?
+"""
+
+ROLLUP_PRODUCT = """
+INSERT INTO history_daily_product (product_id, day, seller_id, contacts)
+SELECT product_id, substr(timestamp, 1, 10), seller_id, COUNT(*)
+FROM history WHERE id BETWEEN ? AND ?
+GROUP BY product_id, substr(timestamp, 1, 10)
+ON CONFLICT (product_id, day) DO UPDATE SET contacts = contacts + excluded.contacts
+"""
+
+ROLLUP_SELLER = """
+INSERT INTO history_daily_seller (seller_id, day, contacts)
+SELECT seller_id, substr(timestamp, 1, 10), COUNT(*)
+FROM history WHERE id BETWEEN ? AND ? AND seller_id IS NOT NULL
+GROUP BY seller_id, substr(timestamp, 1, 10)
+ON CONFLICT (seller_id, day) DO UPDATE SET contacts = contacts + excluded.contacts
+"""
+
+class LeaseLost(RuntimeError):
+    pass
+
+class Retention:
+    def __init__(self, db, archive_dir, days=90, batch=2000, vacuum_pages=1000, interval=24 * 3600,
+                 lease_ttl=600):
+        self.db = db
+        self.archive_dir = archive_dir
+        self.days = days
+        self.batch = batch
+        self.vacuum_pages = vacuum_pages
+        self.interval = interval
+        self.lease_ttl = lease_ttl
+        self.owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+
+    # ---------- scheduling ----------
+
+    def start(self, delay=60):
+        # اولین اجرا با کمی تأخیر تا راه‌اندازی ربات کند نشود
+        threading.Thread(target=self._loop, args=(delay,), name="retention", daemon=True).start()
+
+    def stop(self):
+        self._stop.set()
+
+    def _loop(self, delay):
+        wait = delay
+        while not self._stop.wait(wait):
+            try:
+                self.run()
+            except Exception:
+                logger.exception("history retention failed")
+            wait = self.interval
+
+    # ---------- run ----------
+
+    def run(self):
+        # خروجی: آمار اجرا، یا None اگر اجرای دیگری (در این یا پروسه‌ی دیگری) در جریان است
+        if not self._lock.acquire(blocking=False):
+            return None
+        try:
+            with self.db.transaction() as cur:
+                if not self._claim(cur):
+                    logger.info("history retention is running in another process")
+                    return None
+            start = time.perf_counter()
+            try:
+                archived = self.archive()
+                freed = self.vacuum()
+            except LeaseLost:
+                logger.warning("history retention lease was taken over; stopping")
+                return None
+            finally:
+                self._release()
+            elapsed = time.perf_counter() - start
+            metrics.observe("bot_retention_seconds", elapsed)
+            logger.info("history retention: %d rows archived, %d pages freed in %.1fs", archived, freed, elapsed)
+            return {"archived": archived, "freed_pages": freed, "seconds": elapsed}
+        finally:
+            self._lock.release()
+
+    # ---------- lease ----------
+
+    def _claim(self, cur):
+        # داخل تراکنش نوشتن صدا زده می‌شود؛ lease را می‌گیرد یا تمدید می‌کند
+        now = time.time()
+        cur.execute(CLAIM_LEASE, (LEASE, self.owner, now + self.lease_ttl, now))
+        row = cur.execute("SELECT owner FROM leases WHERE name=?", (LEASE,)).fetchone()
+        return row is not None and row[0] == self.owner
+
+    def _renew(self, cur):
+        if not self._claim(cur):
+            raise LeaseLost(LEASE)
+
+    def _release(self):
+        with self.db.transaction() as cur:
+            cur.execute("UPDATE leases SET expires_at = 0 WHERE name=? AND owner=?", (LEASE, self.owner))
+
+    def cutoff(self):
+        # مرز روز (UTC، مثل timestamp سطرها)؛ هر روز یک‌جا و کامل جمع زده می‌شود
+        return (datetime.utcnow() - timedelta(days=self.days)).date().isoformat()
+
+    def archive(self):
+        cutoff = self.cutoff()
+        os.makedirs(self.archive_dir, exist_ok=True)
+        archived = 0
+        last_id = 0
+        while not self._stop.is_set():
+            # id و timestamp هر دو صعودی‌اند؛ دسته‌ها از ابتدای جدول تا اولین سطر جدیدتر از cutoff
+            rows = self.db.cursor().execute(
+                "SELECT id, user_id, product_id, seller_id, timestamp FROM history \
+                 WHERE id > ? ORDER BY id LIMIT ?",
+                (last_id, self.batch)
+            ).fetchall()
+            old = []
+            for row in rows:
+                if (row[4] or "") >= cutoff:
+                    break
+                old.append(row)
+            if not old:
+                break
+
+            self._archive_batch(old)
+            archived += len(old)
+            metrics.inc("bot_retention_archived_rows_total", len(old))
+            if len(old) < len(rows):
+                break
+            last_id = old[-1][0]
+        return archived
+
+    def _archive_batch(self, rows):
+        months = {}
+        for row in rows:
+            months.setdefault((row[4] or "unknown")[:7], []).append(row)
+
+        sizes = [
+            (name, self._append(name, items))
+            for name, items in ((f"history-{month}.jsonl.gz", items) for month, items in months.items())
+        ]
+        first, last = rows[0][0], rows[-1][0]
+        with self.db.transaction() as cur:
+            # با LeaseLost کل دسته rollback می‌شود؛ نوشتن فایل را اجرای بعدی کوتاه می‌کند
+            self._renew(cur)
+            cur.execute(ROLLUP_PRODUCT, (first, last))
+            cur.execute(ROLLUP_SELLER, (first, last))
+            cur.execute("DELETE FROM history WHERE id BETWEEN ? AND ?", (first, last))
+            cur.executemany(
+                "INSERT INTO history_archive_files (name, size) VALUES (?, ?) \
+                 ON CONFLICT (name) DO UPDATE SET size = excluded.size",
+                sizes
+            )
+
+    def _append(self, name, rows):
+        # فایل را به اندازه‌ی ثبت‌شده در دیتابیس کوتاه می‌کند (دور ریختن نوشتن ناتمام قبلی)
+        # و یک member جدید gzip اضافه می‌کند. خروجی: اندازه‌ی جدید فایل
+        row = self.db.cursor().execute(
+            "SELECT size FROM history_archive_files WHERE name=?", (name,)
+        ).fetchone()
+        committed = row[0] if row else 0
+        path = os.path.join(self.archive_dir, name)
+
+        with open(path, "r+b" if os.path.exists(path) else "w+b") as f:
+            actual = f.seek(0, os.SEEK_END)
+            if actual < committed:
+                raise RuntimeError(f"{path} is {actual} bytes but {committed} bytes were archived into it")
+            f.truncate(committed)
+            f.seek(committed)
+            with gzip.GzipFile(filename="", fileobj=f, mode="wb", compresslevel=6) as gz:
+                gz.write("".join(
+                    json.dumps({"id": i, "user_id": u, "product_id": p, "seller_id": s, "timestamp": t}) + "\n"
+                    for i, u, p, s, t in rows
+                ).encode("utf-8"))
+            f.flush()
+            # قبل از حذف سطرها باید روی دیسک باشد
+            os.fsync(f.fileno())
+            return f.tell()
+
+    def vacuum(self):
+        # فقط اگر دیتابیس در حالت auto_vacuum=INCREMENTAL باشد؛ هر قدم قفل نوشتن را کوتاه نگه می‌دارد
+        cur = self.db.cursor()
+        if cur.execute("PRAGMA auto_vacuum").fetchone()[0] != AUTO_VACUUM_INCREMENTAL:
+            logger.warning("auto_vacuum is not INCREMENTAL; run python retention.py --enable-incremental-vacuum")
+            return 0
+        start = free = cur.execute("PRAGMA freelist_count").fetchone()[0]
+        while free and not self._stop.is_set():
+            with self.db.write_lock:
+                with self.db.transaction() as lease:
+                    self._renew(lease)
+                # execute هر بار فقط یک صفحه آزاد می‌کند؛ executescript دستور را تا آخر اجرا می‌کند
+                self.db.connection().executescript(f"PRAGMA incremental_vacuum({self.vacuum_pages})")
+            remaining = cur.execute("PRAGMA freelist_count").fetchone()[0]
+            if remaining >= free:
+                break
+            free = remaining
+        return start - free
+
+def enable_incremental_vacuum(db):
+    # auto_vacuum فقط با یک VACUUM کامل روی دیتابیس موجود عوض می‌شود؛ کل فایل بازنویسی می‌شود
+    with db.write_lock:
+        conn = db.connection()
+        conn.execute(f"PRAGMA auto_vacuum = {AUTO_VACUUM_INCREMENTAL}")
+        conn.execute("VACUUM")
+
+# ===================== CLI =====================
+
+def main(argv=None):
+    from config import RETENTION_DAYS, RETENTION_BATCH, HISTORY_ARCHIVE_DIR, VACUUM_PAGES
+
+    parser = argparse.ArgumentParser(description="Roll up and archive old history rows")
+    parser.add_argument("--days", type=int, default=RETENTION_DAYS)
+    parser.add_argument("--archive-dir", default=HISTORY_ARCHIVE_DIR)
+    parser.add_argument("--batch", type=int, default=RETENTION_BATCH)
+    parser.add_argument("--enable-incremental-vacuum", action="store_true",
+                        help="switch the database to auto_vacuum=INCREMENTAL (full VACUUM; stop the bot first)")
+    args = parser.parse_args(argv)
+
+    from database import db, ensure_schema
+
+    ensure_schema()
+    if args.enable_incremental_vacuum:
+        enable_incremental_vacuum(db)
+        print("auto_vacuum = INCREMENTAL")
+        return
+    if args.days <= 0:
+        parser.error("--days must be positive")
+    retention = Retention(db, args.archive_dir, days=args.days, batch=args.batch, vacuum_pages=VACUUM_PAGES)
+    print(retention.run())
+
+if __name__ == "__main__":
+    main()
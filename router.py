@@ -0,0 +1,152 @@
+import logging
+import time
+
+from metrics import metrics, set_current_handler
+
+logger = logging.getLogger(__name__)
+
+# callback_data به شکل action:id است (مثلاً cart_add:12)؛
+# action از روی trie پیدا می‌شود، پس هزینه‌ی dispatch به تعداد مسیرها بستگی ندارد.
+
+def parse_callback(data):
+    action, _, arg = data.partition(":")
+    return action, arg
+
+class _Node:
+    __slots__ = ("children", "handler")
+
+    def __init__(self):
+        self.children = {}
+        self.handler = None
+
+class Router:
+    def __init__(self):
+        self.commands = {}
+        self.texts = {}
+        self.fallback = None
+        self.callback_fallback = None
+        self.inline_handler = None
+        self.states = None
+        self._callbacks = _Node()
+
+    # ---------- registration ----------
+
+    def command(self, *names):
+        def decorator(handler):
+            for name in names:
+                self.commands[name] = handler
+            return handler
+        return decorator
+
+    def text(self, *texts):
+        def decorator(handler):
+            for text in texts:
+                self.texts[text] = handler
+            return handler
+        return decorator
+
+    def callback(self, *actions):
+        def decorator(handler):
+            for action in actions:
+                node = self._callbacks
+                for ch in action:
+                    node = node.children.setdefault(ch, _Node())
+                node.handler = handler
+            return handler
+        return decorator
+
+    def inline(self, handler):
+        self.inline_handler = handler
+        return handler
+
+    def use_states(self, store):
+        # اگر چت وسط یک گفتگو باشد، پیام به هندلر همان مرحله می‌رود
+        self.states = store
+
+    def default(self, handler):
+        self.fallback = handler
+        return handler
+
+    def default_callback(self, handler):
+        self.callback_fallback = handler
+        return handler
+
+    # ---------- matching ----------
+
+    def match_message(self, message):
+        text = message.text
+        if text is None:
+            return None
+        if text.startswith("/"):
+            name = text[1:].split(maxsplit=1)[0].split("@")[0] if len(text) > 1 else ""
+            handler = self.commands.get(name)
+            if handler:
+                return handler
+        return self.texts.get(text, self.fallback)
+
+    def match_callback(self, data):
+        # طولانی‌ترین action ثبت‌شده که بعدش ':' یا انتهای رشته است
+        node = self._callbacks
+        found = None
+        for i, ch in enumerate(data):
+            node = node.children.get(ch)
+            if node is None:
+                break
+            if node.handler and (i + 1 == len(data) or data[i + 1] == ":"):
+                found = node.handler
+        return found or self.callback_fallback
+
+    # ---------- dispatch ----------
+
+    def dispatch(self, handler, update, **data):
+        name = handler.__name__
+        previous = set_current_handler(name)
+        start = time.perf_counter()
+        try:
+            handler(update, **data)
+        except Exception as e:
+            metrics.inc("bot_handler_errors_total", handler=name, type=type(e).__name__)
+            raise
+        finally:
+            metrics.observe("bot_handler_seconds", time.perf_counter() - start, handler=name)
+            set_current_handler(previous)
+
+    def on_message(self, message):
+        if self.states is not None:
+            step = self.states.consume(message.chat.id)
+            if step:
+                handler, data = step
+                self.dispatch(handler, message, **data)
+                return
+
+        handler = self.match_message(message)
+        if handler:
+            self.dispatch(handler, message)
+
+    def on_callback(self, call):
+        handler = self.match_callback(call.data or "")
+        if handler:
+            self.dispatch(handler, call)
+        else:
+            logger.debug("no route for callback %r", call.data)
+
+    def on_inline(self, query):
+        if self.inline_handler:
+            self.dispatch(self.inline_handler, query)
+
+    def install(self, bot):
+        # فقط یک هندلر برای هر نوع آپدیت (پیام، callback، inline) در telebot ثبت می‌شود
+        bot.message_handler(func=lambda m: True, content_types=["text", "photo", "document"])(self.on_message)
+        bot.callback_query_handler(func=lambda c: True)(self.on_callback)
+        bot.inline_handler(func=lambda q: True)(self.on_inline)
+
+    def stats(self):
+        return {
+            dict(labels)["handler"]: {
+                "count": count,
+                "avg_ms": total / count * 1000,
+                "max_ms": worst * 1000,
+            }
+            for labels, (count, total, worst) in metrics.histograms("bot_handler_seconds").items()
+            if count
+        }
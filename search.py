@@ -0,0 +1,92 @@
+import re
+
+PAGE_SIZE = 5
+
+# عبارت‌های خیلی عمومی (مثلاً «گوشی») ممکن است به صدها هزار محصول بخورند؛ برای اینکه
+# مرتب‌سازی به تعداد نتایج بستگی نداشته باشد فقط جدیدترین CANDIDATES نتیجه (بعد از فیلتر قیمت)
+# رتبه‌بندی می‌شوند و search_products بریده شدن نتایج را برمی‌گرداند تا به کاربر گفته شود.
+# برای عبارت‌های دقیق‌تر که کمتر از این تعداد نتیجه دارند رتبه‌بندی کامل است.
+CANDIDATES = 1000
+
+# یکسان‌سازی متن فارسی؛ همین تابع هم برای عبارت جستجو و هم (به‌صورت تابع SQL
+# به نام fa_normalize در triggerها) برای متن ایندکس‌شده استفاده می‌شود تا هر دو طرف یکسان باشند.
+NORMALIZE_MAP = {
+    "ي": "ی", "ى": "ی", "ك": "ک", "ۀ": "ه", "ة": "ه", "أ": "ا", "إ": "ا",
+    **{chr(0x06F0 + i): str(i) for i in range(10)},   # ارقام فارسی
+    **{chr(0x0660 + i): str(i) for i in range(10)},   # ارقام عربی
+    # اعراب و کشیده حذف می‌شوند
+    **{chr(c): "" for c in range(0x064B, 0x0653)},
+    "ـ": "",
+}
+
+_TRANSLATE = str.maketrans(NORMALIZE_MAP)
+# بازه‌ی قیمت فقط یک کلمه‌ی جدا (بین فاصله‌ها) است، مثل 1000-5000، -5000 یا 1000-؛
+# خط تیره‌ی داخل نام مدل (iphone-13) بازه حساب نمی‌شود
+_PRICE_RANGE = re.compile(r"(?<!\S)(?:(\d+)-(\d*)|-(\d+))(?!\S)")
+
+def normalize(text):
+    return (text or "").translate(_TRANSLATE).lower()
+
+def parse_query(raw):
+    # «گوشی سامسونگ 1000-5000» → (["گوشی", "سامسونگ"], 1000, 5000)
+    text = normalize(raw)
+    min_price = max_price = None
+    match = _PRICE_RANGE.search(text)
+    if match:
+        low, high, only_high = match.groups()
+        min_price = int(low) if low else None
+        high = high or only_high
+        max_price = int(high) if high else None
+        text = text[:match.start()] + " " + text[match.end():]
+    return re.findall(r"\w+", text), min_price, max_price
+
+def search_products(cur, raw, offset=0, limit=PAGE_SIZE):
+    # خروجی: (ردیف‌های id, title, price, photo ، آیا صفحه‌ی بعد هست، آیا فقط CANDIDATES نتیجه‌ی
+    # جدیدتر دیده شده‌اند)
+    terms, min_price, max_price = parse_query(raw)
+
+    filters = []
+    params = []
+    if min_price is not None:
+        filters.append("p.price >= ?")
+        params.append(min_price)
+    if max_price is not None:
+        filters.append("p.price <= ?")
+        params.append(max_price)
+
+    if terms:
+        # کلمات کامل جستجو می‌شوند؛ tokenizer روی نیم‌فاصله هم جدا می‌کند (گوشی‌ها → گوشی + ها)
+        match = " ".join(f'"{term}"' for term in terms)
+        where = "".join(f" AND {f}" for f in filters)
+        # FTS5 نتایج را به ترتیب rowid پیمایش می‌کند، پس LIMIT داخلی زود متوقف می‌شود؛
+        # فیلتر قیمت داخل همان پیمایش است تا سقف CANDIDATES فقط محصولات داخل بازه را بشمارد.
+        # candidates (تعداد کل نامزدها، قبل از LIMIT بیرونی) نشان می‌دهد سقف پر شده یا نه
+        cur.execute(
+            f"SELECT id, title, price, photo, COUNT(*) OVER () AS candidates \
+              FROM ( \
+                  SELECT p.id, p.title, p.price, p.photo, bm25(products_fts, 10.0, 1.0) AS score \
+                  FROM products_fts JOIN products p ON p.id = products_fts.rowid \
+                  WHERE products_fts MATCH ?{where} \
+                  ORDER BY products_fts.rowid DESC LIMIT ? \
+              ) \
+              ORDER BY score \
+              LIMIT ? OFFSET ?",
+            [match] + params + [CANDIDATES, limit + 1, offset]
+        )
+        rows = cur.fetchall()
+        truncated = bool(rows) and rows[0][4] >= CANDIDATES
+        return [row[:4] for row in rows[:limit]], len(rows) > limit, truncated
+    elif filters:
+        # فقط بازه‌ی قیمت: از ایندکس products.price استفاده می‌شود
+        cur.execute(
+            f"SELECT p.id, p.title, p.price, p.photo FROM products p \
+              WHERE {' AND '.join(filters)} \
+              ORDER BY p.price, p.id \
+              LIMIT ? OFFSET ?",
+            params + [limit + 1, offset]
+        )
+    else:
+        return [], False, False
+
+    rows = cur.fetchall()
+    return rows[:limit], len(rows) > limit, False
@@ -0,0 +1,142 @@
+import hashlib
+import json
+import logging
+import re
+import sqlite3
+import sys
+import threading
+import time
+from collections import defaultdict
+
+from metrics import current_handler
+
+logger = logging.getLogger(__name__)
+
+# لاگ کوئری‌های کند (اختیاری، با SLOW_QUERY_LOG در config):
+# هر دستوری که بیشتر از threshold طول بکشد با پارامترهای کوتاه‌شده، زمان، هندلر صدا زننده و
+# EXPLAIN QUERY PLAN در یک فایل JSONL چرخشی نوشته می‌شود.
+#
+#   python slowlog.py slow_queries.jsonl*      # خلاصه بر اساس fingerprint دستورها
+
+MAX_PARAM_CHARS = 64
+
+_LITERALS = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+_IN_LIST = re.compile(r"\(\s*\?(?:\s*,\s*\?)*\s*\)")
+
+def fingerprint(sql):
+    # دستورهایی که فقط در مقدارها فرق دارند یک fingerprint دارند
+    text = _LITERALS.sub("?", " ".join(sql.split()).lower())
+    text = _IN_LIST.sub("(?)", text)
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()[:12], text
+
+def normalize_param(value):
+    if isinstance(value, str):
+        return value if len(value) <= MAX_PARAM_CHARS else value[:MAX_PARAM_CHARS] + "…"
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        return f"<{len(value)} bytes>"
+    if value is None or isinstance(value, (int, float)):
+        return value
+    return repr(value)[:MAX_PARAM_CHARS]
+
+def normalize_params(params):
+    if isinstance(params, dict):
+        return {k: normalize_param(v) for k, v in params.items()}
+    return [normalize_param(v) for v in params]
+
+class SlowQueryLog:
+    def __init__(self, path, threshold_ms=100, max_bytes=10 * 1024 * 1024, backups=5):
+        from logging.handlers import RotatingFileHandler
+
+        self.threshold = threshold_ms / 1000
+        self._handler = RotatingFileHandler(path, maxBytes=max_bytes, backupCount=backups, encoding="utf-8")
+        self._lock = threading.Lock()
+
+    def record(self, conn, sql, params, elapsed, many=False):
+        entry = {
+            "ts": round(time.time(), 3),
+            "ms": round(elapsed * 1000, 3),
+            "fingerprint": fingerprint(sql)[0],
+            "sql": " ".join(sql.split()),
+            "params": None if many else normalize_params(params),
+            "many": many,
+            "handler": current_handler(),
+            "thread": threading.current_thread().name,
+            "plan": None if many else query_plan(conn, sql, params),
+        }
+        line = json.dumps(entry, ensure_ascii=False)
+        with self._lock:
+            try:
+                # RotatingFileHandler خودش اندازه را چک و فایل را جابه‌جا می‌کند
+                self._handler.emit(logging.makeLogRecord({"msg": line}))
+            except Exception:
+                logger.exception("slow query log write failed")
+
+    def close(self):
+        self._handler.close()
+
+def query_plan(conn, sql, params):
+    # با cursor معمولی sqlite3 (نه InstrumentedCursor) تا خودش دوباره زمان‌گیری و لاگ نشود
+    try:
+        rows = conn.cursor(sqlite3.Cursor).execute("EXPLAIN QUERY PLAN " + sql, params).fetchall()
+    except sqlite3.Error:
+        # مثلاً دستورهای DDL یا PRAGMA
+        return None
+    return [detail for _, _, _, detail in rows]
+
+# ===================== SUMMARY =====================
+
+def read_entries(paths):
+    for path in paths:
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    yield json.loads(line)
+                except ValueError:
+                    continue
+
+def is_full_scan(detail):
+    # FTS، ردیف ثابت و subqueryهای ساخته‌شده در همان کوئری حساب نمی‌شوند
+    return (
+        detail.startswith("SCAN ")
+        and "VIRTUAL TABLE" not in detail
+        and not detail.startswith(("SCAN CONSTANT ROW", "SCAN (subquery"))
+    )
+
+def summarize(entries):
+    groups = defaultdict(list)
+    for entry in entries:
+        groups[entry["fingerprint"]].append(entry)
+
+    summary = []
+    for key, items in groups.items():
+        times = sorted(item["ms"] for item in items)
+        latest = max(items, key=lambda item: item["ts"])
+        plan = latest.get("plan") or []
+        summary.append({
+            "fingerprint": key,
+            "count": len(items),
+            "total_ms": round(sum(times), 3),
+            "p50_ms": times[len(times) // 2],
+            "max_ms": times[-1],
+            "handlers": sorted({item["handler"] or "-" for item in items}),
+            "full_scan": any(is_full_scan(line) for line in plan),
+            "sql": latest["sql"],
+            "plan": plan,
+        })
+    summary.sort(key=lambda row: row["total_ms"], reverse=True)
+    return summary
+
+def main(paths):
+    for row in summarize(read_entries(paths)):
+        print(f"{row['fingerprint']}  {row['count']:>6}x  total {row['total_ms']:.1f} ms  "
+              f"p50 {row['p50_ms']:.1f} ms  max {row['max_ms']:.1f} ms"
+              f"{'  FULL SCAN' if row['full_scan'] else ''}")
+        print(f"    handlers: {', '.join(row['handlers'])}")
+        print(f"    {row['sql']}")
+        for line in row["plan"]:
+            print(f"      {line}")
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        sys.exit("usage: python slowlog.py slow_queries.jsonl [more files...]")
+    main(sys.argv[1:])
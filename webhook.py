@@ -0,0 +1,123 @@
+import json
+import logging
+import queue
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from telebot import types
+
+logger = logging.getLogger(__name__)
+
+MAX_BODY_SIZE = 1024 * 1024
+
+# سرور webhook داخلی: آپدیت‌ها را با POST می‌گیرد و در صف‌های محدود می‌گذارد.
+# هر چت همیشه به یک worker می‌رود تا ترتیب پیام‌هایش (مثلاً مراحل ثبت محصول) حفظ شود.
+# اگر صف پر باشد 503 برمی‌گردد و تلگرام بعداً دوباره می‌فرستد (backpressure).
+# TLS را reverse proxy یا load balancer جلوی این سرور انجام می‌دهد.
+
+def update_key(update):
+    for item in (update.message, update.edited_message, update.callback_query, update.inline_query):
+        if item is None:
+            continue
+        chat = getattr(item, "chat", None)
+        if chat is not None:
+            return chat.id
+        return item.from_user.id
+    return update.update_id
+
+class WebhookServer:
+    def __init__(self, bot, host, port, path, secret="", workers=8, queue_size=1000):
+        self.bot = bot
+        self.path = path
+        self.secret = secret
+        self.queues = [queue.Queue(max(1, queue_size // workers)) for _ in range(workers)]
+        self.rejected = 0
+        self.httpd = ThreadingHTTPServer((host, port), self._handler_class())
+        self.httpd.daemon_threads = True
+
+    def depth(self):
+        return sum(q.qsize() for q in self.queues)
+
+    def submit(self, update):
+        shard = self.queues[hash(update_key(update)) % len(self.queues)]
+        try:
+            shard.put_nowait(update)
+        except queue.Full:
+            self.rejected += 1
+            return False
+        return True
+
+    def start(self):
+        # اجرا در پس‌زمینه (برای تست آفلاین با POST کردن آپدیت‌های ضبط‌شده)
+        self._start_workers()
+        threading.Thread(target=self.httpd.serve_forever, name="webhook-http", daemon=True).start()
+
+    def serve_forever(self):
+        self._start_workers()
+        self.httpd.serve_forever()
+
+    def _start_workers(self):
+        for i, shard in enumerate(self.queues):
+            threading.Thread(target=self._worker, args=(shard,), name=f"webhook-{i}", daemon=True).start()
+
+    def shutdown(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def _worker(self, shard):
+        while True:
+            update = shard.get()
+            try:
+                self.bot.process_new_updates([update])
+            except Exception:
+                logger.exception("update %s failed", update.update_id)
+            finally:
+                shard.task_done()
+
+    def _handler_class(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path != "/healthz":
+                    self._reply(404)
+                    return
+                self._reply(200, json.dumps({"queue": server.depth(), "rejected": server.rejected}))
+
+            def do_POST(self):
+                if self.path != server.path:
+                    self._reply(404)
+                    return
+                if server.secret and self.headers.get("X-Telegram-Bot-Api-Secret-Token") != server.secret:
+                    self._reply(403)
+                    return
+
+                length = int(self.headers.get("Content-Length") or 0)
+                if length > MAX_BODY_SIZE:
+                    self._reply(413)
+                    return
+                try:
+                    update = types.Update.de_json(self.rfile.read(length).decode("utf-8"))
+                except (ValueError, KeyError, TypeError):
+                    self._reply(400)
+                    return
+
+                if server.submit(update):
+                    self._reply(200)
+                else:
+                    self.send_response(503)
+                    self.send_header("Retry-After", "1")
+                    self.send_header("Content-Length", "0")
+                    self.end_headers()
+
+            def _reply(self, status, body=""):
+                data = body.encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, format, *args):
+                logger.debug(format, *args)
+
+        return Handler